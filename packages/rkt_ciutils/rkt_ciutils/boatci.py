@@ -1,16 +1,32 @@
+import os
 import re
+import subprocess
+import threading
 from typing import Dict
+from typing import Set
+from typing import List
+from typing import Callable
 from typing import Optional
+from typing import Tuple
+from typing import Union
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from subprocess import CalledProcessError
 from rkd.api.contract import TaskInterface, ExecutionContext
 from rkd.api.syntax import TaskDeclaration
 from rkt_utils.docker import TagImageTask
 from rkt_utils.docker import PushTask
-from .github import ForEachGithubReleaseTask
+from rkt_utils.registry import RegistryClient, RegistryException, parse_image
+from rkt_utils.ledger import BuildLedger
+from .github import ForEachGithubReleaseTask, PlannedRelease, natural_sort
 from .github import FindClosestReleaseTask
 from .docker import DockerTagExistsTask
-from .tools import VersionTools, GitTools
+from .dockerfile import find_image_references, DockerfileSyntaxError
+from .tools import VersionTools, GitTools, TaskTools
+
+
+class GraphException(Exception):
+    pass
 
 
 class ProcessRequestTask(TaskInterface):
@@ -70,9 +86,13 @@ class ProcessRequestTask(TaskInterface):
             task_type=task_type,
             should_rebuild=rebuild,
             version=tag_template,
-            git_tag=git_tag
+            git_tag=git_tag,
+            in_process=bool(context.args['in_process'])
         )
 
+        if context.args['in_process']:
+            return TaskTools.run_command(self, cmd_to_exec, context.env, get_in_process_tasks())
+
         try:
             self.sh('set -x; %s' % cmd_to_exec, verbose=True)
         except CalledProcessError as e:
@@ -82,13 +102,14 @@ class ProcessRequestTask(TaskInterface):
         return True
 
     def _parse_template_str(self, template: str, task_type: str, should_rebuild: bool, git_tag: str,
-                            version: str = '') -> str:
+                            version: str = '', in_process: bool = False) -> str:
         parsed = template
 
         if "%NEXT_VERSION%" in template:
             parsed = parsed.replace('%NEXT_VERSION%', VersionTools.get_next_version())
 
         parsed = parsed.replace('%REBUILD_FLAG%', '' if should_rebuild else ' --dont-rebuild-when-exists')
+        parsed = parsed.replace('%IN_PROCESS_FLAG%', ' --in-process' if in_process else '')
 
         if version:
             parsed = parsed.replace('%VERSION%', version)
@@ -115,11 +136,15 @@ class ProcessRequestTask(TaskInterface):
         parser.add_argument(
             '--exec', '-e',
             help='Build task name. Defaults to building all releases from github',
-            default='rkd --no-ui %RELEASE_TASK% -rl info %REBUILD_FLAG% --version-template="%VERSION_TEMPLATE%"'
+            default='rkd --no-ui %RELEASE_TASK% -rl info %REBUILD_FLAG%%IN_PROCESS_FLAG% ' +
+                    '--version-template="%VERSION_TEMPLATE%"'
         )
         parser.add_argument('--dev-version-template', default='%MATCH_0%-SNAPSHOT',
                             help='Examples: %MATCH_0%-D%NEXT_VERSION%-SNAPSHOT')
         parser.add_argument('--release-version-template', default='%MATCH_0%-D%GIT_TAG%')
+        parser.add_argument('--in-process', action='store_true',
+                            help='Resolve the whole build chain into a single build plan and execute it ' +
+                                 'in this process, instead of spawning nested rkd processes')
 
 
 class EachRelease(TaskInterface):
@@ -137,9 +162,23 @@ class EachRelease(TaskInterface):
         github_repository: str = context.get_env('GITHUB_REPOSITORY')
         version_template: str = context.args['version_template']
         rebuild: bool = not context.args['dont_rebuild_when_exists']
+        in_process: bool = bool(context.args['in_process'])
         version_build_cmd: str = context.get_env('VERSION_BUILD_CMD')\
             .replace('%VERSION_TEMPLATE%', version_template)\
-            .replace('%IMAGE%', dest_docker_repo)
+            .replace('%IMAGE%', dest_docker_repo)\
+            .replace('%IN_PROCESS_FLAG%', ' --in-process' if in_process else '')
+
+        if in_process:
+            return self.execute_build_plan(context, self.create_build_plan(
+                github_repository=github_repository,
+                allowed_tags_regexp=allowed_tags_regexp,
+                dest_docker_repo=dest_docker_repo,
+                max_versions=max_versions,
+                version_template=version_template,
+                version_build_cmd=version_build_cmd,
+                rebuild=rebuild,
+                ledger_path=context.args.get('ledger') or None
+            ))
 
         opts = ''
 
@@ -166,6 +205,58 @@ class EachRelease(TaskInterface):
 
         return True
 
+    def create_build_plan(self, github_repository: str, allowed_tags_regexp: str, dest_docker_repo: str,
+                          max_versions: int, version_template: str, version_build_cmd: str,
+                          rebuild: bool, ledger_path: str = None) -> List[PlannedRelease]:
+        """
+        Resolve versions, docker tags, build commands and existence checks without spawning :github tasks
+
+        With a build ledger already pushed tags are answered locally, the registry is asked only on a miss
+        """
+
+        for_each_release = ForEachGithubReleaseTask()
+        self.copy_internal_dependencies(for_each_release)
+        for_each_release.ledger = BuildLedger(ledger_path) if ledger_path else None
+
+        try:
+            tags = for_each_release.get_available_tags('https://api.github.com/repos/%s' % github_repository,
+                                                       sleep_time=5, retries=5)
+
+            return for_each_release.plan_releases(
+                tags=tags,
+                max_versions=max_versions,
+                allowed_tags_regexp=re.compile(allowed_tags_regexp) if allowed_tags_regexp else None,
+                release_tag_template=version_template,
+                force_rebuild=rebuild,
+                build_command=version_build_cmd,
+                dest_docker_repo=dest_docker_repo
+            )
+
+        finally:
+            if for_each_release.ledger:
+                for_each_release.ledger.close()
+
+    def execute_build_plan(self, context: ExecutionContext, plan: List[PlannedRelease]) -> bool:
+        self.io().h1('Build plan')
+        self.io().outln(self.table(
+            ['Git tag', 'Docker tag', 'Already built', 'Command'],
+            [[release.git_tag, release.release_tag, 'yes' if release.already_built else 'no', release.command]
+             for release in plan]
+        ))
+
+        result = True
+
+        for release in plan:
+            if release.already_built:
+                continue
+
+            self.io().h2('Building "%s"' % release.release_tag)
+
+            if not TaskTools.run_command(self, release.command, context.env, get_in_process_tasks()):
+                result = False
+
+        return result
+
     def get_declared_envs(self) -> Dict[str, str]:
         return {
             'ALLOWED_TAGS_REGEXP': 'v([0-9.]+)',
@@ -174,7 +265,7 @@ class EachRelease(TaskInterface):
             'GITHUB_REPOSITORY': '',
             'VERSION_BUILD_CMD': 'rkd :boat-ci:specific-release --dockerfile=./Dockerfile ' +
                                  ' --dir=. --docker-version="%VERSION_TEMPLATE%" --app-version="%MATCH_0%" ' +
-                                 ' --dest-docker-repo=%IMAGE%'
+                                 ' --dest-docker-repo=%IMAGE%%IN_PROCESS_FLAG%'
         }
 
     def configure_argparse(self, parser: ArgumentParser):
@@ -183,6 +274,11 @@ class EachRelease(TaskInterface):
             action='store_true'
         )
         parser.add_argument('--version-template', required=True)
+        parser.add_argument('--in-process', action='store_true',
+                            help='Build all versions in this process instead of spawning nested rkd processes')
+        parser.add_argument('--ledger', default=os.getenv('RKT_BUILD_LEDGER', ''),
+                            help='SQLite build ledger written by :docker:push, asked before the registry ' +
+                                 'with --in-process (defaults to $RKT_BUILD_LEDGER)')
 
 
 class SpecificRelease(TaskInterface):
@@ -199,7 +295,10 @@ class SpecificRelease(TaskInterface):
             'DOCKER_BUILD_OPTS': None,
             'DEST_DOCKER_REPO': None,
             'DOCKERFILE': None,
-            'DIR': None
+            'DIR': None,
+            'CACHE_FROM': '',
+            'CACHE_MODE': 'inline',
+            'CACHE_DIR': ''
         }
 
     def execute(self, context: ExecutionContext) -> bool:
@@ -215,21 +314,112 @@ class SpecificRelease(TaskInterface):
         # complete docker image address with version
         tag = image + ':' + image_version
 
+        # recorded in the build ledger together with pushed tags
+        git_tag = ['--git-tag=%s' % app_version] if app_version else []
+
+        # tag and push through Docker Engine API, the build itself stays on the CLI (BuildKit, buildx cache options)
+        engine_api = ['--engine-api'] if context.args.get('engine_api') else []
+
+        cache = self._get_cache_opts(
+            cache_from=context.get_arg_or_env('--cache-from'),
+            cache_mode=context.get_arg_or_env('--cache-mode'),
+            cache_dir=context.get_arg_or_env('--cache-dir'),
+            image=image,
+            image_version=image_version
+        )
+
+        if not cache:
+            return False
+
+        build_cmd, cache_opts = cache
+
         # build & tag & publish
-        if not self.silent_sh(('docker build %s -f %s -t %s %s ' +
+        if not self.silent_sh(('%s %s -f %s -t %s %s %s ' +
                                '--build-arg RKT_APP_VERSION="%s" --build-arg RKT_IMG_VERSION=%s') %
-                              (work_dir, dockerfile_path, tag, opts, app_version, image_version),
+                              (build_cmd, work_dir, dockerfile_path, tag, opts, cache_opts, app_version,
+                               image_version),
                               verbose=True):
             self.io().error('Cannot build docker image')
             return False
 
-        self.rkd([':docker:tag', '--image=%s' % tag, '--propagate', '-rl=debug'], verbose=True)
+        if context.args['in_process']:
+            if not TaskTools.execute_in_process(self, TagImageTask(), ['--image=%s' % tag, '--propagate'] + engine_api,
+                                                context.env):
+                return False
+
+            if push:
+                return TaskTools.execute_in_process(self, PushTask(),
+                                                    ['--image=%s' % tag, '--propagate'] + git_tag + engine_api,
+                                                    context.env)
+
+            return True
+
+        self.rkd([':docker:tag', '--image=%s' % tag, '--propagate', '-rl=debug'] + engine_api, verbose=True)
 
         if push:
-            self.rkd([':docker:push', '--image=%s' % tag, '--propagate', '-rl=debug'], verbose=True)
+            self.rkd([':docker:push', '--image=%s' % tag, '--propagate', '-rl=debug'] + git_tag + engine_api,
+                     verbose=True)
 
         return True
 
+    def _get_cache_opts(self, cache_from: str, cache_mode: str, cache_dir: str, image: str,
+                        image_version: str) -> Union[Tuple[str, str], None]:
+        """Layer cache - reuse layers of an already pushed release, when building on a fresh machine
+
+        Modes:
+            inline: BuildKit reads the cache embedded in the --cache-from image, and embeds it in the built image
+            local: "docker buildx" imports and exports the cache from/to a local directory (--cache-dir)
+            classic: Legacy builder, the --cache-from image is pulled first
+
+        :return: Tuple of build command and options, None on invalid options
+        """
+
+        if cache_mode == 'local':
+            if not cache_dir:
+                self.io().error_msg('--cache-dir is required for "local" cache mode')
+                return None
+
+            return 'docker buildx build --load', ('--cache-from type=local,src=%s ' +
+                                                  '--cache-to type=local,dest=%s,mode=max') % (cache_dir, cache_dir)
+
+        if cache_from == 'auto':
+            cache_from = self.find_cache_image(image, image_version)
+
+            if not cache_from:
+                self.io().warn('No already pushed tag found to use as a layer cache')
+
+        if not cache_from:
+            return 'docker build', ''
+
+        self.io().info('Using "%s" as a layer cache' % cache_from)
+
+        if cache_mode == 'classic':
+            self.silent_sh('docker pull %s' % cache_from)
+            return 'docker build', '--cache-from %s' % cache_from
+
+        return 'DOCKER_BUILDKIT=1 docker build', '--cache-from %s --build-arg BUILDKIT_INLINE_CACHE=1' % cache_from
+
+    def find_cache_image(self, image: str, image_version: str) -> Union[str, None]:
+        """ Find an already pushed tag that is the closest previous version of the one being built """
+
+        reference = parse_image(image + ':' + image_version)
+
+        try:
+            tags = RegistryClient(reference.registry).list_tags(reference.repository)
+        except (RegistryException, OSError) as e:
+            self.io().warn('Cannot list tags of "%s": %s' % (image, str(e)))
+            return None
+
+        candidates = [tag for tag in tags if tag != image_version]
+
+        if not candidates:
+            return None
+
+        ordered = natural_sort(candidates + [image_version])
+        position = ordered.index(image_version)
+
+        return image + ':' + (ordered[position - 1] if position > 0 else ordered[position + 1])
+
     def _parse_opts(self, template: str, app_version: str) -> str:
         """Templating - allows to append additional information to build args of the Docker image
 
@@ -239,19 +429,29 @@ class SpecificRelease(TaskInterface):
             The algorithm is in :github:find-closest-release task and is always reproducible.
         """
 
-        if '%FIND_CLOSEST_RELEASE' in template:
-            all_matches = re.findall('%FIND_CLOSEST_RELEASE\((.*)\)%', template)
+        repositories = sorted(set(re.findall('%FIND_CLOSEST_RELEASE\\((.*?)\\)%', template)))
+
+        if repositories:
+            finder = FindClosestReleaseTask()
+            self.copy_internal_dependencies(finder)
+
+            # with a token all repositories are fetched in one GraphQL query, else distinct repositories
+            # are fetched concurrently. Tag lists are cached for the whole process
+            finder.prefetch_tags(repositories, sleep_time=5, retries=5)
+
+            with ThreadPoolExecutor(max_workers=min(len(repositories), 8)) as pool:
+                resolved = dict(zip(repositories, pool.map(
+                    lambda repository: finder.find_closest_version(
+                        version=app_version,
+                        repository=repository,
+                        sleep_time=5,
+                        retries=5
+                    ),
+                    repositories
+                )))
 
-            for match in all_matches:
-                template = template.replace(
-                    '%%FIND_CLOSEST_RELEASE(%s)%%' % match,
-                    self.sh(' '.join([
-                        'rkd', '--silent',
-                        ':github:find-closest-release',
-                        '--repository=%s' % match,
-                        '--compare-with=%s' % app_version
-                    ]), capture=True).strip()
-                )
+            for repository, version in resolved.items():
+                template = template.replace('%%FIND_CLOSEST_RELEASE(%s)%%' % repository, version)
 
         return template
 
@@ -264,6 +464,222 @@ class SpecificRelease(TaskInterface):
         parser.add_argument('--docker-build-opts', '-o', default=None,
                             help='Docker build opts eg. --build-arg SOME=THING')
         parser.add_argument('--no-push', help='Don\'t push to docker registry', action='store_true')
+        parser.add_argument('--in-process', action='store_true',
+                            help='Tag and push in this process instead of spawning nested rkd processes')
+        parser.add_argument('--cache-from', default='',
+                            help='Image to use as a layer cache, or "auto" to use closest already pushed tag ' +
+                                 'of --dest-docker-repo')
+        parser.add_argument('--cache-mode', default='inline', choices=['inline', 'local', 'classic'],
+                            help='Layer cache mode: inline (BuildKit), local (buildx, requires --cache-dir), classic')
+        parser.add_argument('--cache-dir', default='', help='Directory for the "local" cache mode')
+        parser.add_argument('--engine-api', action='store_true',
+                            help='Tag and push through Docker Engine API (UNIX socket) instead of docker CLI processes')
+
+
+class BuildGraph(TaskInterface):
+    """ Builds images of one repository in order of their FROM and COPY --from references, in parallel """
+
+    _output_lock = threading.Lock()
+
+    def get_name(self) -> str:
+        return ':build-graph'
+
+    def get_group_name(self) -> str:
+        return ':boat-ci'
+
+    def execute(self, context: ExecutionContext) -> bool:
+        images = dict(context.args['image'])
+        workers = int(context.args['workers'])
+        version = context.args['docker_version']
+
+        try:
+            graph = self.create_graph(images)
+            levels = self.get_levels(graph)
+
+        except (DockerfileSyntaxError, GraphException, OSError) as e:
+            self.io().error_msg(str(e))
+            return False
+
+        commands = {image: self.render_command(context.args['exec'], image, dockerfile, version)
+                    for image, dockerfile in images.items()}
+
+        self.io().h1('Build graph')
+        self.io().outln(self.table(
+            ['Stage', 'Image', 'Depends on', 'Command'],
+            [[str(number + 1), image, ', '.join(sorted(graph[image])), commands[image]]
+             for number, level in enumerate(levels) for image in level]
+        ))
+
+        if context.args['dry_run']:
+            return True
+
+        results = self.build_graph(graph, lambda image: self.run_prefixed(image, commands[image]), workers)
+
+        for image in [image for level in levels for image in level]:
+            if results[image] == 'built':
+                self.io().success_msg('[%s] Built' % image)
+            elif results[image] == 'failed':
+                self.io().error_msg('[%s] Failed' % image)
+            else:
+                self.io().warn('[%s] Skipped, as a dependency failed' % image)
+
+        return all([result == 'built' for result in results.values()])
+
+    @staticmethod
+    def render_command(template: str, image: str, dockerfile_path: str, version: str) -> str:
+        return template.replace('%IMAGE%', image)\
+            .replace('%DOCKERFILE%', dockerfile_path)\
+            .replace('%DIR%', os.path.dirname(dockerfile_path) or '.')\
+            .replace('%VERSION%', version)
+
+    @staticmethod
+    def create_graph(images: Dict[str, str]) -> Dict[str, Set[str]]:
+        """
+        Map of image -> images it depends on, considering only images built by the graph.
+        A reference matches an image by registry and repository, tag is not considered
+        """
+
+        by_name = {}
+
+        for image in images.keys():
+            reference = parse_image(image.split('@')[0])
+            by_name[(reference.registry, reference.repository)] = image
+
+        graph = {}
+
+        for image, dockerfile_path in images.items():
+            with open(dockerfile_path, 'r', encoding='utf-8') as f:
+                references = find_image_references(f)
+
+            graph[image] = set()
+
+            for referenced in references:
+                reference = parse_image(referenced.split('@')[0])
+                dependency = by_name.get((reference.registry, reference.repository))
+
+                if dependency and dependency != image:
+                    graph[image].add(dependency)
+
+        return graph
+
+    @staticmethod
+    def get_levels(graph: Dict[str, Set[str]]) -> List[List[str]]:
+        """ Images grouped by stages, each stage depends only on previous stages (Kahn's algorithm) """
+
+        remaining = {image: set(dependencies) for image, dependencies in graph.items()}
+        levels = []
+
+        while remaining:
+            level = sorted([image for image, dependencies in remaining.items() if not dependencies])
+
+            if not level:
+                raise GraphException('Circular dependency between images: %s' % ', '.join(sorted(remaining.keys())))
+
+            for image in level:
+                del remaining[image]
+
+            for dependencies in remaining.values():
+                dependencies.difference_update(level)
+
+            levels.append(level)
+
+        return levels
+
+    def build_graph(self, graph: Dict[str, Set[str]], build: Callable[[str], bool],
+                    workers: int) -> Dict[str, str]:
+        """
+        Starts each build as soon as all its dependencies are built, up to "workers" builds at once.
+        When a build fails, builds depending on it (also indirectly) are skipped, other branches continue
+
+        :return: image -> "built", "failed" or "skipped"
+        """
+
+        dependents = {image: set() for image in graph}
+
+        for image, dependencies in graph.items():
+            for dependency in dependencies:
+                dependents[dependency].add(image)
+
+        waiting_for = {image: len(dependencies) for image, dependencies in graph.items()}
+        results = {}
+        running = {}
+
+        def skip(image: str):
+            for dependent in dependents[image]:
+                if dependent not in results:
+                    results[dependent] = 'skipped'
+                    skip(dependent)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            ready = sorted([image for image, count in waiting_for.items() if count == 0])
+
+            while ready or running:
+                for image in ready:
+                    self.io().info('Starting build of %s' % image)
+                    running[pool.submit(build, image)] = image
+
+                ready = []
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    image = running.pop(future)
+
+                    try:
+                        succeeded = future.result()
+                    except Exception as e:
+                        self.io().error_msg('[%s] %s' % (image, str(e)))
+                        succeeded = False
+
+                    if not succeeded:
+                        results[image] = 'failed'
+                        skip(image)
+                        continue
+
+                    results[image] = 'built'
+
+                    for dependent in sorted(dependents[image]):
+                        waiting_for[dependent] -= 1
+
+                        if waiting_for[dependent] == 0 and dependent not in results:
+                            ready.append(dependent)
+
+        return results
+
+    def run_prefixed(self, image: str, command: str) -> bool:
+        """ Runs a build command, each output line is prefixed with the image name """
+
+        process = subprocess.Popen(['bash', '-c', 'set -euo pipefail; ' + command],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        for line in iter(process.stdout.readline, b''):
+            with self._output_lock:
+                self.io().outln('[%s] %s' % (image, line.decode('utf-8', errors='replace').rstrip()))
+
+        return process.wait() == 0
+
+    def configure_argparse(self, parser: ArgumentParser):
+        parser.add_argument('--image', '-i', nargs=2, action='append', required=True,
+                            metavar=('IMAGE', 'DOCKERFILE'),
+                            help='Image to build and its Dockerfile eg. quay.io/riotkit/php ./php/Dockerfile' +
+                                 ', can be repeated')
+        parser.add_argument('--docker-version', '-v', default='latest', help='Version of images (image tag)')
+        parser.add_argument('--exec', '-e', default='rkd :boat-ci:specific-release --dockerfile="%DOCKERFILE%" ' +
+                                                    '--dir="%DIR%" --dest-docker-repo="%IMAGE%" ' +
+                                                    '--docker-version="%VERSION%"',
+                            help='Build command, supports %%IMAGE%%, %%DOCKERFILE%%, %%DIR%%, %%VERSION%%')
+        parser.add_argument('--workers', '-w', default='2', help='Number of builds running at once')
+        parser.add_argument('--dry-run', action='store_true', help='Only print the build order')
+
+
+def get_in_process_tasks() -> Dict[str, Callable]:
+    """ Tasks that BoatCI is able to execute in-process, without spawning a new rkd """
+
+    return {
+        ':boat-ci:each-release': EachRelease,
+        ':boat-ci:specific-release': SpecificRelease,
+        ':docker:tag': TagImageTask,
+        ':docker:push': PushTask
+    }
 
 
 def imports():
@@ -271,6 +687,7 @@ def imports():
         TaskDeclaration(EachRelease()),
         TaskDeclaration(ProcessRequestTask()),
         TaskDeclaration(SpecificRelease()),
+        TaskDeclaration(BuildGraph()),
 
         # dependencies
         TaskDeclaration(ForEachGithubReleaseTask()),
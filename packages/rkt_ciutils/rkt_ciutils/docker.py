@@ -2,48 +2,67 @@
 import os
 import json
 import shlex
-from jinja2 import Template
-from typing import List, Dict
+import requests
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from typing import List, Dict, Tuple, Union, Iterable
+from concurrent.futures import ProcessPoolExecutor
 from argparse import ArgumentParser
 from rkd.api.contract import TaskInterface, ExecutionContext
 from rkd.api.syntax import TaskDeclaration
-from rkd.standardlib.shell import BaseShellCommandWithArgumentParsingTask
+from rkt_utils.registry import RegistryClient, RegistryException, parse_image
+from .dockerfile import tokenize_dockerfile, parse_key_values, find_dockerfiles, ExtractionCache, DockerfileSyntaxError
 from collections import namedtuple
 
 
 EnvironmentVariable = namedtuple('EnvironmentVariable', 'name value comment')
 
 
-class DockerTagExistsTask(BaseShellCommandWithArgumentParsingTask):
+class DockerTagExistsTask(TaskInterface):
     """ Check if a docker tag exists """
 
-    def __init__(self):
-        super().__init__(
-            name=':tag-exists',
-            group=':docker',
-            description='',
-            arguments_definition=None,
-            command='''
-                image_full_name="$ARG_IMAGE";
-                wait_time="${ARG_WAIT_TIME:-10}"
-                search_term='Pulling|is up to date|not found'
-                
-                result="$((timeout --preserve-status "$wait_time" docker 2>&1 pull "$image_full_name" &) | grep -v 'Pulling repository' | egrep -o "$search_term")"
-                test "$result" || { echo "Timed out too soon. Try using a wait_time greater than $wait_time..."; return 1 ;}
-                
-                if echo $result | grep -vq 'not found'; then
-                    echo "Image found."
-                    exit 0
-                else
-                    echo "Image not found"
-                    exit 1
-                fi
-            '''
-        )
+    _clients = {}  # type: Dict[Tuple[str, int], RegistryClient]
+
+    def get_name(self) -> str:
+        return ':tag-exists'
+
+    def get_group_name(self) -> str:
+        return ':docker'
+
+    def execute(self, context: ExecutionContext) -> bool:
+        try:
+            exists = self.tag_exists(context.args['image'], timeout=int(context.args['wait_time']))
+
+        except (RegistryException, requests.RequestException) as e:
+            self.io().error_msg('Cannot check "%s": %s' % (context.args['image'], str(e)))
+            return False
+
+        self.io().outln('Image found.' if exists else 'Image not found')
+
+        return exists
+
+    @classmethod
+    def tag_exists(cls, image: str, timeout: int = 10) -> bool:
+        """
+        Asks the registry if the manifest exists (HEAD request), nothing is pulled.
+        Clients are kept per registry, so auth tokens and connections are reused between checks
+        """
+
+        reference = parse_image(image)
+
+        return cls.get_client(reference.registry, timeout).manifest_exists(reference.repository, reference.tag)
+
+    @classmethod
+    def get_client(cls, registry: str, timeout: int = 10) -> RegistryClient:
+        key = (registry, timeout)
+
+        if key not in cls._clients:
+            cls._clients[key] = RegistryClient(registry, timeout=timeout)
+
+        return cls._clients[key]
 
     def configure_argparse(self, parser: ArgumentParser):
         parser.add_argument('--image', '-i', required=True, help='Image name')
-        parser.add_argument('--wait-time', '-w', default='10', help='Time to wait after which to interrupt the pulling')
+        parser.add_argument('--wait-time', '-w', default='10', help='Timeout in seconds of a request to the registry')
 
 
 class ExtractEnvsFromDockerfileTask(TaskInterface):
@@ -58,108 +77,157 @@ class ExtractEnvsFromDockerfileTask(TaskInterface):
     def execute(self, context: ExecutionContext) -> bool:
         out_format = context.args['format']
         file_path = context.args['file']
+        patterns = context.args.get('path') or []
+        instruction = context.args.get('instruction') or 'ENV'
+
+        if bool(file_path) == bool(patterns):
+            self._io.error_msg('Specify either --file or --path')
+            return False
+
+        if patterns and out_format not in ['json', 'bash_source']:
+            self._io.error_msg('Format "%s" is not supported with --path, use json or bash_source' % out_format)
+            return False
+
+        try:
+            if patterns:
+                self._io.out(self.extract_bulk(
+                    out_format, patterns, instruction,
+                    workers=int(context.args['workers']) if context.args.get('workers') else None,
+                    cache_path=None if context.args.get('no_cache') else context.args.get('cache')
+                ))
+            else:
+                self._io.out(self.extract(out_format, file_path, instruction))
+
+        except DockerfileSyntaxError as e:
+            self._io.error_msg(str(e))
+            return False
 
-        self._io.out(self.extract(out_format, file_path))
         return True
 
-    def extract(self, out_format: str, file_path: str) -> str:
-        if not os.path.isfile(file_path):
-            raise Exception('Cannot find Dockerfile at path "%s"' % file_path)
+    def extract_bulk(self, out_format: str, patterns: List[str], instruction: str = 'ENV',
+                     workers: int = None, cache_path: str = None) -> str:
+        """ One JSON document with variables of all matched Dockerfiles: {"path": {"NAME": [name, value, comment]}} """
 
-        with open(file_path, 'rb') as f:
-            content = f.read().decode('utf-8')
+        paths = list(dict.fromkeys([path for pattern in patterns for path in find_dockerfiles(pattern)]))
 
-        out_vars = self.get_envs(content)
+        out_vars = self.get_envs_many(paths, instruction, workers, ExtractionCache(cache_path) if cache_path else None)
 
         if out_format == 'bash_source':
             return 'export DOCKERFILE_ENVS=%s' % shlex.quote(json.dumps(out_vars))
         elif out_format == 'json':
             return json.dumps(out_vars, indent=2, sort_keys=True)
-        else:
-            buf = ''
 
-            for name, out_var in out_vars.items():
-                buf += "export %s=%s\n" % (out_var.name, out_var.value)
+        raise Exception('Format "%s" is not supported for multiple Dockerfiles, use json or bash_source' % out_format)
 
-            return buf
+    def get_envs_many(self, paths: List[str], instruction: str = 'ENV', workers: int = None,
+                      cache: ExtractionCache = None) -> Dict[str, Dict[str, EnvironmentVariable]]:
+        """
+        Parses Dockerfiles in a process pool. Files unchanged since the last run (same mtime and size)
+        are taken from the cache without reading them
+        """
 
-    def configure_argparse(self, parser: ArgumentParser):
-        parser.add_argument('--file', '-f', required=True, help='Path to Dockerfile to read as input')
-        parser.add_argument('--format', default='json', help='Output format, one of: json, bash_source, env')
+        results = {}
+        missing = []
 
-    def get_envs(self, content: str):
-        by_lines = content.split("\n")
-        normalized_lines = list(map(lambda curr: curr.strip(), by_lines))
-        pos = -1
-        matched_lines = {}
+        for path in paths:
+            cached = cache.get(path, instruction) if cache else None
 
-        for line in normalized_lines:
-            pos += 1
+            if cached is None:
+                missing.append(path)
+                continue
 
-            # each block that starts with "ENV" can be multi-line, so it will be extracted multi-line
-            if line.upper().startswith('ENV'):
-                matched_lines = {**matched_lines, **self._parse_lines(self._extract_block(pos, normalized_lines))}
+            results[path] = {name: EnvironmentVariable(*env) for name, env in cached.items()}
 
-        return matched_lines
+        self.io().debug('%i Dockerfiles taken from cache, %i to parse' % (len(results), len(missing)))
 
-    def _parse_lines(self, lines: List[str]) -> Dict[str, EnvironmentVariable]:
-        parsed = {}
-        comment_buffer = ''
+        if len(missing) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed = list(pool.map(_extract_file, missing, [instruction] * len(missing), chunksize=8))
+        else:
+            parsed = [_extract_file(path, instruction) for path in missing]
 
-        for line in lines:
-            # if that's a comment or a comment continuation, then collect into the buffer
-            if line.startswith('#'):
-                comment_buffer += line.lstrip('# ') + "\n"
-            else:
-                # if the comment block ended, or it is not a comment block
-                if line.startswith('ENV'):
-                    line = line[3:].strip()
+        for path, stat, envs in parsed:
+            results[path] = envs
 
-                sep = line.split('=', maxsplit=1)
+            if cache:
+                cache.store(path, instruction, stat, envs)
 
-                # potential syntax error
-                if len(sep) < 2:
-                    self._io.warn('!!! Cannot parse block in line "%s"' % line)
-                    continue
+        if cache:
+            cache.save()
 
-                parsed[sep[0].strip()] = EnvironmentVariable(
-                    name=sep[0].strip(),
-                    value=sep[1].strip(),
-                    comment=comment_buffer.strip()
-                )
-                comment_buffer = ''
+        return results
 
-        return parsed
+    def extract(self, out_format: str, file_path: str, instruction: str = 'ENV') -> str:
+        if not os.path.isfile(file_path):
+            raise Exception('Cannot find Dockerfile at path "%s"' % file_path)
 
-    @staticmethod
-    def _extract_block(start_pos: int, lines: List[str]) -> list:
-        extracted = []
-        pos = start_pos
-        length = len(lines)
+        with open(file_path, 'r', encoding='utf-8') as f:
+            out_vars = self.get_envs(f, instruction)
 
-        extracted.append(lines[start_pos].rstrip('\\'))
+        if out_format == 'bash_source':
+            return 'export DOCKERFILE_ENVS=%s' % shlex.quote(json.dumps(out_vars))
+        elif out_format == 'json':
+            return json.dumps(out_vars, indent=2, sort_keys=True)
+        else:
+            buf = ''
 
-        while True:
-            pos += 1
+            for name, out_var in out_vars.items():
+                buf += "export %s=%s\n" % (out_var.name, shlex.quote(out_var.value or ''))
 
-            if pos > length:
-                break
+            return buf
 
-            line = lines[pos]
+    def configure_argparse(self, parser: ArgumentParser):
+        parser.add_argument('--file', '-f', required=False, default='', help='Path to Dockerfile to read as input')
+        parser.add_argument('--path', '-p', nargs='+', default=[],
+                            help='Directories or glob patterns (eg. "images/**/Dockerfile") to read many Dockerfiles' +
+                                 ' at once, results are combined into one JSON document')
+        parser.add_argument('--workers', '-w', default='',
+                            help='Number of processes parsing Dockerfiles with --path (default: number of CPUs)')
+        parser.add_argument('--cache', default=os.getenv('RKT_DOCKERFILE_CACHE',
+                                                         '~/.cache/rkt_ciutils/dockerfile-envs.json'),
+                            help='File keeping results between runs with --path, unchanged Dockerfiles' +
+                                 ' are not parsed again')
+        parser.add_argument('--no-cache', action='store_true', help='Do not use the cache with --path')
+        parser.add_argument('--format', default='json', help='Output format, one of: json, bash_source, env')
+        parser.add_argument('--instruction', default='ENV', choices=['ENV', 'ARG', 'LABEL'],
+                            help='Instruction to extract variables from (default: ENV)')
 
-            if line.endswith('\\') or line.startswith('#'):
-                extracted.append(line.rstrip('\\'))
+    @staticmethod
+    def get_envs(content: Union[str, Iterable[str]], instruction: str = 'ENV') -> Dict[str, EnvironmentVariable]:
+        """
+        Collects variables defined by ENV (or ARG, LABEL) in one pass over the Dockerfile.
+        Accepts whole content or any iterable of lines (eg. an open file). Later definitions override earlier
+        """
+
+        if isinstance(content, str):
+            content = content.splitlines()
+
+        envs = {}
+
+        for parsed in tokenize_dockerfile(content):
+            if parsed.name != instruction:
                 continue
-            else:
-                extracted.append(line)
-                break
 
-        return extracted
+            for pair in parse_key_values(parsed):
+                envs[pair.name] = EnvironmentVariable(name=pair.name, value=pair.value, comment=pair.comment)
+
+        return envs
+
+
+def _extract_file(path: str, instruction: str) -> tuple:
+    """ Runs in a worker process """
+
+    stat = ExtractionCache.stat(path)
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return path, stat, ExtractEnvsFromDockerfileTask.get_envs(f, instruction)
 
 
 class GenerateReadmeTask(TaskInterface):
     """ Generate README.md.j2 into README.md considering env variables from Dockerfile """
 
+    _environments = {}  # type: Dict[Tuple[str, str], Environment]
+
     def get_name(self) -> str:
         return ':generate-readme'
 
@@ -170,41 +238,114 @@ class GenerateReadmeTask(TaskInterface):
         readme_path = context.args['target_path']
         readme_template_path = context.args['template']
         dockerfile_path = context.args['dockerfile']
+        batch = context.args.get('render') or []
+        cache_dir = None if context.args.get('no_bytecode_cache') else context.args.get('bytecode_cache_dir')
 
-        if not os.path.isfile(readme_template_path):
-            self._io.error_msg('Path to template is not valid')
+        if batch and (readme_template_path or dockerfile_path):
+            self._io.error_msg('--render cannot be mixed with --template and --dockerfile')
             return False
 
-        if not os.path.isfile(dockerfile_path):
-            self._io.error_msg('Path to Dockerfile is not valid')
-            return False
+        if not batch:
+            if not readme_template_path or not dockerfile_path:
+                self._io.error_msg('--template and --dockerfile are required')
+                return False
 
-        variables = self.extract_envs_from_dockerfile(dockerfile_path)
+            batch = [(readme_template_path, dockerfile_path, readme_path)]
 
-        with open(readme_template_path, 'rb') as f:
-            rendered = Template(f.read().decode('utf-8')).render({'DOCKERFILE_ENVS': variables})
+        for template_path, dockerfile_path, _ in batch:
+            if not os.path.isfile(template_path):
+                self._io.error_msg('Path to template is not valid: %s' % template_path)
+                return False
 
-            if readme_path:
-                with open(readme_path, 'w') as rw:
-                    rw.write(rendered)
-            else:
+            if not os.path.isfile(dockerfile_path):
+                self._io.error_msg('Path to Dockerfile is not valid: %s' % dockerfile_path)
+                return False
+
+        # one Dockerfile can be documented by many templates, it is parsed once
+        variables = {}
+
+        for template_path, dockerfile_path, target_path in batch:
+            if dockerfile_path not in variables:
+                variables[dockerfile_path] = self.extract_envs_from_dockerfile(dockerfile_path)
+
+            rendered = self.render(template_path, variables[dockerfile_path], cache_dir)
+
+            if not target_path:
                 self._io.out(rendered)
+                continue
+
+            if self.write_if_changed(target_path, rendered):
+                self._io.info_msg('Written %s' % target_path)
+            else:
+                self._io.debug('Not changed: %s' % target_path)
 
         return True
 
-    def extract_envs_from_dockerfile(self, dockerfile_path: str):
-        """ Extracts environment variables list, values and descriptions from the Dockerfile """
+    def render(self, template_path: str, variables: Dict[str, EnvironmentVariable], cache_dir: str = None) -> str:
+        directory, name = os.path.split(os.path.abspath(template_path))
+
+        return self.get_environment(directory, cache_dir).get_template(name).render({'DOCKERFILE_ENVS': variables})
+
+    @classmethod
+    def get_environment(cls, directory: str, cache_dir: str = None) -> Environment:
+        """
+        Environments are kept per templates directory, so compiled templates are reused in the process.
+        With a cache_dir the compiled bytecode is kept on disk between runs (invalidated on template change)
+        """
+
+        key = (directory, cache_dir)
+
+        if key not in cls._environments:
+            bytecode_cache = None
+
+            if cache_dir:
+                cache_dir = os.path.expanduser(cache_dir)
+                os.makedirs(cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+            cls._environments[key] = Environment(loader=FileSystemLoader(directory), bytecode_cache=bytecode_cache)
+
+        return cls._environments[key]
+
+    @staticmethod
+    def write_if_changed(path: str, content: str) -> bool:
+        """ Writes only when content differs, so modification time is kept for unchanged files """
+
+        encoded = content.encode('utf-8')
+
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == encoded:
+                    return False
+        except OSError:
+            pass
+
+        with open(path, 'wb') as f:
+            f.write(encoded)
+
+        return True
+
+    @staticmethod
+    def extract_envs_from_dockerfile(dockerfile_path: str) -> Dict[str, EnvironmentVariable]:
+        """ Extracts environment variables list, values and descriptions from the Dockerfile, sorted by name """
 
-        task = ExtractEnvsFromDockerfileTask()
-        self.copy_internal_dependencies(task)
-        return json.loads(task.extract('json', dockerfile_path))
+        with open(dockerfile_path, 'r', encoding='utf-8') as f:
+            return dict(sorted(ExtractEnvsFromDockerfileTask.get_envs(f).items()))
 
     def configure_argparse(self, parser: ArgumentParser):
-        parser.add_argument('--template', '-rt', required=True,
+        parser.add_argument('--template', '-rt', required=False, default='',
                             help='Readme template path (in Jinja2 format)')
         parser.add_argument('--target-path', '-t', required=False, default='',
                             help='Path where to write the README. If not specified, then stdout will be preferred')
-        parser.add_argument('--dockerfile', '-f', required=True, help='Path to the Dockerfile to parse')
+        parser.add_argument('--dockerfile', '-f', required=False, default='', help='Path to the Dockerfile to parse')
+        parser.add_argument('--render', '-r', nargs=3, action='append', default=[],
+                            metavar=('TEMPLATE', 'DOCKERFILE', 'TARGET'),
+                            help='Render many READMEs in one run, can be repeated. Replaces --template, --dockerfile' +
+                                 ' and --target-path')
+        parser.add_argument('--bytecode-cache-dir', default=os.getenv('RKT_JINJA_CACHE_DIR',
+                                                                      '~/.cache/rkt_ciutils/jinja'),
+                            help='Directory to keep compiled templates between runs')
+        parser.add_argument('--no-bytecode-cache', action='store_true', help='Do not keep compiled templates on disk')
 
 
 def imports():
@@ -0,0 +1,402 @@
+import os
+import re
+import glob
+import json
+from collections import namedtuple
+from typing import Iterable, Iterator, List, Tuple, Union
+
+Instruction = namedtuple('Instruction', 'name arguments comment line segments heredocs escape')
+"""
+name: Upper-cased instruction name eg. ENV
+arguments: Logical line without the instruction name, continuations joined
+comment: Comment lines directly preceding the instruction
+line: Line number where the instruction starts (counted from 1)
+segments: List of (offset in arguments, comment) - a comment found before each continuation line
+heredocs: List of heredoc bodies, in order of appearance
+escape: Escape character set by the parser directive
+"""
+
+KeyValue = namedtuple('KeyValue', 'name value comment')
+
+DIRECTIVE_PATTERN = re.compile(r'^#\s*([a-zA-Z][a-zA-Z0-9]*)\s*=\s*(.+?)\s*$')
+# like BuildKit: only at the start of a word, optionally after a fd number, "<<<" is a here-string
+HEREDOC_PATTERN = re.compile(r'(?:^|\s)\d*<<(?!<)(-?)(["\']?)([a-zA-Z_][a-zA-Z0-9_]*)\2')
+HEREDOC_INSTRUCTIONS = ['RUN', 'COPY', 'ADD']
+
+
+class DockerfileSyntaxError(Exception):
+    pass
+
+
+def find_image_references(lines: Iterable[str]) -> List[str]:
+    """
+    Images a Dockerfile is built from: FROM and COPY --from, without stages defined in the same Dockerfile
+
+    ARG defaults declared before the first FROM are substituted eg. FROM ${BASE_IMAGE}
+    """
+
+    global_args = {}
+    stages = []
+    images = []
+
+    def substitute(value: str) -> str:
+        return re.sub(r'\$\{?([a-zA-Z_][a-zA-Z0-9_]*)\}?', lambda match: global_args.get(match.group(1), ''), value)
+
+    def add(image: str):
+        image = substitute(image)
+
+        if image and image not in stages and image not in images and not image.isdigit() and image != 'scratch':
+            images.append(image)
+
+    for instruction in tokenize_dockerfile(lines):
+        if instruction.name == 'ARG' and not stages:
+            for pair in parse_key_values(instruction):
+                global_args[pair.name] = pair.value or ''
+
+        elif instruction.name == 'FROM':
+            words = [word for word in instruction.arguments.split() if not word.startswith('--')]
+
+            if not words:
+                raise DockerfileSyntaxError('FROM without an image in line %i' % instruction.line)
+
+            add(words[0])
+
+            if len(words) >= 3 and words[1].upper() == 'AS':
+                stages.append(words[2])
+
+        elif instruction.name == 'COPY':
+            for word in instruction.arguments.split():
+                if word.startswith('--from='):
+                    add(word[len('--from='):])
+
+    return images
+
+
+def find_dockerfiles(pattern: str) -> List[str]:
+    """
+    Dockerfiles under a directory (Dockerfile, Dockerfile.*, *.Dockerfile, searched recursively)
+    or files matching a glob pattern (** is supported)
+    """
+
+    if os.path.isdir(pattern):
+        found = []
+
+        for root, dirs, files in os.walk(pattern):
+            dirs[:] = sorted([name for name in dirs if not name.startswith('.')])
+
+            found += [os.path.join(root, name) for name in sorted(files)
+                      if name == 'Dockerfile' or name.startswith('Dockerfile.') or name.endswith('.Dockerfile')]
+
+        return found
+
+    return sorted([path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)])
+
+
+class ExtractionCache(object):
+    """
+    Results of parsed Dockerfiles kept between runs in a JSON file
+
+    An entry is valid as long as the file has the same modification time and size, so unchanged files
+    are not read at all.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self._changed = False
+
+        try:
+            with open(self.path, 'rb') as f:
+                self._entries = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, path: str, instruction: str) -> Union[dict, None]:
+        entry = self._entries.get(self._key(path, instruction))
+
+        if entry and entry['stat'] == self.stat(path):
+            return entry['result']
+
+        return None
+
+    def store(self, path: str, instruction: str, stat: list, result: dict):
+        self._entries[self._key(path, instruction)] = {'stat': stat, 'result': result}
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(json.dumps(self._entries).encode('utf-8'))
+
+        os.replace(self.path + '.tmp', self.path)
+        self._changed = False
+
+    @staticmethod
+    def _key(path: str, instruction: str) -> str:
+        return '%s:%s' % (instruction, os.path.abspath(path))
+
+    @staticmethod
+    def stat(path: str) -> list:
+        """ Modification time and size, taken before the file is read """
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return []
+
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+def tokenize_dockerfile(lines: Iterable[str]) -> Iterator[Instruction]:
+    """
+    Single-pass Dockerfile tokenizer, reads lines one by one and yields logical instructions
+
+    Handles parser directives (escape), comments (also between continuation lines), line continuations,
+    and heredocs (RUN <<EOF ... EOF), so lines inside a heredoc are never taken as instructions.
+    """
+
+    escape = '\\'
+    directives_allowed = True
+    comments = []
+    lines = iter(lines)
+    line_number = 0
+
+    for raw_line in lines:
+        line_number += 1
+        line = raw_line.rstrip('\r\n')
+        stripped = line.strip()
+
+        if directives_allowed:
+            directive = DIRECTIVE_PATTERN.match(stripped)
+
+            if directive and directive.group(1).lower() == 'escape':
+                escape = directive.group(2)
+
+                if escape not in ['\\', '`']:
+                    raise DockerfileSyntaxError('Invalid escape character "%s" in line %i' % (escape, line_number))
+
+                continue
+
+            if not directive:
+                directives_allowed = False
+
+        if not stripped:
+            comments = []
+            continue
+
+        if stripped.startswith('#'):
+            comments.append(stripped.lstrip('# '))
+            continue
+
+        # logical line: join continuations, skipping comments and empty lines between them
+        start_line = line_number
+        name, first = (re.split(r'\s+', stripped, 1) + [''])[0:2]
+        parts = []
+        segments = [(0, '\n'.join(comments))]
+        segment_comments = []
+        offset = 0
+        current = first
+
+        while True:
+            continued = current.rstrip().endswith(escape)
+
+            if continued:
+                current = current.rstrip()[0:-1]
+
+            parts.append(current)
+            offset += len(current)
+
+            if not continued:
+                break
+
+            current = None
+
+            for raw_next in lines:
+                line_number += 1
+                next_line = raw_next.rstrip('\r\n')
+
+                if not next_line.strip():
+                    continue
+
+                if next_line.strip().startswith('#'):
+                    segment_comments.append(next_line.strip().lstrip('# '))
+                    continue
+
+                current = next_line
+                break
+
+            if current is None:
+                break
+
+            if segment_comments:
+                segments.append((offset, '\n'.join(segment_comments)))
+                segment_comments = []
+
+        arguments = ''.join(parts).strip()
+        heredocs = []
+
+        for match in HEREDOC_PATTERN.finditer(arguments) if name.upper() in HEREDOC_INSTRUCTIONS else []:
+            strip_tabs, terminator = match.group(1) == '-', match.group(3)
+            body = []
+
+            for raw_next in lines:
+                line_number += 1
+                next_line = raw_next.rstrip('\r\n')
+
+                if (next_line.lstrip('\t') if strip_tabs else next_line) == terminator:
+                    break
+
+                body.append(next_line.lstrip('\t') if strip_tabs else next_line)
+            else:
+                raise DockerfileSyntaxError('Unterminated heredoc "%s" starting in line %i' % (terminator, start_line))
+
+            heredocs.append('\n'.join(body) + '\n')
+
+        # offsets were counted on the non-stripped arguments
+        shift = len(''.join(parts)) - len(''.join(parts).lstrip())
+
+        yield Instruction(
+            name=name.upper(),
+            arguments=arguments,
+            comment='\n'.join(comments),
+            line=start_line,
+            segments=[(max(position - shift, 0), comment) for position, comment in segments],
+            heredocs=heredocs,
+            escape=escape
+        )
+
+        comments = []
+
+
+def parse_key_values(instruction: Instruction) -> List[KeyValue]:
+    """
+    Parse ENV, ARG and LABEL arguments
+
+    Forms:
+        ENV NAME value with spaces
+        ENV NAME=value NAME2="quoted value"
+        ARG NAME
+        ARG NAME=default
+        LABEL org.label-schema.name="Taiga" description='Project management'
+
+    A comment found before a line belongs to the first variable that starts in that line.
+    """
+
+    escape = instruction.escape
+    words = _split_words(instruction.arguments, escape)
+    segments = instruction.segments
+    cursor = [0]
+
+    def take_comment(position: int) -> str:
+        """ Comment of the line the word starts in, each comment is taken once (segments are ordered by offset) """
+
+        comment = ''
+
+        while cursor[0] < len(segments) and segments[cursor[0]][0] <= position:
+            comment = segments[cursor[0]][1]
+            cursor[0] += 1
+
+        return comment
+
+    if not words:
+        return []
+
+    # legacy form: ENV NAME value
+    if instruction.name == 'ENV' and '=' not in words[0][1]:
+        position, name = words[0]
+        value = instruction.arguments[position + len(name):].strip()
+
+        return [KeyValue(name=name, value=_unquote(value, escape), comment=take_comment(position))]
+
+    pairs = []
+
+    for position, word in words:
+        if '=' not in word:
+            if instruction.name != 'ARG':
+                raise DockerfileSyntaxError('Cannot parse "%s" in line %i, expected NAME=value' % (
+                    word, instruction.line))
+
+            pairs.append(KeyValue(name=word, value=None, comment=take_comment(position)))
+            continue
+
+        name, value = word.split('=', 1)
+        pairs.append(KeyValue(name=_unquote(name, escape), value=_unquote(value, escape),
+                              comment=take_comment(position)))
+
+    return pairs
+
+
+def _split_words(text: str, escape: str) -> List[Tuple[int, str]]:
+    """ Split on whitespace outside quotes, keeping quotes and escapes. Returns (position, raw word) """
+
+    words = []
+    position = 0
+    length = len(text)
+
+    while position < length:
+        if text[position].isspace():
+            position += 1
+            continue
+
+        end = _word_end(text, position, escape)
+        words.append((position, text[position:end]))
+        position = end
+
+    return words
+
+
+def _word_end(text: str, position: int, escape: str) -> int:
+    """ Scans a word in place, starting at position. Returns the index after the word """
+
+    quote = None
+    length = len(text)
+
+    while position < length:
+        char = text[position]
+
+        if char == escape and quote != "'":
+            position += 2
+            continue
+
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char.isspace():
+            break
+
+        position += 1
+
+    return min(position, length)
+
+
+def _unquote(word: str, escape: str) -> str:
+    """ Remove quotes and escape characters: "hello \\"world\\"" -> hello "world" """
+
+    result = []
+    quote = None
+    position = 0
+
+    while position < len(word):
+        char = word[position]
+
+        if char == escape and quote != "'" and position + 1 < len(word):
+            result.append(word[position + 1])
+            position += 2
+            continue
+
+        if quote and char == quote:
+            quote = None
+        elif not quote and char in '"\'':
+            quote = char
+        else:
+            result.append(char)
+
+        position += 1
+
+    return ''.join(result)
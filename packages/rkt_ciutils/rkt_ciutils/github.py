@@ -1,178 +1,855 @@
-from abc import ABC
-from typing import Union, Pattern, Match
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union, Pattern, Match
 
+import os
+import json
+import hashlib
 import requests
 import time
 import re
+import zlib
+import bisect
+import heapq
+import itertools
+import random
 import subprocess
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from rkd.api.contract import TaskInterface, ExecutionContext
+from rkt_utils.registry import RegistryException, parse_image
+from rkt_utils.ledger import BuildLedger
+from .tools import GitRepository, UnsupportedRepositoryLayout
+from .docker import DockerTagExistsTask
+
+PlannedRelease = namedtuple('PlannedRelease', 'git_tag release_tag command already_built')
+
+
+def natural_sort_key(key: str) -> list:
+    return [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', key)]
 
 
 def natural_sort(l):
-    convert = lambda text: int(text) if text.isdigit() else text.lower()
-    alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
+    return sorted(l, key=natural_sort_key)
+
+
+class VersionIndex(object):
+    """
+    Tags sorted once in natural order, answers "closest release to X" with a binary search
+
+    The closest release is the highest one lower than X, or the lowest one if X is lower than all releases.
+    """
+
+    def __init__(self, tags: List[str]):
+        self._tags = set(tags)
+        self._sorted = natural_sort(tags)
+        self._keys = [natural_sort_key(tag) for tag in self._sorted]
+
+    def find_closest(self, version: str) -> str:
+        if version in self._tags or not self._sorted:
+            return version
+
+        # tags with the same sort key as the version count as lower, like in a stable sort
+        position = bisect.bisect_right(self._keys, natural_sort_key(version))
+
+        return self._sorted[position - 1] if position > 0 else self._sorted[0]
+
+    def find_closest_many(self, versions: List[str]) -> Dict[str, str]:
+        return {version: self.find_closest(version) for version in versions}
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of GitHub API responses keyed by URL
+
+    Stored responses are revalidated with "If-None-Match", GitHub answers "304 Not Modified"
+    for unchanged resources, and such requests do not count into the rate limit.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.expanduser(directory)
+
+    def get(self, url: str) -> Union[dict, None]:
+        try:
+            with open(self._path(url), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url: str, etag: str, body: Union[list, dict], next_url: Union[str, None]):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(url)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps({'url': url, 'etag': etag, 'body': body, 'next': next_url}).encode('utf-8'))
+
+        os.replace(path + '.tmp', path)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+class GithubException(Exception):
+    pass
+
+
+TAGS_QUERY_PART = '''
+    %(alias)s: repository(owner: %(owner)s, name: %(name)s) {
+        refs(refPrefix: "refs/tags/", first: %(page_size)i, after: %(cursor)s,
+             orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) {
+            pageInfo { hasNextPage endCursor }
+            nodes { name }
+        }
+    }'''
+
+
+class GithubClient(object):
+    """
+    GitHub API client shared by all tasks in the process
+
+    Requests go through a pooled session and are scheduled by a token bucket filled from
+    the "X-RateLimit-Remaining" header and refilled at "X-RateLimit-Reset". A "Retry-After" blocks all requests
+    for the given time. Other failures (connection errors, HTTP 5xx) are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, token: str = None, session: requests.Session = None, pool_size: int = 10,
+                 max_backoff: int = 60, max_wait: int = 3600, graphql_url: str = 'https://api.github.com/graphql'):
+        self.session = session if session else requests.Session()
+        self.graphql_url = graphql_url
+        self.token = token
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._tokens = None  # type: Union[int, None]
+        self._refill_at = 0.0
+        self._blocked_until = 0.0
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+
+        if token:
+            self.session.headers['Authorization'] = 'token %s' % token
+
+    def get(self, url: str, headers: dict = None, retries: int = 5, backoff: float = 1) -> requests.Response:
+        """ GET with retries. The last response is returned even if it is an error, so the caller can report it """
+
+        return self.request('GET', url, headers=headers, retries=retries, backoff=backoff)
+
+    def graphql(self, query: str, retries: int = 5, backoff: float = 1) -> dict:
+        """ Run a GraphQL query, returns the "data" part. GitHub GraphQL API always requires a token """
+
+        if not self.token:
+            raise GithubException('GitHub GraphQL API requires a token')
+
+        response = self.request('POST', self.graphql_url, json={'query': query}, retries=retries, backoff=backoff)
+
+        if response.status_code != 200:
+            raise GithubException('GitHub GraphQL API responded with HTTP %i: %s' % (
+                response.status_code, response.text[0:256]))
+
+        body = response.json()
+
+        if body.get('errors'):
+            raise GithubException('GitHub GraphQL query failed: %s' % ', '.join(
+                [error.get('message', '') for error in body['errors']]))
+
+        return body['data']
+
+    def list_tags_batch(self, repositories: List[str], page_size: int = 100, retries: int = 5,
+                        backoff: float = 1) -> Dict[str, List[str]]:
+        """
+        Tags of many repositories in one GraphQL query per page. Each repository is an aliased field,
+        repositories that have more pages are queried again with their cursor until all are complete.
+
+        :return: Dict of "owner/name" -> tags, newest first
+        """
+
+        tags = {repository: [] for repository in repositories}
+        cursors = {repository: None for repository in repositories}  # type: Dict[str, Union[str, None]]
+
+        while cursors:
+            pending = list(cursors.keys())
+            data = self.graphql('query {%s\n}' % ''.join([
+                TAGS_QUERY_PART % {
+                    'alias': 'r%i' % num,
+                    'owner': json.dumps(repository.split('/')[0]),
+                    'name': json.dumps(repository.split('/', 1)[1]),
+                    'page_size': page_size,
+                    'cursor': json.dumps(cursors[repository])
+                }
+                for num, repository in enumerate(pending)
+            ]), retries=retries, backoff=backoff)
+
+            for num, repository in enumerate(pending):
+                refs = data['r%i' % num]['refs']
+                tags[repository] += [str(node['name']) for node in refs['nodes']]
+
+                if refs['pageInfo']['hasNextPage']:
+                    cursors[repository] = refs['pageInfo']['endCursor']
+                else:
+                    del cursors[repository]
+
+        return tags
+
+    def request(self, method: str, url: str, headers: dict = None, retries: int = 5, backoff: float = 1,
+                **kwargs) -> requests.Response:
+        attempt = 0
+
+        while True:
+            self._acquire()
+
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=30, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    raise GithubException('Cannot connect to GitHub API at %s: %s' % (url, str(e)))
+
+                response = None
+
+            if response is not None:
+                rate_limited, wait_scheduled = self._update_limits(response)
+
+                if attempt >= retries or not (rate_limited or response.status_code >= 500):
+                    return response
+
+                # waiting for the rate limit reset is handled by the bucket, without a known reset time backoff is used
+                if rate_limited and wait_scheduled:
+                    attempt += 1
+                    continue
+
+            time.sleep(self._calculate_backoff(attempt, backoff))
+            attempt += 1
+
+    def _acquire(self):
+        """ Take a token from the bucket, waiting for the refill or the Retry-After time if necessary """
+
+        with self._lock:
+            now = time.time()
+            wait = self._blocked_until - now
+
+            if self._tokens is not None and self._tokens <= 0:
+                wait = max(wait, self._refill_at - now)
+                self._tokens = None  # the next response tells the actual state of the new window
+
+            elif self._tokens is not None:
+                self._tokens -= 1
+
+            if wait > self.max_wait:
+                raise GithubException('GitHub API rate limit exceeded, it resets in %i seconds. '
+                                      'Consider setting GITHUB_TOKEN' % wait)
+
+            # other threads wait on the lock, as all of them would be limited the same way
+            if wait > 0:
+                time.sleep(wait)
+
+    def _update_limits(self, response: requests.Response) -> Tuple[bool, bool]:
+        """
+        Update the bucket from the response headers
+
+        :return: Tuple of: was the request rate limited, is a wait until the limit resets known (Retry-After, reset)
+        """
+
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+
+        with self._lock:
+            if remaining is not None and reset:
+                self._tokens = int(remaining)
+                self._refill_at = float(reset)
+
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+
+        rate_limited = response.status_code == 429 or \
+            (response.status_code == 403 and (remaining == '0' or bool(response.headers.get('Retry-After'))))
+
+        return rate_limited, retry_after is not None or (remaining == '0' and bool(reset))
+
+    @staticmethod
+    def _parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+        """ Retry-After is either a number of seconds, or an HTTP date """
+
+        if not value:
+            return None
+
+        if value.strip().isdigit():
+            return float(value.strip())
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _calculate_backoff(self, attempt: int, base: float) -> float:
+        """ Exponential backoff with jitter: half of the delay is fixed, the other half is random """
+
+        delay = min(self.max_backoff, base * (2 ** attempt))
+
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+_clients = {}  # type: Dict[str, GithubClient]
+_clients_lock = threading.Lock()
+
+
+def get_github_client(token: str = None) -> GithubClient:
+    """ One client per token, so the rate limit state and connection pool are shared in the process """
+
+    with _clients_lock:
+        if token not in _clients:
+            _clients[token] = GithubClient(token)
+
+        return _clients[token]
+
+
+class TagSourceException(Exception):
+    pass
+
+
+class TagSource(ABC):
+    """ Git-native source of tags, an alternative to GitHub API. Works with any git hosting, has no rate limit """
+
+    def __init__(self, location_template: str):
+        self.location_template = location_template
+
+    def get_location(self, repository: str) -> str:
+        """ eg. https://github.com/%REPOSITORY%.git -> https://github.com/riotkit-org/taiga.git """
+
+        return self.location_template.replace('%REPOSITORY%', repository)
+
+    def get_tags(self, location: str) -> List[str]:
+        """ Tag names, newest version first """
+
+        return list(reversed(natural_sort(self.get_tag_commits(location).keys())))
+
+    @abstractmethod
+    def get_tag_commits(self, location: str) -> Dict[str, str]:
+        """ Tag name -> commit SHA, annotated tags are peeled to the commit """
+
+        pass
+
+
+class LsRemoteTagSource(TagSource):
+    """ All tags of a remote (or a local path) in one "git ls-remote" call """
+
+    def get_tag_commits(self, location: str) -> Dict[str, str]:
+        try:
+            output = subprocess.check_output(['git', 'ls-remote', '--tags', location], stderr=subprocess.PIPE,
+                                             timeout=300)
+        except subprocess.CalledProcessError as e:
+            raise TagSourceException('Cannot list tags of "%s": %s' % (
+                location, e.stderr.decode('utf-8', errors='replace').strip()))
+
+        return self.parse_ls_remote(output.decode('utf-8'))
+
+    @staticmethod
+    def parse_ls_remote(output: str) -> Dict[str, str]:
+        """
+        Example output:
+            9fceb02d0ae598e95dc970b74767f19372d61af8	refs/tags/v1.1
+            1b2e1d63ff4f5e9b1a0e3c4ba8a6e1d1a2c3d4e5	refs/tags/v1.1^{}
+        """
+
+        commits = {}
+
+        for line in output.splitlines():
+            if '\t' not in line:
+                continue
+
+            sha, ref = line.split('\t', 1)
+
+            if not ref.startswith('refs/tags/'):
+                continue
+
+            name = ref[len('refs/tags/'):]
+
+            # peeled annotated tag, replaces the SHA of the tag object
+            if name.endswith('^{}'):
+                commits[name[0:-3]] = sha
+                continue
+
+            commits.setdefault(name, sha)
+
+        return commits
+
+
+class LocalCloneTagSource(TagSource):
+    """ Tags of a local mirror or a bare clone, read directly from its refs and objects. The clone is not fetched """
+
+    def get_tag_commits(self, location: str) -> Dict[str, str]:
+        if not os.path.isdir(location):
+            raise TagSourceException('"%s" is not a git repository' % location)
+
+        # a directory inside another repository (eg. the CI checkout) must not be answered with its tags
+        repository = GitRepository(location, search_parents=False)
+
+        if repository.git_dir is None:
+            raise TagSourceException('"%s" is not a git repository (neither bare, nor containing .git)' % location)
+
+        try:
+            return {name: tag.commit for name, tag in repository.get_tags().items()}
+        except (UnsupportedRepositoryLayout, OSError, ValueError, zlib.error):
+            pass
+
+        return LsRemoteTagSource(location).get_tag_commits(location)
+
+
+TAG_SOURCES = {
+    'ls-remote': LsRemoteTagSource,
+    'clone': LocalCloneTagSource
+}
+
+
+def create_tag_source(name: str, location_template: str) -> Union[TagSource, None]:
+    """ None means GitHub API """
 
-    return sorted(l, key=alphanum_key)
+    if name == 'github':
+        return None
+
+    if name not in TAG_SOURCES:
+        raise TagSourceException('Unknown tag source "%s", choose one of: github, %s' % (
+            name, ', '.join(TAG_SOURCES.keys())))
+
+    return TAG_SOURCES[name](location_template)
 
 
 class BaseGithubTask(TaskInterface, ABC):
+    _tags_cache = {}  # type: Dict[str, List[str]]
+    response_cache = ResponseCache(os.getenv('GITHUB_HTTP_CACHE_DIR', '~/.cache/rkt_ciutils/github'))
+    github_token = os.getenv('GITHUB_TOKEN')
+    tag_source = None  # type: Union[TagSource, None]
+
     def get_group_name(self) -> str:
         return ':github'
 
+    def get_repository_tags(self, repository: str, sleep_time: int, retries: int = 5) -> list:
+        """ Tags of a repository eg. riotkit-org/taiga from the configured tag source, by default from GitHub API """
+
+        if not self.tag_source:
+            return self.get_available_tags('https://api.github.com/repos/%s' % repository, sleep_time, retries)
+
+        location = self.tag_source.get_location(repository)
+        key = '%s:%s' % (self.tag_source.__class__.__name__, location)
+
+        if key not in self._tags_cache:
+            self.io().h2('Getting tags of %s using %s' % (repository, self.tag_source.__class__.__name__))
+            self._tags_cache[key] = self.tag_source.get_tags(location)
+
+        return list(self._tags_cache[key])
+
+    def iter_repository_tags(self, repository: str, sleep_time: int, retries: int = 5) -> Iterator[str]:
+        """
+        Same as get_repository_tags(), but GitHub API pages are fetched lazily - when the consumer stops iterating,
+        next pages are not fetched. The tag list is cached only when it was read completely
+        """
+
+        url = 'https://api.github.com/repos/%s' % repository
+
+        if self.tag_source or url in self._tags_cache:
+            yield from self.get_repository_tags(repository, sleep_time, retries)
+            return
+
+        tags = []
+
+        for page in self._iter_tag_pages(url, sleep_time, retries):
+            tags += page
+            yield from page
+
+        self._tags_cache[url] = tags
+
     def get_available_tags(self, url: str, sleep_time: int, retries: int = 5) -> list:
-        """ Lists all tags from github project """
+        """ Lists all tags from github project. Tag lists are shared by all tasks in the process """
 
-        tags_url = url + '/tags'
-        self.io().h2('Getting latest github releases from %s' % tags_url)
+        if url not in self._tags_cache:
+            self._tags_cache[url] = self._fetch_tags(url, sleep_time, retries)
 
-        try:
-            response = requests.get(tags_url).json()
+        return list(self._tags_cache[url])
+
+    def prefetch_tags(self, repositories: List[str], sleep_time: int, retries: int = 5):
+        """
+        Fill the tags cache for many repositories with one GraphQL round trip.
+        Without a token (GraphQL requires it) nothing is done, and tags are fetched one by one from REST API
+        """
+
+        missing = [repository for repository in repositories
+                   if 'https://api.github.com/repos/%s' % repository not in self._tags_cache]
+
+        if not missing or not self.github_token or self.tag_source:
+            return
+
+        self.io().h2('Getting latest github releases of %s' % ', '.join(missing))
+
+        for repository, tags in self.client().list_tags_batch(missing, retries=retries, backoff=sleep_time).items():
+            self._tags_cache['https://api.github.com/repos/%s' % repository] = tags
+
+    def _fetch_tags(self, url: str, sleep_time: int, retries: int = 5) -> list:
+        return [tag for page in self._iter_tag_pages(url, sleep_time, retries) for tag in page]
+
+    def _iter_tag_pages(self, url: str, sleep_time: int, retries: int = 5) -> Iterator[List[str]]:
+        """ Pages are requested one by one, when the consumer asks for the next page """
+
+        page_url = url + '/tags?per_page=100'
+
+        while page_url:
+            self.io().h2('Getting latest github releases from %s' % page_url)
+            response, page_url = self._get_page(page_url, sleep_time, retries)
 
             if "message" in response and response['message'] == 'Not Found':
                 raise Exception('Repository on github not found')
 
-            return list(map(
+            if not isinstance(response, list):
+                raise GithubException('Cannot list tags of %s: %s' % (url, response.get('message', response)))
+
+            yield list(map(
                 lambda tag_object: str(tag_object['name']),
                 response
             ))
-        except TypeError:
-            if retries <= 0:
-                raise
 
-            time.sleep(sleep_time)
-            return self.get_available_tags(url, sleep_time, retries - 1)
+    def _get_page(self, url: str, sleep_time: int = 5,
+                  retries: int = 5) -> Tuple[Union[list, dict], Union[str, None]]:
+        """ Fetch a single page, revalidating the cached copy with ETag. Returns decoded body and next page url """
+
+        cached = self.response_cache.get(url) if self.response_cache else None
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        response = self.client().get(url, headers=headers, retries=retries, backoff=sleep_time)
+
+        if response.status_code == 304 and cached:
+            self.io().debug('Not modified, using cached response of %s' % url)
+            return cached['body'], cached['next']
+
+        body = response.json()
+        next_url = response.links.get('next', {}).get('url')
+
+        if self.response_cache and response.status_code == 200 and response.headers.get('ETag'):
+            self.response_cache.store(url, response.headers['ETag'], body, next_url)
+
+        return body, next_url
+
+    def client(self) -> GithubClient:
+        return get_github_client(self.github_token)
+
+    def configure_client(self, context: ExecutionContext):
+        self.github_token = context.args['token'] or None
+        self.response_cache = None if context.args['no_http_cache'] \
+            else ResponseCache(context.args['http_cache_dir'])
+        self.tag_source = create_tag_source(context.args['tag_source'], context.args['git_remote'])
 
     def configure_argparse(self, parser: ArgumentParser):
         parser.add_argument('--retries', '-r', default='5', help='Maximum number of retries in request to github')
-        parser.add_argument('--retry-wait', '-w', default='5', help='Amount of seconds between retries')
+        parser.add_argument('--retry-wait', '-w', default='5',
+                            help='Amount of seconds between retries, doubled with each retry')
         parser.add_argument('--repository', '-n', required=True, help='Repository name eg. riotkit-org/filerepository')
+        parser.add_argument('--http-cache-dir',
+                            default=os.getenv('GITHUB_HTTP_CACHE_DIR', '~/.cache/rkt_ciutils/github'),
+                            help='Directory where GitHub API responses are cached and revalidated using ETag')
+        parser.add_argument('--no-http-cache', action='store_true', help='Do not cache GitHub API responses')
+        parser.add_argument('--token', default=os.getenv('GITHUB_TOKEN', ''),
+                            help='GitHub API token, raises the rate limit (defaults to $GITHUB_TOKEN)')
+        parser.add_argument('--tag-source', default='github', choices=['github'] + list(TAG_SOURCES.keys()),
+                            help='Where to get tags from: github (API), ls-remote (git ls-remote of --git-remote), ' +
+                                 'clone (local mirror or bare clone at --git-remote)')
+        parser.add_argument('--git-remote', default='https://github.com/%REPOSITORY%.git',
+                            help='Git remote URL or path used by ls-remote and clone tag sources, ' +
+                                 '%%REPOSITORY%% is replaced with --repository')
 
 
 class FindClosestReleaseTask(BaseGithubTask):
     """ Find a github release that is closest to the selected number """
 
+    _version_indexes = {}  # type: Dict[Tuple[str, str, str], VersionIndex]
+
     def get_name(self) -> str:
         return ':find-closest-release'
 
     def execute(self, context: ExecutionContext) -> bool:
-        url = 'https://api.github.com/repos/%s' % context.args['repository']
+        self.configure_client(context)
+
+        versions = context.args['compare_with']
+        versions = [versions] if isinstance(versions, str) else versions
 
-        self._io.out(self.find_closest_version(
-            version=context.args['compare_with'],
-            url=url,
+        closest = self.find_closest_versions(
+            versions=versions,
+            repository=context.args['repository'],
             sleep_time=int(context.args['retry_wait']),
             retries=int(context.args['retries'])
-        ))
+        )
+
+        # single version: just the result, many versions: "version closest-release" per line
+        if len(versions) == 1:
+            self._io.out(closest[versions[0]])
+            return True
+
+        for version in versions:
+            self._io.outln('%s %s' % (version, closest[version]))
 
         return True
 
     def configure_argparse(self, parser: ArgumentParser):
         super().configure_argparse(parser)
-        parser.add_argument('--compare-with', '-c', required=True, help='Version to compare with')
+        parser.add_argument('--compare-with', '-c', required=True, nargs='+',
+                            help='Version to compare with, many versions can be given at once')
 
-    def find_closest_version(self, version: str, url: str, sleep_time: int, retries: int) -> str:
-        all_versions = self.get_available_tags(url, sleep_time, retries)
+    def find_closest_version(self, version: str, repository: str, sleep_time: int, retries: int) -> str:
+        return self.get_version_index(repository, sleep_time, retries).find_closest(version)
 
-        if version in all_versions:
-            return version
+    def find_closest_versions(self, versions: List[str], repository: str, sleep_time: int,
+                              retries: int) -> Dict[str, str]:
+        return self.get_version_index(repository, sleep_time, retries).find_closest_many(versions)
 
-        all_versions += [version]
-        sorted_desc = list(reversed(natural_sort(all_versions)))
-        current_version_position = sorted_desc.index(version)
+    def get_version_index(self, repository: str, sleep_time: int, retries: int) -> VersionIndex:
+        """ Index is built once per repository and tag source location, and shared by all tasks in the process """
 
-        if len(sorted_desc) == 1:
-            return version
+        if self.tag_source:
+            key = (self.tag_source.__class__.__name__, self.tag_source.get_location(repository), repository)
+        else:
+            key = ('github', 'https://api.github.com/repos/%s' % repository, repository)
+
+        if key not in self._version_indexes:
+            self._version_indexes[key] = VersionIndex(self.get_repository_tags(repository, sleep_time, retries))
+
+        return self._version_indexes[key]
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """ "2/3" -> (2, 3) """
+
+    match = re.match('^([0-9]+)/([0-9]+)$', shard.strip())
 
-        if current_version_position == len(sorted_desc) - 1:
-            return sorted_desc[len(sorted_desc) - 2]
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise Exception('Invalid shard "%s", expected INDEX/COUNT eg. 1/3 (INDEX counted from 1)' % shard)
 
-        return sorted_desc[current_version_position + 1]
+    return int(match.group(1)), int(match.group(2))
 
 
 class ForEachGithubReleaseTask(BaseGithubTask):
     """ Iterate over recent X github releases and execute a task """
 
+    _remote_tags = {}  # type: Dict[str, Set[str]]
+    existence_check = 'manifest'
+    ledger = None  # type: Union[BuildLedger, None]
+    verify_ledger = False
+
     def get_name(self) -> str:
         return ':for-each-release'
 
     def execute(self, context: ExecutionContext) -> bool:
         self.io().h1('Iterating over each github release')
+        self.configure_client(context)
+        self.existence_check = context.args['existence_check']
+        self.ledger = BuildLedger(context.args['ledger']) if context.args['ledger'] else None
+        self.verify_ledger = bool(context.args['verify_ledger'])
+
+        if context.args['refresh_remote_tags']:
+            self._remote_tags.pop(context.args['dest_docker_repo'], None)
 
-        url = 'https://api.github.com/repos/%s' % context.args['repository']
         force_rebuild = not context.args['dont_rebuild']
-        tags = self.get_available_tags(
-            url,
-            int(context.args['retry_wait']),
-            int(context.args['retries'])
-        )
-        self.io().h4('Release tag template is "%s"' % context.args['release_tag_template'])
-
-        return self.print_last_versions(
-            tags=tags,
-            max_versions=int(context.args['max_versions']),
-            allowed_tags_regexp=re.compile(context.args['allowed_tags_regexp']) \
-            if context.args['allowed_tags_regexp'] else None,
-            release_tag_template=context.args['release_tag_template'],
-            force_rebuild=force_rebuild,
-            build_command=context.args['exec'],
-            dest_docker_repo=context.args['dest_docker_repo'],
-            dry_run=bool(context.args['dry_run'])
-        )
 
-    def print_last_versions(self, tags: list, max_versions: int, allowed_tags_regexp: Union[Pattern, None],
+        try:
+            tags = self.iter_repository_tags(
+                context.args['repository'],
+                int(context.args['retry_wait']),
+                int(context.args['retries'])
+            )
+            self.io().h4('Release tag template is "%s"' % context.args['release_tag_template'])
+
+            return self.print_last_versions(
+                tags=tags,
+                max_versions=int(context.args['max_versions']),
+                allowed_tags_regexp=re.compile(context.args['allowed_tags_regexp']) \
+                if context.args['allowed_tags_regexp'] else None,
+                release_tag_template=context.args['release_tag_template'],
+                force_rebuild=force_rebuild,
+                build_command=context.args['exec'],
+                dest_docker_repo=context.args['dest_docker_repo'],
+                dry_run=bool(context.args['dry_run']),
+                parallel=int(context.args['parallel']),
+                sort=context.args['sort'],
+                shard=parse_shard(context.args['shard']) if context.args['shard'] else None,
+                plan_out=context.args['plan_out']
+            )
+
+        finally:
+            if self.ledger:
+                self.ledger.close()
+                self.ledger = None
+
+    def print_last_versions(self, tags: Iterable[str], max_versions: int, allowed_tags_regexp: Union[Pattern, None],
                             release_tag_template: str, force_rebuild: bool, build_command: str,
-                            dest_docker_repo: str, dry_run: bool):
-        to_build = {}
+                            dest_docker_repo: str, dry_run: bool, parallel: int = 1, sort: str = 'api',
+                            shard: Tuple[int, int] = None, plan_out: str = None):
         result = True
+        to_run_in_parallel = []
+        plan = self.plan_releases(tags, max_versions, allowed_tags_regexp, release_tag_template,
+                                  force_rebuild, build_command, dest_docker_repo, sort, shard)
 
-        self.io().print_opt_line()
-        self.io().h1('Parsing GIT tags to find out those that are release tags')
+        if plan_out:
+            self.write_plan(plan_out, plan, shard)
 
-        # collect items to build
-        for tag in tags:
-            properties = None
+        for release in plan:
+            if release.already_built:
+                self.io().h2('Skipping "%s" as the docker tag already exists' % release.release_tag)
+                continue
 
-            if allowed_tags_regexp:
-                matches = allowed_tags_regexp.match(tag)
-                if not matches:
-                    self.io().h2("Not matched tag \"%s\"" % tag)
-                    continue
+            self.io().h2('Calling generated command %s' % release.command)
+
+            if not dry_run and parallel > 1:
+                to_run_in_parallel.append(release)
+                continue
+
+            if not dry_run:
+                try:
+                    self.sh(release.command)
+                except subprocess.CalledProcessError:
+                    result = False
+
+            self.io().print_separator()
+            self.io().print_opt_line()
+
+        if to_run_in_parallel:
+            result = self.build_in_parallel(to_run_in_parallel, parallel)
+
+        return result
+
+    def build_in_parallel(self, releases: List[PlannedRelease], workers: int) -> bool:
+        """ Run build commands concurrently, each output line is prefixed with the git tag it belongs to """
+
+        output_lock = threading.Lock()
+
+        def build(release: PlannedRelease) -> int:
+            process = subprocess.Popen(['bash', '-c', 'set -euo pipefail; ' + release.command],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+            for line in iter(process.stdout.readline, b''):
+                with output_lock:
+                    self.io().outln('[%s] %s' % (release.git_tag, line.decode('utf-8', errors='replace').rstrip()))
+
+            return process.wait()
+
+        self.io().h1('Building %i releases, %i at once' % (len(releases), workers))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            exit_codes = list(pool.map(build, releases))
+
+        failed = [release.git_tag for release, exit_code in zip(releases, exit_codes) if exit_code != 0]
 
-                self.io().h2('Matched %s' % tag)
-                properties = matches
+        for release, exit_code in zip(releases, exit_codes):
+            if exit_code == 0:
+                self.io().success_msg('[%s] Built' % release.git_tag)
+            else:
+                self.io().error_msg('[%s] Failed with exit code %i' % (release.git_tag, exit_code))
 
-            to_build[tag] = properties
+        return not failed
 
-        processed = 0
-        self.io().h1('Processing tags (max amount: %i)' % max_versions)
+    def plan_releases(self, tags: Iterable[str], max_versions: int, allowed_tags_regexp: Union[Pattern, None],
+                      release_tag_template: str, force_rebuild: bool, build_command: str,
+                      dest_docker_repo: str, sort: str = 'api', shard: Tuple[int, int] = None) -> List[PlannedRelease]:
+        """
+        Decide which tags to build, what docker tags they produce and which commands build them
 
-        for git_tag, matches in to_build.items():
-            if 0 < max_versions <= processed:
-                break
+        Tags are processed lazily: with "api" sort the iteration stops after max_versions release tags,
+        so no more tags (pages) are read. "version" sort needs to see all tags, but keeps only max_versions highest.
 
+        With a shard (index, count) only the share of the selected releases belonging to the shard is planned.
+        """
+
+        plan = []
+
+        self.io().print_opt_line()
+        self.io().h1('Processing tags (max amount: %i, sort: %s)' % (max_versions, sort))
+
+        candidates = self._match_release_tags(tags, allowed_tags_regexp)
+
+        if sort == 'version':
+            candidates = self._highest_versions(candidates, max_versions)
+
+        candidates = itertools.islice(candidates, max_versions if max_versions > 0 else None)
+
+        if shard:
+            candidates = self._select_shard(candidates, shard)
+
+        for git_tag, matches in candidates:
             release_tag = self.create_release_tag(git_tag, matches, release_tag_template)
 
-            if not force_rebuild and self.was_already_built(dest_docker_repo, release_tag):
-                self.io().h2('Skipping "%s" as the docker tag already exists' % release_tag)
-                processed += 1
+            plan.append(PlannedRelease(
+                git_tag=git_tag,
+                release_tag=release_tag,
+                command=self.render_template(build_command, git_tag, matches),
+                already_built=not force_rebuild and self.was_already_built(dest_docker_repo, release_tag)
+            ))
+
+        return plan
+
+    def _match_release_tags(self, tags: Iterable[str],
+                            allowed_tags_regexp: Union[Pattern, None]) -> Iterator[Tuple[str, Union[Match, None]]]:
+        seen = set()
+
+        for tag in tags:
+            if tag in seen:
                 continue
 
-            command = self.render_template(build_command, git_tag, matches)
+            seen.add(tag)
 
-            self.io().h2('Calling generated command %s' % command)
+            if not allowed_tags_regexp:
+                yield tag, None
+                continue
 
-            if not dry_run:
-                try:
-                    self.sh(command)
-                except subprocess.CalledProcessError:
-                    result = False
+            matches = allowed_tags_regexp.match(tag)
 
-            processed += 1
-            self.io().print_separator()
-            self.io().print_opt_line()
+            if not matches:
+                self.io().debug('Not matched tag "%s"' % tag)
+                continue
 
-        return result
+            self.io().h2('Matched %s' % tag)
+            yield tag, matches
+
+    @staticmethod
+    def _version_key(candidate: Tuple[str, Union[Match, None]]) -> Tuple[list, str]:
+        """
+        The version is the first regexp group, or the whole tag. Git tag breaks ties,
+        it is kept apart from the version parts, as they would be compared with it when one version prefixes another
+        """
+
+        git_tag, matches = candidate
+        version = matches.group(1) if matches and matches.groups() and matches.group(1) else git_tag
+
+        return natural_sort_key(version), git_tag
+
+    @classmethod
+    def _highest_versions(cls, candidates: Iterator[Tuple[str, Union[Match, None]]],
+                          max_versions: int) -> Iterator[Tuple[str, Union[Match, None]]]:
+        """ Highest versions first """
+
+        if max_versions > 0:
+            return iter(heapq.nlargest(max_versions, candidates, key=cls._version_key))
+
+        return iter(sorted(candidates, key=cls._version_key, reverse=True))
+
+    @classmethod
+    def _select_shard(cls, candidates: Iterable[Tuple[str, Union[Match, None]]],
+                      shard: Tuple[int, int]) -> List[Tuple[str, Union[Match, None]]]:
+        """
+        Round-robin over releases sorted by version, so every runner gets the same split regardless
+        of the order returned by the tag source, and new (usually heavier) versions are spread between runners
+        """
+
+        index, count = shard
+        ordered = sorted(candidates, key=cls._version_key, reverse=True)
+
+        return [candidate for position, candidate in enumerate(ordered) if position % count == index - 1]
+
+    def write_plan(self, path: str, plan: List[PlannedRelease], shard: Union[Tuple[int, int], None]):
+        with open(path, 'wb') as f:
+            f.write(json.dumps({
+                'shard': '%i/%i' % shard if shard else None,
+                'releases': [release._asdict() for release in plan]
+            }, indent=4).encode('utf-8'))
+
+        self.io().info_msg('Build plan written to "%s"' % path)
 
     def create_release_tag(self, git_tag: str, matches: Union[Match, None], release_tag_template: str):
         return self.render_template(release_tag_template, git_tag, matches, False)
@@ -199,20 +876,51 @@ class ForEachGithubReleaseTask(BaseGithubTask):
         return text
 
     def was_already_built(self, image_name: str, docker_tag: str) -> bool:
-        """ Checks if the docker tag was already pushed """
+        """
+        Checks if the docker tag was already pushed
+
+        The build ledger is asked first, the registry only on a miss (or always with --verify-ledger).
+        Tags found in the registry are remembered in the ledger
+        """
+
+        image = '%s:%s' % (image_name, docker_tag)
+
+        if self.ledger and not self.verify_ledger and self.ledger.contains(image):
+            self.io().h3('Docker tag "%s" found in the build ledger' % docker_tag)
+            return True
 
         self.io().h3('Checking if docker tag "%s" was already pushed' % docker_tag)
 
         try:
-            self.rkd([':docker:tag-exists', '--image=%s:%s' % (image_name, docker_tag)], verbose=True)
-            return True
+            if self.existence_check == 'tags-list':
+                exists = docker_tag in self.get_remote_tags(image_name)
+            else:
+                exists = DockerTagExistsTask.tag_exists(image)
 
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 127:
-                raise Exception(':docker-tag-exists command is not registered')
+        except (RegistryException, requests.RequestException) as e:
+            self.io().warn('Cannot check if "%s" exists, assuming it does not: %s' % (image, str(e)))
 
             return False
 
+        if self.ledger and exists:
+            self.ledger.record(image)
+
+        elif self.ledger:
+            self.ledger.forget(image)
+
+        return exists
+
+    def get_remote_tags(self, image_name: str) -> Set[str]:
+        """ All tags of the docker repository, listed once per process (use --refresh-remote-tags to list again) """
+
+        if image_name not in self._remote_tags:
+            reference = parse_image(image_name)
+            self.io().h3('Listing tags of docker repository "%s"' % image_name)
+            self._remote_tags[image_name] = set(
+                DockerTagExistsTask.get_client(reference.registry).list_tags(reference.repository))
+
+        return self._remote_tags[image_name]
+
     def configure_argparse(self, parser: ArgumentParser):
         super().configure_argparse(parser)
 
@@ -234,6 +942,22 @@ class ForEachGithubReleaseTask(BaseGithubTask):
                             help='Do not build the same version twice ' +
                                  '(checks existence of a docker tag for --docker-repo)',
                             action='store_true')
+        parser.add_argument('--sort', default='api', choices=['api', 'version'],
+                            help='Order in which releases are taken: api (as returned by the tag source, ' +
+                                 'stops reading tags early) or version (highest --max-versions versions)')
+        parser.add_argument('--shard', default='',
+                            help='Build only a share of releases eg. 2/3 - second of three runners (counted from 1)')
+        parser.add_argument('--plan-out', default='', help='Write the list of planned releases as JSON to a file')
+        parser.add_argument('--existence-check', default='manifest', choices=['manifest', 'tags-list'],
+                            help='How --dont-rebuild checks the docker tag: manifest (a request per release) ' +
+                                 'or tags-list (all tags of --dest-docker-repo listed once)')
+        parser.add_argument('--ledger', default=os.getenv('RKT_BUILD_LEDGER', ''),
+                            help='SQLite build ledger written by :docker:push, asked before the registry ' +
+                                 '(defaults to $RKT_BUILD_LEDGER)')
+        parser.add_argument('--verify-ledger', action='store_true',
+                            help='Always ask the registry, correct the build ledger with the answer')
+        parser.add_argument('--refresh-remote-tags', action='store_true',
+                            help='List tags of --dest-docker-repo again, even if already listed in this process')
         parser.add_argument('--allowed-tags-regexp', '-tr',
                             help='Optional regexp to filter tags (eg. release-([0-9.]+) or v([0-9.]+))')
         parser.add_argument('--release-tag-template', '-t',
@@ -243,6 +967,9 @@ class ForEachGithubReleaseTask(BaseGithubTask):
         parser.add_argument('--max-versions', '-mv',
                             help='Max versions to check/build',
                             default='5')
+        parser.add_argument('--parallel', '-j',
+                            help='Number of releases to build concurrently',
+                            default='1')
         parser.add_argument('--dry-run',
                             help='Print instead of performing',
                             action='store_true')
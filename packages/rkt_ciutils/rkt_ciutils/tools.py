@@ -1,11 +1,339 @@
+import os
 import re
+import zlib
+import shlex
+import struct
+from collections import namedtuple
 from subprocess import check_output, CalledProcessError, STDOUT
-from typing import Union
+from typing import Callable, Dict, List, Tuple, Union
+from rkd.api.contract import TaskInterface, ExecutionContext
+from rkd.api.syntax import TaskDeclaration
+from rkd.argparsing.parser import CommandlineParsingHelper
 
+PACK_OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+
+GitTag = namedtuple('GitTag', 'name commit tagger_date annotated')
+
+
+class UnsupportedRepositoryLayout(Exception):
+    pass
+
+
+class GitRepository(object):
+    """
+    Snapshot of GIT metadata read directly from the .git directory (HEAD, refs/tags, packed-refs, tag objects)
+
+    Everything is read once and memoized, so answering "are we on a tag?" costs no process spawning.
+    Unusual layouts (reftable, alternates, deltified tag objects, $GIT_DIR) are answered by the git CLI.
+    """
+
+    def __init__(self, path: str = '.', search_parents: bool = True):
+        self.git_dir, self.common_dir = self._find_git_dir(os.path.abspath(path), search_parents)
+        self._head = None  # type: Union[str, None]
+        self._tags = None  # type: Union[Dict[str, GitTag], None]
+        self._answers = {}  # type: Dict[str, Union[str, None]]
+
+    def get_current_tag(self) -> Union[str, None]:
+        """ Tag pointing exactly at HEAD, annotated tags are preferred like in "git describe" """
+
+        if 'current_tag' not in self._answers:
+            self._answers['current_tag'] = self._with_cli_fallback(self._read_current_tag, self._cli_current_tag)
+
+        return self._answers['current_tag']
+
+    def get_last_tag(self) -> str:
+        """ Most recent tag by tagger date """
+
+        if 'last_tag' not in self._answers:
+            self._answers['last_tag'] = self._with_cli_fallback(self._read_last_tag, self._cli_last_tag)
+
+        return self._answers['last_tag']
+
+    def get_head_commit(self) -> str:
+        if self._head is None:
+            with open(os.path.join(self.git_dir, 'HEAD'), 'rb') as f:
+                head = f.read().decode('utf-8').strip()
+
+            self._head = self._resolve_ref(head[len('ref: '):]) if head.startswith('ref: ') else head
+
+        return self._head
+
+    def get_tags(self) -> Dict[str, GitTag]:
+        if self._tags is None:
+            tags = {}
+
+            for name, (sha, is_annotated) in self._read_tag_refs().items():
+                if is_annotated is False:
+                    tags[name] = GitTag(name=name, commit=sha, tagger_date=None, annotated=False)
+                    continue
+
+                tags[name] = self._read_tag(name, sha)
+
+            self._tags = tags
+
+        return self._tags
+
+    def _read_current_tag(self) -> Union[str, None]:
+        head = self.get_head_commit()
+        candidates = [tag for tag in self.get_tags().values() if tag.commit == head]
+
+        if not candidates:
+            return None
+
+        candidates.sort(key=lambda tag: (not tag.annotated, -(tag.tagger_date or 0), tag.name))
+
+        return candidates[0].name
+
+    def _read_last_tag(self) -> str:
+        tags = sorted(self.get_tags().values(), key=lambda tag: (-(tag.tagger_date or 0), tag.name))
+
+        return tags[0].name if tags else ''
+
+    def _with_cli_fallback(self, reader: Callable, fallback: Callable):
+        if self.git_dir is None:
+            return fallback()
 
-class GitTools:
-    @classmethod
-    def get_current_tag(cls) -> Union[str, None]:
+        try:
+            return reader()
+        except (UnsupportedRepositoryLayout, OSError, ValueError, zlib.error):
+            return fallback()
+
+    @staticmethod
+    def _find_git_dir(path: str, search_parents: bool = True) -> Tuple[Union[str, None], Union[str, None]]:
+        """
+        Returns the git directory (HEAD) and the common directory (refs, objects)
+
+        Without search_parents only the path itself is checked - as a bare repository, or with a ".git" inside
+        """
+
+        if search_parents and os.getenv('GIT_DIR'):
+            return None, None
+
+        # bare repository or a mirror
+        if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+            git_dir = path
+            path = None
+
+        while path:
+            dot_git = os.path.join(path, '.git')
+
+            if os.path.isdir(dot_git):
+                git_dir = dot_git
+                break
+
+            # worktrees and submodules: ".git" file with "gitdir: <path>"
+            if os.path.isfile(dot_git):
+                with open(dot_git, 'rb') as f:
+                    content = f.read().decode('utf-8').strip()
+
+                if not content.startswith('gitdir: '):
+                    return None, None
+
+                git_dir = os.path.join(path, content[len('gitdir: '):])
+                break
+
+            parent = os.path.dirname(path)
+
+            if parent == path or not search_parents:
+                return None, None
+
+            path = parent
+
+        common_dir = git_dir
+
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'rb') as f:
+                common_dir = os.path.normpath(os.path.join(git_dir, f.read().decode('utf-8').strip()))
+
+        if os.path.exists(os.path.join(common_dir, 'reftable')) or \
+                os.path.exists(os.path.join(common_dir, 'objects', 'info', 'alternates')):
+            return None, None
+
+        return git_dir, common_dir
+
+    def _read_packed_refs(self) -> Dict[str, Tuple[str, Union[str, bool, None]]]:
+        """ refname -> (sha, peeled sha). Peeled is False when the file is "fully-peeled" and ref is not a tag """
+
+        refs = {}
+        path = os.path.join(self.common_dir, 'packed-refs')
+
+        if not os.path.isfile(path):
+            return refs
+
+        last_ref = None
+        fully_peeled = False
+
+        with open(path, 'rb') as f:
+            for line in f.read().decode('utf-8').splitlines():
+                if line.startswith('# pack-refs with:'):
+                    fully_peeled = 'fully-peeled' in line.split(' ')
+                    continue
+
+                if line.startswith('#') or not line.strip():
+                    continue
+
+                if line.startswith('^'):
+                    refs[last_ref] = (refs[last_ref][0], line[1:].strip())
+                    continue
+
+                sha, last_ref = line.split(' ', 1)
+                refs[last_ref] = (sha, False if fully_peeled else None)
+
+        return refs
+
+    def _resolve_ref(self, ref: str) -> str:
+        loose = os.path.join(self.git_dir if ref == 'HEAD' else self.common_dir, ref)
+
+        if os.path.isfile(loose):
+            with open(loose, 'rb') as f:
+                value = f.read().decode('utf-8').strip()
+
+            return self._resolve_ref(value[len('ref: '):]) if value.startswith('ref: ') else value
+
+        packed = self._read_packed_refs()
+
+        if ref in packed:
+            return packed[ref][0]
+
+        raise UnsupportedRepositoryLayout('Cannot resolve ref "%s"' % ref)
+
+    def _read_tag_refs(self) -> Dict[str, Tuple[str, Union[bool, None]]]:
+        """ tag name -> (sha, is annotated), None when it is not known without reading the object """
+
+        tags = {}
+
+        for ref, (sha, peeled) in self._read_packed_refs().items():
+            if ref.startswith('refs/tags/'):
+                tags[ref[len('refs/tags/'):]] = (sha, None if peeled is None else bool(peeled))
+
+        tags_dir = os.path.join(self.common_dir, 'refs', 'tags')
+
+        for root, dirs, files in os.walk(tags_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                tags[os.path.relpath(path, tags_dir).replace(os.sep, '/')] = (self._resolve_ref(
+                    os.path.relpath(path, self.common_dir).replace(os.sep, '/')), None)
+
+        return tags
+
+    def _read_tag(self, name: str, sha: str) -> GitTag:
+        """ Peels annotated tags to the commit, collecting the tagger date """
+
+        object_type, content = self._read_object(sha)
+
+        if object_type != 'tag':
+            return GitTag(name=name, commit=sha, tagger_date=None, annotated=False)
+
+        headers = {}
+
+        for line in content.decode('utf-8', errors='replace').split('\n\n', 1)[0].splitlines():
+            key, value = line.split(' ', 1)
+            headers[key] = value
+
+        tagger_date = int(headers['tagger'].rsplit(' ', 2)[1]) if 'tagger' in headers else None
+        commit = headers['object']
+
+        # tag of a tag
+        while headers.get('type') == 'tag':
+            object_type, content = self._read_object(commit)
+            headers = dict(line.split(' ', 1) for line in
+                           content.decode('utf-8', errors='replace').split('\n\n', 1)[0].splitlines())
+            commit = headers['object']
+
+        return GitTag(name=name, commit=commit, tagger_date=tagger_date, annotated=True)
+
+    def _read_object(self, sha: str) -> Tuple[str, bytes]:
+        loose = os.path.join(self.common_dir, 'objects', sha[0:2], sha[2:])
+
+        if os.path.isfile(loose):
+            with open(loose, 'rb') as f:
+                raw = zlib.decompress(f.read())
+
+            header, content = raw.split(b'\0', 1)
+            return header.split(b' ')[0].decode('utf-8'), content
+
+        return self._read_packed_object(sha)
+
+    def _read_packed_object(self, sha: str) -> Tuple[str, bytes]:
+        pack_dir = os.path.join(self.common_dir, 'objects', 'pack')
+        binary_sha = bytes.fromhex(sha)
+
+        for idx_name in sorted(os.listdir(pack_dir)) if os.path.isdir(pack_dir) else []:
+            if not idx_name.endswith('.idx'):
+                continue
+
+            offset = self._find_in_pack_index(os.path.join(pack_dir, idx_name), binary_sha)
+
+            if offset is None:
+                continue
+
+            with open(os.path.join(pack_dir, idx_name[0:-4] + '.pack'), 'rb') as f:
+                f.seek(offset)
+                byte = f.read(1)[0]
+                object_type = (byte >> 4) & 7
+
+                while byte & 0x80:
+                    byte = f.read(1)[0]
+
+                if object_type not in PACK_OBJECT_TYPES:
+                    raise UnsupportedRepositoryLayout('Deltified object %s' % sha)
+
+                decompressor = zlib.decompressobj()
+                content = b''
+
+                while not decompressor.eof:
+                    chunk = f.read(4096)
+
+                    if not chunk:
+                        break
+
+                    content += decompressor.decompress(chunk)
+
+                return PACK_OBJECT_TYPES[object_type], content
+
+        raise UnsupportedRepositoryLayout('Object %s not found' % sha)
+
+    @staticmethod
+    def _find_in_pack_index(path: str, binary_sha: bytes) -> Union[int, None]:
+        """ Binary search in a version 2 pack index, returns offset in the pack file """
+
+        with open(path, 'rb') as f:
+            index = f.read()
+
+        if index[0:8] != b'\377tOc\0\0\0\2':
+            raise UnsupportedRepositoryLayout('Unsupported pack index version in %s' % path)
+
+        fanout = struct.unpack('>256I', index[8:8 + 1024])
+        total = fanout[255]
+        low = fanout[binary_sha[0] - 1] if binary_sha[0] > 0 else 0
+        high = fanout[binary_sha[0]]
+        shas_start = 8 + 1024
+
+        while low < high:
+            middle = (low + high) // 2
+            current = index[shas_start + middle * 20:shas_start + middle * 20 + 20]
+
+            if current == binary_sha:
+                offsets_start = shas_start + total * 20 + total * 4
+                offset = struct.unpack('>I', index[offsets_start + middle * 4:offsets_start + middle * 4 + 4])[0]
+
+                # large offsets (packs over 2 GB)
+                if offset & 0x80000000:
+                    large_start = offsets_start + total * 4 + (offset & 0x7fffffff) * 8
+                    offset = struct.unpack('>Q', index[large_start:large_start + 8])[0]
+
+                return offset
+
+            if current < binary_sha:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    @staticmethod
+    def _cli_current_tag() -> Union[str, None]:
         try:
             return check_output(
                 'git describe --exact-match --tags $(git log -n1 --pretty=\'%h\')',
@@ -16,12 +344,8 @@ class GitTools:
         except CalledProcessError:
             return None
 
-    @classmethod
-    def is_currently_on_tag(cls) -> bool:
-        return cls.get_current_tag() is not None
-
-    @classmethod
-    def get_last_tag(cls) -> str:
+    @staticmethod
+    def _cli_last_tag() -> str:
         return check_output(
                 'git for-each-ref refs/tags --sort=-taggerdate --format=\'%(refname)\' --count=1',
                 shell=True,
@@ -30,6 +354,33 @@ class GitTools:
             .decode('utf-8').strip().replace('refs/tags/', '')
 
 
+class GitTools:
+    _repositories = {}  # type: Dict[str, GitRepository]
+
+    @classmethod
+    def get_repository(cls) -> GitRepository:
+        """ One snapshot per working directory for the whole invocation """
+
+        cwd = os.getcwd()
+
+        if cwd not in cls._repositories:
+            cls._repositories[cwd] = GitRepository(cwd)
+
+        return cls._repositories[cwd]
+
+    @classmethod
+    def get_current_tag(cls) -> Union[str, None]:
+        return cls.get_repository().get_current_tag()
+
+    @classmethod
+    def is_currently_on_tag(cls) -> bool:
+        return cls.get_current_tag() is not None
+
+    @classmethod
+    def get_last_tag(cls) -> str:
+        return cls.get_repository().get_last_tag()
+
+
 class VersionTools:
     @classmethod
     def get_next_version(cls) -> str:
@@ -56,3 +407,82 @@ class VersionTools:
             parts.append('1')
 
         return '.'.join(parts)
+
+
+class TaskTools:
+    # global rkd switches that do not change how the task is executed
+    IGNORED_RKD_SWITCHES = ['--no-ui', '-n']
+
+    # switches changing the user or working directory, applied only by rkd itself - such calls go to the shell
+    SHELL_ONLY_RKD_SWITCHES = ['--become', '-rb', '--task-workdir', '-rw']
+
+    @classmethod
+    def parse_rkd_command(cls, cmd: str) -> Union[Tuple[str, List[str]], None]:
+        """
+        Parse a single-task rkd call, returns None for anything that needs a shell
+
+        Example: rkd --no-ui :boat-ci:each-release -rl info -> (':boat-ci:each-release', ['-rl', 'info'])
+        """
+
+        if re.search('[;&|`$<>@]', cmd):
+            return None
+
+        try:
+            argv = shlex.split(cmd)
+        except ValueError:
+            return None
+
+        if not argv or os.path.basename(argv[0]) != 'rkd':
+            return None
+
+        argv = [arg for arg in argv[1:] if arg not in cls.IGNORED_RKD_SWITCHES]
+
+        if not argv or not argv[0].startswith(':') or [arg for arg in argv[1:] if arg.startswith(':')]:
+            return None
+
+        if [arg for arg in argv if arg.split('=', 1)[0] in cls.SHELL_ONLY_RKD_SWITCHES]:
+            return None
+
+        return argv[0], argv[1:]
+
+    @classmethod
+    def execute_in_process(cls, parent: TaskInterface, task: TaskInterface, args: List[str], env: dict) -> bool:
+        """ Executes a task in current Python process, arguments are parsed the same way as from commandline """
+
+        parent.copy_internal_dependencies(task)
+        declaration = TaskDeclaration(task, env=env)
+
+        try:
+            parsed_args, defined_args = CommandlineParsingHelper.parse(declaration, args)
+
+        except SystemExit:
+            # argparse exits on unknown or invalid arguments, in-process it would end the whole build chain
+            parent.io().error_msg('Invalid arguments for %s: %s' % (declaration.to_full_name(), ' '.join(args)))
+            return False
+
+        return task.execute(ExecutionContext(
+            declaration=declaration,
+            args=parsed_args,
+            env=declaration.get_env(),
+            defined_args=defined_args
+        )) is True
+
+    @classmethod
+    def run_command(cls, parent: TaskInterface, cmd: str, env: dict, tasks: Dict[str, Callable]) -> bool:
+        """
+        Runs known rkd tasks in current process (skips interpreter startup and tasks bootstrap),
+        everything else is executed in a shell as usual
+        """
+
+        parsed = cls.parse_rkd_command(cmd)
+
+        if parsed and parsed[0] in tasks:
+            parent.io().debug('Executing %s in-process' % parsed[0])
+            return cls.execute_in_process(parent, tasks[parsed[0]](), parsed[1], env)
+
+        try:
+            parent.sh(cmd, verbose=True)
+            return True
+        except CalledProcessError as e:
+            parent.io().error_msg(str(e))
+            return False
@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 
+import os
+import time
+import tempfile
+import threading
 import unittest
-from rkt_ciutils.boatci import ProcessRequestTask
+from unittest import mock
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_ciutils.boatci import ProcessRequestTask, EachRelease, SpecificRelease, BuildGraph, GraphException
+from rkt_ciutils.github import PlannedRelease
+from rkt_ciutils.github import BaseGithubTask, FindClosestReleaseTask
 
 
 class ProcessRequestTaskTest(unittest.TestCase):
@@ -9,3 +18,207 @@ class ProcessRequestTaskTest(unittest.TestCase):
         """Scenario: We are on a tag in GIT, so the CI should build images for such tag
         """
 
+
+
+class InProcessChainTest(BasicTestingCase):
+    def _plan(self, **kwargs) -> list:
+        """ Three releases, the oldest one is already built """
+
+        return [PlannedRelease(version, version + '-SNAPSHOT',
+                               kwargs['version_build_cmd'].replace('%MATCH_0%', version), version == '4.2.0')
+                for version in ['5.0.1', '5.0.0', '4.2.0']]
+
+    def test_process_request_executes_the_whole_build_plan_in_process(self):
+        task = self.satisfy_task_dependencies(ProcessRequestTask(), io=BufferedSystemIO())
+        context = self.mock_execution_context(task, {
+            'commit_message': 'Update', 'type': 'each-release', 'in_process': True,
+            'exec': 'rkd --no-ui %RELEASE_TASK% -rl info %REBUILD_FLAG%%IN_PROCESS_FLAG% ' +
+                    '--version-template="%VERSION_TEMPLATE%"',
+            'dev_version_template': '%MATCH_0%-SNAPSHOT', 'release_version_template': '%MATCH_0%-D%GIT_TAG%'
+        }, dict(EachRelease().get_declared_envs(), GITHUB_REPOSITORY='taigaio/taiga-back',
+                DEST_DOCKER_REPO='quay.io/riotkit/taiga'))
+        built = []
+
+        def build(release: SpecificRelease, release_context) -> bool:
+            built.append((release_context.args['docker_version'], release_context.args['in_process']))
+            return release_context.args['docker_version'] != '5.0.1-SNAPSHOT'
+
+        with mock.patch('rkt_ciutils.boatci.GitTools.is_currently_on_tag', return_value=False), \
+                mock.patch.object(EachRelease, 'create_build_plan', autospec=True,
+                                  side_effect=lambda each_release, **kwargs: self._plan(**kwargs)) as create_plan, \
+                mock.patch.object(SpecificRelease, 'execute', autospec=True, side_effect=build), \
+                mock.patch.object(EachRelease, 'sh') as sh:
+            # a failed release is reported, but does not stop building the next ones
+            self.assertFalse(task.execute(context))
+
+        self.assertFalse(create_plan.call_args[1]['rebuild'])
+        self.assertEqual([('5.0.1-SNAPSHOT', True), ('5.0.0-SNAPSHOT', True)], built)
+        sh.assert_not_called()
+
+    def test_each_release_executes_not_built_releases(self):
+        task = self.satisfy_task_dependencies(EachRelease(), io=BufferedSystemIO())
+        context = self.mock_execution_context(task, {'version_template': '', 'dont_rebuild_when_exists': False,
+                                                     'in_process': True}, {})
+        plan = self._plan(version_build_cmd='rkd :boat-ci:specific-release --docker-version=%MATCH_0% --in-process')
+
+        with mock.patch.object(SpecificRelease, 'execute', autospec=True, return_value=True) as execute:
+            self.assertTrue(task.execute_build_plan(context, plan))
+
+        self.assertEqual(['5.0.1', '5.0.0'], [call[0][1].args['docker_version'] for call in execute.call_args_list])
+
+
+class SpecificReleaseTest(BasicTestingCase):
+    def test_auto_cache_picks_closest_previous_pushed_tag(self):
+        task = self.satisfy_task_dependencies(SpecificRelease())
+
+        with mock.patch('rkt_ciutils.boatci.RegistryClient') as client:
+            client.return_value.list_tags.return_value = ['1.9.0', '2.0.1', '2.1.0', '3.0.0', 'latest']
+
+            self.assertEqual(
+                ('DOCKER_BUILDKIT=1 docker build',
+                 '--cache-from quay.io/riotkit/taiga:2.0.1 --build-arg BUILDKIT_INLINE_CACHE=1'),
+                task._get_cache_opts('auto', 'inline', '', 'quay.io/riotkit/taiga', '2.0.5')
+            )
+
+    def test_local_cache_uses_buildx_with_cache_import_and_export(self):
+        task = self.satisfy_task_dependencies(SpecificRelease())
+
+        build_cmd, opts = task._get_cache_opts('', 'local', '/var/cache/buildx', 'quay.io/riotkit/taiga', '2.0.5')
+
+        self.assertEqual('docker buildx build --load', build_cmd)
+        self.assertIn('--cache-to type=local,dest=/var/cache/buildx,mode=max', opts)
+
+    def test_no_cache_without_cache_source(self):
+        task = self.satisfy_task_dependencies(SpecificRelease())
+
+        self.assertEqual(('docker build', ''), task._get_cache_opts('', 'inline', '', 'quay.io/riotkit/taiga', '2.0'))
+        self.assertEqual(('docker build', ''), task._get_cache_opts('', 'classic', '', 'quay.io/riotkit/taiga', '2.0'))
+
+    def test_local_cache_without_directory_is_reported(self):
+        io = BufferedSystemIO()
+        task = self.satisfy_task_dependencies(SpecificRelease(), io=io)
+
+        self.assertIsNone(task._get_cache_opts('', 'local', '', 'quay.io/riotkit/taiga', '2.0'))
+        self.assertIn('--cache-dir is required', io.get_value())
+
+    def test_engine_api_is_passed_to_tag_and_push(self):
+        task = self.satisfy_task_dependencies(SpecificRelease(), io=BufferedSystemIO())
+        context = self.mock_execution_context(task, {
+            'dir': '.', 'dockerfile': './Dockerfile', 'dest_docker_repo': 'quay.io/riotkit/taiga',
+            'docker_version': '5.0.1', 'app_version': '5.0.1', 'docker_build_opts': '', 'no_push': False,
+            'in_process': True, 'cache_from': '', 'cache_mode': 'inline', 'cache_dir': '', 'engine_api': True
+        }, {}, defined_args={'--' + name: {'default': None} for name in ['dir', 'dockerfile', 'dest-docker-repo',
+                                                                          'docker-build-opts', 'cache-from',
+                                                                          'cache-mode', 'cache-dir']})
+
+        with mock.patch.object(task, 'silent_sh', return_value=True), \
+                mock.patch('rkt_ciutils.boatci.TaskTools.execute_in_process', return_value=True) as execute:
+            self.assertTrue(task.execute(context))
+
+        self.assertEqual([['--image=quay.io/riotkit/taiga:5.0.1', '--propagate', '--engine-api'],
+                          ['--image=quay.io/riotkit/taiga:5.0.1', '--propagate', '--git-tag=5.0.1', '--engine-api']],
+                         [call[0][2] for call in execute.call_args_list])
+
+    def test_find_closest_release_is_resolved_in_process_with_shared_tags_cache(self):
+        BaseGithubTask._tags_cache.clear()
+        FindClosestReleaseTask._version_indexes.clear()
+        task = self.satisfy_task_dependencies(SpecificRelease())
+        tags = {
+            'https://api.github.com/repos/taigaio/taiga-front-dist/tags?per_page=100': [{'name': '5.0.0'},
+                                                                                       {'name': '4.2.1'}],
+            'https://api.github.com/repos/taigaio/taiga-events/tags?per_page=100': [{'name': '5.0.2'},
+                                                                                   {'name': '4.0.0'}]
+        }
+
+        with mock.patch('rkt_ciutils.github.GithubClient.get') as get, \
+                mock.patch.object(BaseGithubTask, 'response_cache', None):
+            get.side_effect = lambda url, headers, retries, backoff: mock.Mock(status_code=200, links={}, headers={},
+                                                             json=mock.Mock(return_value=tags[url]))
+
+            resolved = [task._parse_opts('--build-arg FRONTEND=%FIND_CLOSEST_RELEASE(taigaio/taiga-front-dist)% ' +
+                                         '--build-arg EVENTS=%FIND_CLOSEST_RELEASE(taigaio/taiga-events)%', version)
+                        for version in ['5.0.1', '4.2.5']]
+
+        self.assertEqual(['--build-arg FRONTEND=5.0.0 --build-arg EVENTS=4.0.0',
+                          '--build-arg FRONTEND=4.2.1 --build-arg EVENTS=4.0.0'], resolved)
+        self.assertEqual(2, get.call_count)
+
+    def test_template_without_complete_placeholder_is_returned_as_is(self):
+        task = self.satisfy_task_dependencies(SpecificRelease())
+
+        with mock.patch('rkt_ciutils.boatci.FindClosestReleaseTask') as finder:
+            template = '--build-arg FRONTEND=%FIND_CLOSEST_RELEASE(taigaio/taiga-front-dist'
+
+            self.assertEqual(template, task._parse_opts(template, '5.0.1'))
+
+        finder.assert_not_called()
+
+
+class BuildGraphTest(BasicTestingCase):
+    def _create_images(self) -> dict:
+        root = tempfile.mkdtemp()
+        dockerfiles = {
+            'quay.io/riotkit/base': 'FROM alpine:3.11',
+            'quay.io/riotkit/php': 'ARG BASE=quay.io/riotkit/base:latest\nFROM ${BASE} AS build\nFROM build',
+            'quay.io/riotkit/assets': 'FROM node:12 AS assets',
+            'quay.io/riotkit/app': 'FROM quay.io/riotkit/php:7.4\nCOPY --from=quay.io/riotkit/assets /dist /dist\n' +
+                                   'COPY --from=0 /a /b'
+        }
+        images = {}
+
+        for image, content in dockerfiles.items():
+            path = os.path.join(root, image.split('/')[-1], 'Dockerfile')
+            os.makedirs(os.path.dirname(path))
+
+            with open(path, 'w') as f:
+                f.write(content)
+
+            images[image] = path
+
+        return images
+
+    def test_graph_is_built_from_from_and_copy_from_references(self):
+        graph = BuildGraph.create_graph(self._create_images())
+
+        self.assertEqual({
+            'quay.io/riotkit/base': set(),
+            'quay.io/riotkit/php': {'quay.io/riotkit/base'},
+            'quay.io/riotkit/assets': set(),
+            'quay.io/riotkit/app': {'quay.io/riotkit/php', 'quay.io/riotkit/assets'}
+        }, graph)
+
+        self.assertEqual([['quay.io/riotkit/assets', 'quay.io/riotkit/base'], ['quay.io/riotkit/php'],
+                          ['quay.io/riotkit/app']], BuildGraph.get_levels(graph))
+
+    def test_circular_dependency_is_reported(self):
+        with self.assertRaises(GraphException):
+            BuildGraph.get_levels({'a': {'b'}, 'b': {'a'}, 'c': set()})
+
+    def test_builds_run_in_parallel_after_dependencies_and_failure_skips_dependents(self):
+        task = self.satisfy_task_dependencies(BuildGraph(), io=BufferedSystemIO())
+        graph = {'base': set(), 'tools': set(), 'php': {'base'}, 'app': {'php', 'tools'}, 'docs': {'tools'}}
+        finished = []
+        running = []
+        max_running = [0]
+        lock = threading.Lock()
+
+        def build(image: str) -> bool:
+            with lock:
+                running.append(image)
+                max_running[0] = max(max_running[0], len(running))
+
+            time.sleep(0.05)
+
+            with lock:
+                running.remove(image)
+                finished.append(image)
+
+            return image != 'php'
+
+        results = task.build_graph(graph, build, workers=2)
+
+        self.assertEqual({'base': 'built', 'tools': 'built', 'php': 'failed', 'docs': 'built', 'app': 'skipped'},
+                         results)
+        self.assertEqual(2, max_running[0])
+        self.assertLess(finished.index('base'), finished.index('php'))
+        self.assertNotIn('app', finished)
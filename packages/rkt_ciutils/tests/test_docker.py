@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_ciutils.docker import DockerTagExistsTask
+
+
+class TokenAuthRegistryHandler(BaseHTTPRequestHandler):
+    """ Registry stand-in requiring a Bearer token, knows only riotkit/taiga:2.0 """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+
+        if self.path.startswith('/token'):
+            return self._send(200, json.dumps({'token': 'anarchy'}).encode('utf-8'))
+
+        if self.headers.get('Authorization') != 'Bearer anarchy':
+            return self._send(401, headers={'WWW-Authenticate': 'Bearer realm="http://127.0.0.1:%i/token",'
+                                                                'service="registry"' % self.server.server_port})
+
+        if self.path == '/v2/riotkit/taiga/manifests/2.0':
+            return self._send(200, b'{}', {'Docker-Content-Digest': 'sha256:abc'})
+
+        self._send(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+
+    do_HEAD = do_GET
+
+
+class DockerTagExistsTaskTest(BasicTestingCase):
+    def test_checks_manifest_with_head_request_and_reuses_token(self):
+        server = HTTPServer(('127.0.0.1', 0), TokenAuthRegistryHandler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(DockerTagExistsTask._clients.clear)
+        image = '127.0.0.1:%i/riotkit/taiga' % server.server_port
+
+        self.assertTrue(DockerTagExistsTask.tag_exists(image + ':2.0'))
+        self.assertFalse(DockerTagExistsTask.tag_exists(image + ':3.0'))
+
+        self.assertEqual([('HEAD', '/v2/riotkit/taiga/manifests/2.0'),
+                          ('GET', '/token?scope=repository%3Ariotkit%2Ftaiga%3Apull&service=registry'),
+                          ('HEAD', '/v2/riotkit/taiga/manifests/2.0'),
+                          ('HEAD', '/v2/riotkit/taiga/manifests/3.0')], server.requests)
+
+    def test_task_fails_when_registry_is_not_reachable(self):
+        io = BufferedSystemIO()
+        task = self.satisfy_task_dependencies(DockerTagExistsTask(), io=io)
+        self.addCleanup(DockerTagExistsTask._clients.clear)
+
+        result = task.execute(self.mock_execution_context(task, {'image': '127.0.0.1:1/riotkit/taiga:2.0',
+                                                                 'wait_time': '1'}, {}))
+
+        self.assertFalse(result)
+        self.assertIn('Cannot check', io.get_value())
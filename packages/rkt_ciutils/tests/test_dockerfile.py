@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import tempfile
+import unittest
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_ciutils.dockerfile import tokenize_dockerfile, parse_key_values, DockerfileSyntaxError, ExtractionCache
+from rkt_ciutils.docker import ExtractEnvsFromDockerfileTask, GenerateReadmeTask
+
+DOCKERFILE = '''FROM alpine:3.11
+
+# Application version
+ARG VERSION=5.0.1
+ARG BUILD_DATE
+
+# Database hostname
+ENV DB_HOST=localhost \\
+    # Database port
+    DB_PORT=5432 \\
+
+    DB_NAME="taiga db"
+
+# Legacy form
+ENV TAIGA_URL http://localhost:8000
+
+LABEL org.label-schema.name="Taiga" description='Project management'
+
+RUN <<EOF
+ENV NOT_A_VARIABLE=1
+EOF
+
+ENV DB_HOST=postgres
+'''
+
+
+class DockerfileTokenizerTest(unittest.TestCase):
+    def test_instructions_are_joined_and_heredoc_is_not_parsed(self):
+        instructions = list(tokenize_dockerfile(DOCKERFILE.splitlines()))
+
+        self.assertEqual(['FROM', 'ARG', 'ARG', 'ENV', 'ENV', 'LABEL', 'RUN', 'ENV'],
+                         [instruction.name for instruction in instructions])
+        self.assertEqual(['ENV NOT_A_VARIABLE=1\n'], instructions[6].heredocs)
+        self.assertEqual(23, instructions[7].line)
+
+    def test_env_both_forms_with_comments(self):
+        envs = ExtractEnvsFromDockerfileTask.get_envs(DOCKERFILE)
+
+        self.assertEqual('postgres', envs['DB_HOST'].value)
+        self.assertEqual('', envs['DB_HOST'].comment)
+        self.assertEqual(('DB_PORT', '5432', 'Database port'), envs['DB_PORT'])
+        self.assertEqual('taiga db', envs['DB_NAME'].value)
+        self.assertEqual(('TAIGA_URL', 'http://localhost:8000', 'Legacy form'), envs['TAIGA_URL'])
+        self.assertNotIn('NOT_A_VARIABLE', envs)
+
+    def test_arg_and_label(self):
+        args = ExtractEnvsFromDockerfileTask.get_envs(DOCKERFILE, 'ARG')
+        labels = ExtractEnvsFromDockerfileTask.get_envs(DOCKERFILE, 'LABEL')
+
+        self.assertEqual(('VERSION', '5.0.1', 'Application version'), args['VERSION'])
+        self.assertIsNone(args['BUILD_DATE'].value)
+        self.assertEqual('Taiga', labels['org.label-schema.name'].value)
+        self.assertEqual('Project management', labels['description'].value)
+
+    def test_escape_directive(self):
+        content = '# escape=`\nFROM mcr.microsoft.com/windows\nENV PATH=C:\\Tools `\n    HOME="C:\\Users\\app"\n'
+        instructions = list(tokenize_dockerfile(content.splitlines()))
+        pairs = parse_key_values(instructions[1])
+
+        self.assertEqual([('PATH', 'C:\\Tools'), ('HOME', 'C:\\Users\\app')], [(p.name, p.value) for p in pairs])
+
+    def test_shifts_and_here_strings_are_not_heredocs(self):
+        content = ('FROM alpine\nRUN echo $((1<<x)) && cat <<<word\nENV A=1\nRUN echo x\nENV B=2\n' +
+                   'RUN cat 2<<word\nhello\nword\n')
+        instructions = list(tokenize_dockerfile(content.splitlines()))
+
+        self.assertEqual(['FROM', 'RUN', 'ENV', 'RUN', 'ENV', 'RUN'],
+                         [instruction.name for instruction in instructions])
+        self.assertEqual([], instructions[1].heredocs)
+        self.assertEqual(['hello\n'], instructions[5].heredocs)
+        self.assertEqual({'A', 'B'}, set(ExtractEnvsFromDockerfileTask.get_envs(content).keys()))
+
+    def test_unterminated_heredoc_is_reported(self):
+        with self.assertRaises(DockerfileSyntaxError):
+            list(tokenize_dockerfile(['FROM alpine', 'RUN <<EOF', 'echo 1']))
+
+
+class BulkExtractionTest(BasicTestingCase):
+    def _create_tree(self) -> str:
+        root = tempfile.mkdtemp()
+
+        files = {'api/Dockerfile': 'ENV PORT=8000', 'web/Dockerfile.prod': 'ENV PORT=80',
+                 'web/README.md': 'ENV NOT_A_DOCKERFILE=1', 'worker/Dockerfile': 'ENV QUEUE=default'}
+
+        for name, content in files.items():
+            os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(content)
+
+        return root
+
+    def test_directory_is_parsed_into_one_document_and_cached(self):
+        root = self._create_tree()
+        cache_path = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        task = ExtractEnvsFromDockerfileTask()
+        self.satisfy_task_dependencies(task, io=BufferedSystemIO())
+
+        result = json.loads(task.extract_bulk('json', [root], workers=2, cache_path=cache_path))
+
+        self.assertEqual({
+            root + '/api/Dockerfile': {'PORT': ['PORT', '8000', '']},
+            root + '/web/Dockerfile.prod': {'PORT': ['PORT', '80', '']},
+            root + '/worker/Dockerfile': {'QUEUE': ['QUEUE', 'default', '']}
+        }, result)
+
+        # an unchanged file is answered from the cache without parsing
+        cache = ExtractionCache(cache_path)
+        path = root + '/api/Dockerfile'
+        cache.store(path, 'ENV', ExtractionCache.stat(path), {'FROM_CACHE': ['FROM_CACHE', '1', '']})
+        cache.save()
+
+        result = json.loads(task.extract_bulk('json', [root + '/*/Dockerfile'], cache_path=cache_path))
+
+        self.assertEqual({'FROM_CACHE': ['FROM_CACHE', '1', '']}, result[path])
+        self.assertEqual({'QUEUE': ['QUEUE', 'default', '']}, result[root + '/worker/Dockerfile'])
+        self.assertNotIn(root + '/web/Dockerfile.prod', result)
+
+    def test_env_format_is_rejected_for_many_dockerfiles(self):
+        io = BufferedSystemIO()
+        task = ExtractEnvsFromDockerfileTask()
+        self.satisfy_task_dependencies(task, io=io)
+
+        self.assertFalse(task.execute(self.mock_execution_context(task, {
+            'format': 'env', 'file': '', 'path': [self._create_tree()], 'instruction': 'ENV', 'workers': '',
+            'cache': '', 'no_cache': True
+        }, {})))
+        self.assertIn('Format "env" is not supported with --path', io.get_value())
+
+
+class GenerateReadmeTest(BasicTestingCase):
+    def test_batch_renders_and_writes_only_changed_targets(self):
+        root = tempfile.mkdtemp()
+
+        for name, content in {'Dockerfile': '# Listen port\nENV PORT=8000\nENV HOST=0.0.0.0\n',
+                              'README.md.j2': '{% for name, attrs in DOCKERFILE_ENVS.items() %}'
+                                              '{{ attrs[0] }}={{ attrs.value }} ({{ attrs[2] }}){% endfor %}',
+                              'SHORT.md.j2': '{{ DOCKERFILE_ENVS | length }} variables'}.items():
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(content)
+
+        task = GenerateReadmeTask()
+        self.satisfy_task_dependencies(task, io=BufferedSystemIO())
+        context = self.mock_execution_context(task, {
+            'template': '', 'dockerfile': '', 'target_path': '', 'no_bytecode_cache': False,
+            'bytecode_cache_dir': os.path.join(root, 'cache'),
+            'render': [[root + '/README.md.j2', root + '/Dockerfile', root + '/README.md'],
+                         [root + '/SHORT.md.j2', root + '/Dockerfile', root + '/SHORT.md']]
+        }, {})
+
+        self.assertTrue(task.execute(context))
+
+        with open(root + '/README.md') as f:
+            self.assertEqual('HOST=0.0.0.0 ()PORT=8000 (Listen port)', f.read())
+
+        with open(root + '/SHORT.md') as f:
+            self.assertEqual('2 variables', f.read())
+
+        self.assertTrue(os.listdir(root + '/cache'))
+
+        os.utime(root + '/README.md', (1000, 1000))
+        self.assertTrue(task.execute(context))
+        self.assertEqual(1000, os.stat(root + '/README.md').st_mtime)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import subprocess
+from rkd.api.testing import BasicTestingCase
+from rkt_ciutils.tools import GitRepository
+
+
+class GitRepositoryTest(BasicTestingCase):
+    def _git(self, path: str, cmd: list, date: str = '2020-05-01T10:00:00'):
+        env = dict(os.environ)
+        env.update({
+            'GIT_AUTHOR_NAME': 'Buenaventura Durruti', 'GIT_AUTHOR_EMAIL': 'durruti@example.org',
+            'GIT_COMMITTER_NAME': 'Buenaventura Durruti', 'GIT_COMMITTER_EMAIL': 'durruti@example.org',
+            'GIT_AUTHOR_DATE': date, 'GIT_COMMITTER_DATE': date
+        })
+
+        subprocess.check_call(['git', '-C', path] + cmd, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    def _create_repository(self) -> str:
+        path = tempfile.mkdtemp()
+
+        self._git(path, ['init', '-q'])
+        self._git(path, ['commit', '--allow-empty', '-m', 'First'])
+        self._git(path, ['tag', 'v1.0'])
+        self._git(path, ['tag', '-a', 'v1.1', '-m', 'Annotated on first'], date='2020-05-02T10:00:00')
+        self._git(path, ['commit', '--allow-empty', '-m', 'Second'])
+        self._git(path, ['tag', 'v2.0-light'])
+        self._git(path, ['tag', '-a', 'v2.0', '-m', 'Release 2.0'], date='2020-04-01T10:00:00')
+
+        return path
+
+    def test_reads_loose_objects_and_refs(self):
+        repository = GitRepository(self._create_repository())
+
+        self.assertEqual('v2.0', repository.get_current_tag())
+        self.assertEqual('v1.1', repository.get_last_tag())
+        self.assertTrue(repository.get_tags()['v1.1'].annotated)
+        self.assertFalse(repository.get_tags()['v1.0'].annotated)
+        self.assertEqual(repository.get_tags()['v1.0'].commit, repository.get_tags()['v1.1'].commit)
+
+    def test_reads_packed_refs_and_packed_objects(self):
+        path = self._create_repository()
+        self._git(path, ['gc', '-q', '--aggressive'])
+
+        self.assertFalse(os.path.isdir(os.path.join(path, '.git', 'refs', 'tags', 'v2.0')))
+        self.assertEqual(0, len(os.listdir(os.path.join(path, '.git', 'refs', 'tags'))))
+
+        repository = GitRepository(path)
+
+        self.assertEqual('v2.0', repository.get_current_tag())
+        self.assertEqual('v1.1', repository.get_last_tag())
+
+    def test_answers_are_the_same_as_from_git_cli(self):
+        path = self._create_repository()
+        self._git(path, ['checkout', '-q', 'v1.0'])
+        cwd = os.getcwd()
+
+        try:
+            os.chdir(path)
+            repository = GitRepository(path)
+
+            self.assertEqual(GitRepository._cli_current_tag(), repository.get_current_tag())
+            self.assertEqual(GitRepository._cli_last_tag(), repository.get_last_tag())
+        finally:
+            os.chdir(cwd)
+
+    def test_not_on_tag(self):
+        path = self._create_repository()
+        self._git(path, ['commit', '--allow-empty', '-m', 'Third'])
+
+        self.assertIsNone(GitRepository(os.path.join(path)).get_current_tag())
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import tempfile
+import time
+from email.utils import formatdate
+import threading
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_utils.ledger import BuildLedger
+from rkt_ciutils.boatci import EachRelease
+from rkt_ciutils.github import ForEachGithubReleaseTask, FindClosestReleaseTask, ResponseCache, GithubClient, \
+    VersionIndex, natural_sort, parse_shard
+
+
+class ForEachGithubReleaseTaskTest(BasicTestingCase):
+    def test_parallel_build_prefixes_output_and_propagates_failures(self):
+        io = BufferedSystemIO()
+        task = ForEachGithubReleaseTask()
+        self.satisfy_task_dependencies(task, io=io)
+
+        result = task.print_last_versions(
+            tags=['v3.0', 'v2.0', 'v1.0', 'v0.9', 'latest'],
+            max_versions=3,
+            allowed_tags_regexp=re.compile('v([0-9.]+)'),
+            release_tag_template='%MATCH_0%',
+            force_rebuild=True,
+            build_command='test "%GIT_TAG%" != "v2.0" && echo "built %MATCH_0%"',
+            dest_docker_repo='quay.io/riotkit/taiga',
+            dry_run=False,
+            parallel=3
+        )
+
+        self.assertFalse(result)
+        self.assertIn('[v3.0] built 3.0', io.get_value())
+        self.assertIn('[v1.0] built 1.0', io.get_value())
+        self.assertIn('[v2.0] Failed with exit code 1', io.get_value())
+        self.assertNotIn('[v0.9]', io.get_value())
+
+
+class GithubTagsHandler(BaseHTTPRequestHandler):
+    """ GitHub API stand-in, serves tags in pages of two and answers 304 for a known ETag """
+
+    TAGS = ['v3.0', 'v2.1', 'v2.0', 'v1.0', 'v0.9']
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        page = int(re.search('&page=([0-9]+)', self.path).group(1)) if '&page=' in self.path else 1
+        etag = '"page-%i"' % page
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps([{'name': name} for name in self.TAGS[(page - 1) * 2:page * 2]]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+
+        if page * 2 < len(self.TAGS):
+            self.send_header('Link', '<http://127.0.0.1:%i/repos/riotkit-org/taiga/tags?per_page=100&page=%i>; '
+                                     'rel="next"' % (self.server.server_port, page + 1))
+
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BaseGithubTaskTest(BasicTestingCase):
+    def test_tags_are_fetched_from_all_pages_and_revalidated_with_etag(self):
+        server = HTTPServer(('127.0.0.1', 0), GithubTagsHandler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%i/repos/riotkit-org/taiga' % server.server_port
+
+        try:
+            task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+            task.response_cache = ResponseCache(tempfile.mkdtemp())
+
+            self.assertEqual(GithubTagsHandler.TAGS, task._fetch_tags(url, sleep_time=0))
+            self.assertEqual(GithubTagsHandler.TAGS, task._fetch_tags(url, sleep_time=0))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual([None, None, None], [etag for path, etag in server.requests[0:3]])
+        self.assertEqual(['"page-1"', '"page-2"', '"page-3"'], [etag for path, etag in server.requests[3:]])
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    """ Answers with responses queued in the server, records the Authorization header """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        status, headers = self.server.responses.pop(0)
+        body = b'[]'
+        self.server.requests.append(self.headers.get('Authorization'))
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GithubClientTest(BasicTestingCase):
+    def _serve(self, responses: list) -> HTTPServer:
+        server = HTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+        server.responses = responses
+        server.requests = []
+        server.connections = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    def test_waits_for_rate_limit_reset_instead_of_fixed_retry_wait(self):
+        reset_at = int(time.time()) + 30
+        server = self._serve([
+            (200, {'X-RateLimit-Remaining': '1', 'X-RateLimit-Reset': str(reset_at)}),
+            (200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset_at)}),
+            (200, {'X-RateLimit-Remaining': '59', 'X-RateLimit-Reset': str(reset_at + 3600)})
+        ])
+        client = GithubClient(token='secret')
+        url = 'http://127.0.0.1:%i/repos/riotkit-org/taiga/tags' % server.server_port
+
+        with mock.patch('rkt_ciutils.github.time.sleep') as sleep:
+            for i in range(0, 3):
+                self.assertEqual(200, client.get(url).status_code)
+
+        self.assertEqual(1, sleep.call_count)
+        self.assertAlmostEqual(30, sleep.call_args[0][0], delta=2)
+        self.assertEqual(['token secret'] * 3, server.requests)
+        self.assertEqual(1, server.connections)
+
+    def test_retry_after_and_server_errors_are_retried(self):
+        server = self._serve([
+            (403, {'Retry-After': '5', 'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '0'}),
+            (502, {}),
+            (200, {})
+        ])
+        client = GithubClient()
+        url = 'http://127.0.0.1:%i/repos/riotkit-org/taiga/tags' % server.server_port
+
+        with mock.patch('rkt_ciutils.github.time.sleep') as sleep:
+            self.assertEqual(200, client.get(url, backoff=4).status_code)
+
+        waits = [call[0][0] for call in sleep.call_args_list]
+
+        self.assertAlmostEqual(5, waits[0], delta=1)  # Retry-After
+        self.assertTrue(4 <= waits[1] <= 8)             # backoff with jitter, after second attempt: 8 / 2 + rand(0, 4)
+        self.assertEqual([None, None, None], server.requests)
+
+    def test_rate_limit_without_known_reset_is_retried_with_backoff(self):
+        retry_at = formatdate(time.time() + 20, usegmt=True)
+        server = self._serve([(429, {}), (403, {'X-RateLimit-Remaining': '0'}), (429, {'Retry-After': retry_at}),
+                              (200, {})])
+        client = GithubClient()
+
+        with mock.patch('rkt_ciutils.github.time.sleep') as sleep:
+            self.assertEqual(200, client.get('http://127.0.0.1:%i/' % server.server_port, backoff=4).status_code)
+
+        waits = [call[0][0] for call in sleep.call_args_list]
+
+        self.assertEqual(3, len(waits))
+        self.assertTrue(2 <= waits[0] <= 4)    # backoff after the first attempt: 4 / 2 + rand(0, 2)
+        self.assertTrue(4 <= waits[1] <= 8)
+        self.assertAlmostEqual(20, waits[2], delta=2)  # Retry-After as an HTTP date
+
+    def test_last_error_response_is_returned_after_retries(self):
+        server = self._serve([(500, {}), (500, {})])
+
+        with mock.patch('rkt_ciutils.github.time.sleep'):
+            response = GithubClient().get('http://127.0.0.1:%i/' % server.server_port, retries=1)
+
+        self.assertEqual(500, response.status_code)
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    """ GitHub GraphQL stand-in, resolves aliased "repository" fields with cursor pagination """
+
+    TAGS = {'taigaio/taiga-front-dist': ['5.0.1', '5.0.0', '4.2.1'], 'taigaio/taiga-events': ['5.0.2']}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))['query']
+        self.server.queries.append(query)
+        data = {}
+
+        for alias, owner, name, page_size, cursor in re.findall(
+                r'(\w+): repository\(owner: "([^"]+)", name: "([^"]+)"\) {\s+refs\(refPrefix: "refs/tags/", '
+                r'first: (\d+), after: (null|"\d+")', query):
+            offset = 0 if cursor == 'null' else int(cursor.strip('"'))
+            tags = self.TAGS['%s/%s' % (owner, name)]
+            end = offset + int(page_size)
+
+            data[alias] = {'refs': {
+                'pageInfo': {'hasNextPage': end < len(tags), 'endCursor': str(end)},
+                'nodes': [{'name': tag} for tag in tags[offset:end]]
+            }}
+
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BatchTagsTest(BasicTestingCase):
+    def test_tags_of_many_repositories_are_fetched_in_one_query_per_page(self):
+        server = HTTPServer(('127.0.0.1', 0), GraphQLHandler)
+        server.queries = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = GithubClient(token='secret', graphql_url='http://127.0.0.1:%i/graphql' % server.server_port)
+        tags = client.list_tags_batch(['taigaio/taiga-front-dist', 'taigaio/taiga-events'], page_size=2)
+
+        self.assertEqual(GraphQLHandler.TAGS, tags)
+        self.assertEqual(2, len(server.queries))
+        self.assertNotIn('taiga-events', server.queries[1])  # completed repositories are not queried again
+
+    def test_prefetch_fills_the_shared_cache(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        task.github_token = 'secret'
+        ForEachGithubReleaseTask._tags_cache.clear()
+        self.addCleanup(ForEachGithubReleaseTask._tags_cache.clear)
+
+        with mock.patch.object(GithubClient, 'list_tags_batch', return_value=GraphQLHandler.TAGS) as batch:
+            task.prefetch_tags(['taigaio/taiga-front-dist', 'taigaio/taiga-events'], sleep_time=0)
+            task.prefetch_tags(['taigaio/taiga-events'], sleep_time=0)
+
+            self.assertEqual(['5.0.2'], task.get_available_tags('https://api.github.com/repos/taigaio/taiga-events', 0))
+
+        batch.assert_called_once_with(['taigaio/taiga-front-dist', 'taigaio/taiga-events'], retries=5, backoff=0)
+
+
+class VersionIndexTest(BasicTestingCase):
+    TAGS = ['5.0.1', '5.0.0', '4.2.1', '4.2.0', '4.10.0', '3.0.0-rc1', '3.0.0', 'latest']
+
+    @staticmethod
+    def _find_by_sorting(version: str, tags: list) -> str:
+        """ Previous implementation: sort everything on each lookup """
+
+        if version in tags:
+            return version
+
+        sorted_desc = list(reversed(natural_sort(tags + [version])))
+        position = sorted_desc.index(version)
+
+        if len(sorted_desc) == 1:
+            return version
+
+        if position == len(sorted_desc) - 1:
+            return sorted_desc[len(sorted_desc) - 2]
+
+        return sorted_desc[position + 1]
+
+    def test_same_answers_as_sorting_on_each_lookup(self):
+        index = VersionIndex(self.TAGS)
+
+        for version in ['5.0.5', '5.0.0', '4.3', '4.9.9', '4.10.1', '2.0', '3.0.0-rc0', '6', 'zzz', '0']:
+            with self.subTest(version=version):
+                self.assertEqual(self._find_by_sorting(version, self.TAGS), index.find_closest(version))
+
+        self.assertEqual('1.0', VersionIndex([]).find_closest('1.0'))
+
+    def test_many_versions_are_resolved_with_one_index(self):
+        FindClosestReleaseTask._version_indexes.clear()
+        self.addCleanup(FindClosestReleaseTask._version_indexes.clear)
+        io = BufferedSystemIO()
+        task = self.satisfy_task_dependencies(FindClosestReleaseTask(), io=io)
+
+        with mock.patch.object(task, 'get_repository_tags', return_value=list(self.TAGS)) as get_tags:
+            task.execute(self.mock_execution_context(task, {
+                'repository': 'taigaio/taiga-front-dist', 'compare_with': ['5.0.5', '4.2.5'], 'retry_wait': '0',
+                'retries': '0', 'token': '', 'no_http_cache': True, 'http_cache_dir': '', 'tag_source': 'github',
+                'git_remote': ''
+            }, {}))
+
+        self.assertIn('5.0.5 5.0.1\n4.2.5 4.2.1', io.get_value())
+        get_tags.assert_called_once_with('taigaio/taiga-front-dist', 0, 0)
+
+
+class RemoteTagsTest(BasicTestingCase):
+    def test_dont_rebuild_checks_releases_against_tags_listed_once(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        task.existence_check = 'tags-list'
+        self.addCleanup(ForEachGithubReleaseTask._remote_tags.clear)
+
+        with mock.patch('rkt_ciutils.github.DockerTagExistsTask.get_client') as get_client:
+            get_client.return_value.list_tags.return_value = ['3.0', '1.0', 'latest']
+
+            plan = task.plan_releases(
+                tags=['v3.0', 'v2.0', 'v1.0'],
+                max_versions=3,
+                allowed_tags_regexp=re.compile('v([0-9.]+)'),
+                release_tag_template='%MATCH_0%',
+                force_rebuild=False,
+                build_command='echo',
+                dest_docker_repo='quay.io/riotkit/taiga'
+            )
+
+        self.assertEqual([True, False, True], [release.already_built for release in plan])
+        get_client.assert_called_once_with('quay.io')
+        get_client.return_value.list_tags.assert_called_once_with('riotkit/taiga')
+
+
+class LazyPipelineTest(BasicTestingCase):
+    def test_next_pages_are_not_fetched_when_enough_releases_were_found(self):
+        server = HTTPServer(('127.0.0.1', 0), GithubTagsHandler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        task.response_cache = None
+        url = 'http://127.0.0.1:%i/repos/riotkit-org/taiga' % server.server_port
+        pages = task._iter_tag_pages(url, sleep_time=0)
+        tags = (tag for page in pages for tag in page)
+
+        plan = task.plan_releases(tags, 3, re.compile('v([0-9.]+)'), '%MATCH_0%', True, 'echo', 'riotkit/taiga')
+
+        self.assertEqual(['v3.0', 'v2.1', 'v2.0'], [release.git_tag for release in plan])
+        self.assertEqual(2, len(server.requests))  # third page was never requested
+
+    def test_version_sort_takes_highest_versions(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+
+        plan = task.plan_releases(['v1.10', 'latest', 'v2.0', 'v1.9', 'v2.0', 'v0.1'], 3, re.compile('v([0-9.]+)'),
+                                  '%MATCH_0%', True, 'echo', 'riotkit/taiga', sort='version')
+
+        self.assertEqual(['2.0', '1.10', '1.9'], [release.release_tag for release in plan])
+
+    def test_version_sort_with_versions_prefixing_each_other(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        tags = ['beta', 'v1.0-rc', 'beta2', 'v1.0-rc1', 'v0.9']
+
+        for max_versions in [3, 0]:
+            plan = task.plan_releases(tags, max_versions, re.compile('v?(.+)'), '%MATCH_0%', True, 'echo',
+                                      'riotkit/taiga', sort='version')
+
+            self.assertEqual(['beta2', 'beta', '1.0-rc1'], [release.release_tag for release in plan][0:3])
+
+
+class ShardingTest(BasicTestingCase):
+    TAGS = ['v3.0', 'v2.1', 'v2.0', 'v1.1', 'v1.0', 'v0.9', 'v0.8']
+
+    def _plan(self, tags: list, shard: str, plan_out: str = None) -> list:
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        plan = task.plan_releases(tags, 6, re.compile('v([0-9.]+)'), '%MATCH_0%', True, 'echo %MATCH_0%',
+                                  'riotkit/taiga', shard=parse_shard(shard))
+
+        if plan_out:
+            task.write_plan(plan_out, plan, parse_shard(shard))
+
+        return [release.git_tag for release in plan]
+
+    def test_shards_split_selected_releases_without_overlap(self):
+        shards = [self._plan(self.TAGS, '%i/3' % index) for index in range(1, 4)]
+
+        self.assertEqual(['v3.0', 'v1.1'], shards[0])
+        self.assertEqual(sorted(self.TAGS[0:6]), sorted(shards[0] + shards[1] + shards[2]))
+        self.assertEqual(shards, [self._plan(list(reversed(self.TAGS[0:6])), '%i/3' % index) for index in range(1, 4)])
+
+    def test_release_candidates_are_sharded(self):
+        tags = ['v2.0-rc1', 'v2.0-rc', 'v2.0', 'v1.0-rc', 'v1.0-rc1']
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        shards = [[release.git_tag for release in task.plan_releases(
+            tags, 0, re.compile('v(.+)'), '%MATCH_0%', True, 'echo', 'riotkit/taiga', shard=parse_shard('%i/2' % index)
+        )] for index in [1, 2]]
+
+        self.assertEqual([['v2.0-rc1', 'v2.0', 'v1.0-rc'], ['v2.0-rc', 'v1.0-rc1']], shards)
+
+    def test_plan_is_written_as_json(self):
+        path = os.path.join(tempfile.mkdtemp(), 'plan.json')
+        self._plan(self.TAGS, '2/3', plan_out=path)
+
+        with open(path, 'rb') as f:
+            plan = json.loads(f.read().decode('utf-8'))
+
+        self.assertEqual('2/3', plan['shard'])
+        self.assertEqual({'git_tag': 'v2.1', 'release_tag': '2.1', 'command': 'echo 2.1', 'already_built': False},
+                         plan['releases'][0])
+
+    def test_invalid_shard(self):
+        for shard in ['0/3', '4/3', '1', 'a/b']:
+            with self.subTest(shard=shard):
+                self.assertRaises(Exception, lambda: parse_shard(shard))
+
+
+class BuildLedgerLookupTest(BasicTestingCase):
+    def test_ledger_is_asked_before_the_registry(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        task.ledger = BuildLedger(os.path.join(tempfile.mkdtemp(), 'builds.sqlite3'))
+        task.ledger.record('quay.io/riotkit/taiga:3.0', git_tag='v3.0')
+
+        with mock.patch('rkt_ciutils.github.DockerTagExistsTask.tag_exists', side_effect=[True, False]) as exists:
+            self.assertTrue(task.was_already_built('quay.io/riotkit/taiga', '3.0'))
+            self.assertTrue(task.was_already_built('quay.io/riotkit/taiga', '2.0'))   # registry: exists
+            self.assertFalse(task.was_already_built('quay.io/riotkit/taiga', '1.0'))  # registry: does not exist
+
+        self.assertEqual(['quay.io/riotkit/taiga:2.0', 'quay.io/riotkit/taiga:1.0'],
+                         [call[0][0] for call in exists.call_args_list])
+        self.assertTrue(task.ledger.contains('quay.io/riotkit/taiga:2.0'))
+
+    def test_verify_corrects_the_ledger(self):
+        task = self.satisfy_task_dependencies(ForEachGithubReleaseTask())
+        task.ledger = BuildLedger(os.path.join(tempfile.mkdtemp(), 'builds.sqlite3'))
+        task.ledger.record('quay.io/riotkit/taiga:3.0')
+        task.verify_ledger = True
+
+        with mock.patch('rkt_ciutils.github.DockerTagExistsTask.tag_exists', return_value=False):
+            self.assertFalse(task.was_already_built('quay.io/riotkit/taiga', '3.0'))
+
+        self.assertFalse(task.ledger.contains('quay.io/riotkit/taiga:3.0'))
+
+    def test_in_process_build_plan_uses_the_ledger_and_closes_it(self):
+        path = os.path.join(tempfile.mkdtemp(), 'builds.sqlite3')
+
+        with BuildLedger(path) as ledger:
+            ledger.record('quay.io/riotkit/taiga:3.0')
+
+        task = self.satisfy_task_dependencies(EachRelease())
+
+        with mock.patch.object(ForEachGithubReleaseTask, 'get_available_tags', return_value=['3.0', '2.0']), \
+                mock.patch('rkt_ciutils.github.DockerTagExistsTask.tag_exists', return_value=False) as exists, \
+                mock.patch.object(BuildLedger, 'close', autospec=True, side_effect=BuildLedger.close) as close:
+            plan = task.create_build_plan('taigaio/taiga-back', '([0-9.]+)', 'quay.io/riotkit/taiga', 2, '%MATCH_0%',
+                                          'build %MATCH_0%', rebuild=False, ledger_path=path)
+
+        self.assertEqual([('3.0', True), ('2.0', False)],
+                         [(release.git_tag, release.already_built) for release in plan])
+        exists.assert_called_once_with('quay.io/riotkit/taiga:2.0')
+        close.assert_called_once()
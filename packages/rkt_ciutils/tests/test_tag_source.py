@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import subprocess
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_ciutils.github import FindClosestReleaseTask, LsRemoteTagSource, LocalCloneTagSource, TagSourceException
+
+
+class TagSourceTest(BasicTestingCase):
+    def _git(self, path: str, cmd: list) -> str:
+        env = dict(os.environ)
+        env.update({
+            'GIT_AUTHOR_NAME': 'Lucy Parsons', 'GIT_AUTHOR_EMAIL': 'lucy@example.org',
+            'GIT_COMMITTER_NAME': 'Lucy Parsons', 'GIT_COMMITTER_EMAIL': 'lucy@example.org'
+        })
+
+        return subprocess.check_output(['git', '-C', path] + cmd, env=env, stderr=subprocess.DEVNULL).decode('utf-8')
+
+    def _create_bare_repository(self) -> str:
+        """ Creates <tmp>/riotkit-org/taiga.git with tags 4.2.1, 5.0.0 (annotated), 5.0.1 """
+
+        work = tempfile.mkdtemp()
+        bare = os.path.join(tempfile.mkdtemp(), 'riotkit-org', 'taiga.git')
+
+        self._git(work, ['init', '-q'])
+        self._git(work, ['commit', '--allow-empty', '-m', 'First'])
+        self._git(work, ['tag', '4.2.1'])
+        self._git(work, ['commit', '--allow-empty', '-m', 'Second'])
+        self._git(work, ['tag', '-a', '5.0.0', '-m', 'Release 5.0.0'])
+        self._git(work, ['commit', '--allow-empty', '-m', 'Third'])
+        self._git(work, ['tag', '5.0.1'])
+        subprocess.check_call(['git', 'clone', '-q', '--bare', work, bare], stderr=subprocess.DEVNULL)
+
+        return bare
+
+    def test_sources_return_the_same_peeled_commits(self):
+        bare = self._create_bare_repository()
+        expected = {tag: self._git(bare, ['rev-parse', tag + '^{commit}']).strip()
+                    for tag in ['4.2.1', '5.0.0', '5.0.1']}
+
+        self.assertEqual(expected, LsRemoteTagSource(bare).get_tag_commits(bare))
+        self.assertEqual(expected, LocalCloneTagSource(bare).get_tag_commits(bare))
+        self.assertEqual(['5.0.1', '5.0.0', '4.2.1'], LsRemoteTagSource(bare).get_tags(bare))
+
+    def test_find_closest_release_using_a_local_clone(self):
+        bare = self._create_bare_repository()
+        template = bare.replace('riotkit-org/taiga', '%REPOSITORY%')
+
+        for source in ['ls-remote', 'clone']:
+            io = BufferedSystemIO()
+            task = self.satisfy_task_dependencies(FindClosestReleaseTask(), io=io)
+            args = {'repository': 'riotkit-org/taiga', 'compare_with': '5.0.5', 'retry_wait': '0', 'retries': '0',
+                    'token': '', 'no_http_cache': True, 'http_cache_dir': '', 'tag_source': source,
+                    'git_remote': template}
+
+            with self.subTest(source=source):
+                task.execute(self.mock_execution_context(task, args, {}))
+                self.assertEqual('5.0.1', io.get_value().strip().splitlines()[-1])
+
+    def test_version_index_is_not_shared_between_remotes(self):
+        first = self._create_bare_repository()
+        second = self._create_bare_repository()
+        self._git(second, ['tag', '6.0.0', '5.0.1'])
+        FindClosestReleaseTask._version_indexes.clear()
+        self.addCleanup(FindClosestReleaseTask._version_indexes.clear)
+        found = []
+
+        for bare in [first, second]:
+            task = self.satisfy_task_dependencies(FindClosestReleaseTask())
+            task.tag_source = LocalCloneTagSource(bare.replace('riotkit-org/taiga', '%REPOSITORY%'))
+            found.append(task.find_closest_version('7.0.0', 'riotkit-org/taiga', sleep_time=0, retries=0))
+
+        self.assertEqual(['5.0.1', '6.0.0'], found)
+
+    def test_not_existing_remote_is_reported(self):
+        with self.assertRaises(TagSourceException):
+            LsRemoteTagSource('').get_tag_commits(os.path.join(tempfile.mkdtemp(), 'not-existing.git'))
+
+    def test_directory_inside_other_repository_is_not_read_as_clone(self):
+        work = tempfile.mkdtemp()
+        self._git(work, ['init', '-q'])
+        self._git(work, ['commit', '--allow-empty', '-m', 'First'])
+        self._git(work, ['tag', '1.0'])
+        os.makedirs(os.path.join(work, 'mirrors', 'taiga'))
+
+        with self.assertRaises(TagSourceException):
+            LocalCloneTagSource('').get_tag_commits(os.path.join(work, 'mirrors', 'taiga'))
+
+        self.assertEqual(['1.0'], list(LocalCloneTagSource('').get_tag_commits(work).keys()))
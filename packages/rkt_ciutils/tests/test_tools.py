@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_utils.docker import TagImageTask
+from rkt_ciutils.tools import TaskTools
+
+
+class TaskToolsTest(BasicTestingCase):
+    def test_parse_rkd_command(self):
+        self.assertEqual(
+            (':boat-ci:each-release', ['-rl', 'info', '--version-template=%MATCH_0%-SNAPSHOT']),
+            TaskTools.parse_rkd_command('rkd --no-ui :boat-ci:each-release -rl info ' +
+                                        '--version-template="%MATCH_0%-SNAPSHOT"')
+        )
+
+    def test_commands_that_need_shell_are_not_parsed(self):
+        self.assertIsNone(TaskTools.parse_rkd_command('set -x; rkd :boat-ci:each-release'))
+        self.assertIsNone(TaskTools.parse_rkd_command('rkd :docker:tag --image=$IMAGE'))
+        self.assertIsNone(TaskTools.parse_rkd_command('rkd :docker:tag :docker:push'))
+        self.assertIsNone(TaskTools.parse_rkd_command('make build'))
+        self.assertIsNone(TaskTools.parse_rkd_command('rkd :docker:tag --image=taiga -rw /srv/app'))
+        self.assertIsNone(TaskTools.parse_rkd_command('rkd :docker:tag --image=taiga --become=root'))
+
+    def test_execute_in_process_parses_arguments_like_commandline(self):
+        parent = self.satisfy_task_dependencies(TagImageTask())
+        executed = []
+
+        class RecordingTagImageTask(TagImageTask):
+            def execute(self, context) -> bool:
+                executed.append(self.plan_images(context))
+                return True
+
+        result = TaskTools.execute_in_process(parent, RecordingTagImageTask(),
+                                              ['--image=quay.io/riotkit/taiga:2.1', '--propagate',
+                                               '--without-global-latest'], {})
+
+        self.assertTrue(result)
+        self.assertEqual([[('quay.io/riotkit/taiga:2.1', ['quay.io/riotkit/taiga:2.1', 'quay.io/riotkit/taiga:2'])]],
+                         executed)
+
+
+    def test_invalid_arguments_fail_only_the_task(self):
+        io = BufferedSystemIO()
+        parent = self.satisfy_task_dependencies(TagImageTask(), io=io)
+
+        self.assertFalse(TaskTools.execute_in_process(parent, TagImageTask(), ['--not-existing-switch'], {}))
+        self.assertIn('Invalid arguments for :docker:tag', io.get_value())
@@ -4,6 +4,7 @@ import subprocess
 from argparse import ArgumentParser
 from typing import Callable
 from rkd.api.contract import TaskInterface, ExecutionContext
+from .dbprobe import probe_mysql, probe_postgres, ProbeException
 
 
 class WaitForDatabaseTask(TaskInterface):
@@ -23,16 +24,22 @@ class WaitForDatabaseTask(TaskInterface):
             user=context.args['username'],
             password=context.args['password'],
             port=int(context.args['port']),
-            host=context.args['host']
+            host=context.args['host'],
+            checker=context.args.get('checker') or 'native'
         )
 
     def _get_checker_command(self, db_type: str, db_name: str, user: str,
-                             password: str, host: str, port: int) -> Callable:
+                             password: str, host: str, port: int, checker: str = 'native') -> Callable:
         """
         Detect which checking command fits best
         :return:
         """
 
+        if checker == 'native' and db_type in ['mysql', 'postgres']:
+            self._io.debug(' >> Built-in %s protocol probe was selected' % db_type)
+            return self.get_native_probe(probe_mysql if db_type == 'mysql' else probe_postgres,
+                                         db_name=db_name, user=user, password=password, host=host, port=port)
+
         if db_type == 'mysql':
             if self.is_mysql_tool_available() and user:
                 self._io.debug(' >> MySQL tool checker was selected')
@@ -52,10 +59,10 @@ class WaitForDatabaseTask(TaskInterface):
         raise Exception('Unsupported database type. Only mysql and postgres are supported.')
 
     def check_if_instance_is_alive(self, db_type: str, db_name: str, user: str,
-                                   password: str, host: str, port: int, timeout: int) -> bool:
+                                   password: str, host: str, port: int, timeout: int, checker: str = 'native') -> bool:
 
         checker = self._get_checker_command(db_type=db_type, db_name=db_name, user=user, password=password,
-                                            host=host, port=port)
+                                            host=host, port=port, checker=checker)
         time_left = timeout
 
         while time_left != 0:
@@ -69,6 +76,21 @@ class WaitForDatabaseTask(TaskInterface):
         self._io.error_msg(' >> Error: The DB is still down')
         return False
 
+    def get_native_probe(self, probe: Callable, db_name: str, user: str, password: str, host: str,
+                         port: int) -> Callable:
+        """ Talks the database protocol directly over a socket, no client tools and no shell are needed """
+
+        def check() -> bool:
+            try:
+                return probe(host=host, port=port, user=user or '', password=password or '', db_name=db_name or '',
+                             timeout=1)
+
+            except (OSError, ProbeException) as e:
+                self._io.debug(' >> %s' % str(e))
+                return False
+
+        return check
+
     def get_wait_command_for_mysql(self, host: str, port: int, user: str, password: str) -> Callable:
         return lambda: self.is_command_of_success_code(
             'mysql ' +
@@ -142,3 +164,8 @@ class WaitForDatabaseTask(TaskInterface):
         parser.add_argument('--timeout', '-T',
                             help='Timeout in seconds (optional, defaults to 15)',
                             default=15)
+        parser.add_argument('--checker', '-c',
+                            help='How to check: native (built-in protocol probe, default), ' +
+                                 'tools (mysql, pg_isready or nc commands)',
+                            choices=['native', 'tools'],
+                            default='native')
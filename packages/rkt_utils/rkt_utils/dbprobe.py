@@ -0,0 +1,349 @@
+import os
+import ssl
+import hmac
+import base64
+import socket
+import struct
+import hashlib
+from functools import wraps
+from typing import Callable, Tuple, Union
+
+
+class ProbeException(Exception):
+    pass
+
+
+MYSQL_CLIENT_LONG_PASSWORD = 0x1
+MYSQL_CLIENT_CONNECT_WITH_DB = 0x8
+MYSQL_CLIENT_PROTOCOL_41 = 0x200
+MYSQL_CLIENT_SECURE_CONNECTION = 0x8000
+MYSQL_CLIENT_PLUGIN_AUTH = 0x80000
+
+POSTGRES_SSL_REQUEST = 80877103
+POSTGRES_PROTOCOL_3 = 196608
+
+# errors that prove the server accepts connections, when credentials were not given
+POSTGRES_ACCEPTING_ERRORS = ['28000', '28P01', '3D000']
+
+
+def open_socket(host: str, port: int, timeout: float) -> socket.socket:
+    """
+    Connects over TCP, or to a UNIX socket when the host is a path.
+    A directory is treated like in libpq - the socket is <directory>/.s.PGSQL.<port>
+    """
+
+    if host.startswith('/') or host.startswith('.'):
+        path = os.path.join(host, '.s.PGSQL.%i' % port) if os.path.isdir(host) else host
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(path)
+
+        return sock
+
+    return socket.create_connection((host, port), timeout=timeout)
+
+
+def _malformed_answer_as_probe_exception(database: str) -> Callable:
+    """
+    An empty or truncated packet (proxy, half started server, other service on the port) is reported
+    as ProbeException, so the caller retries like for any other not ready server
+    """
+
+    def decorator(probe: Callable) -> Callable:
+        @wraps(probe)
+        def wrapper(*args, **kwargs) -> bool:
+            try:
+                return probe(*args, **kwargs)
+
+            except (IndexError, KeyError, ValueError, struct.error) as e:
+                raise ProbeException('Malformed answer from %s: %s' % (database, str(e) or type(e).__name__))
+
+        return wrapper
+
+    return decorator
+
+
+@_malformed_answer_as_probe_exception('MySQL')
+def probe_mysql(host: str, port: int, user: str = '', password: str = '', db_name: str = '',
+                timeout: float = 1) -> bool:
+    """
+    Reads the initial handshake packet, without credentials that is enough to tell the server is up.
+    With credentials a HandshakeResponse41 is sent (mysql_native_password or caching_sha2_password)
+
+    When caching_sha2_password requests full authentication (password not cached on the server yet),
+    the server is treated as ready - it requires TLS or RSA to continue, which is out of scope of a probe.
+    """
+
+    with open_socket(host, port, timeout) as sock:
+        sequence, payload = _read_mysql_packet(sock)
+
+        if payload[0] == 0xff:
+            raise ProbeException('MySQL refused the connection: %s' % _mysql_error(payload))
+
+        if payload[0] != 10:
+            raise ProbeException('Not a MySQL handshake, protocol version %i' % payload[0])
+
+        version_end = payload.index(b'\0', 1)
+        position = version_end + 1 + 4
+        nonce = payload[position:position + 8]
+        position += 8 + 1
+        capabilities = struct.unpack('<H', payload[position:position + 2])[0]
+        position += 2 + 1 + 2
+        capabilities |= struct.unpack('<H', payload[position:position + 2])[0] << 16
+        auth_data_length = payload[position + 2]
+        position += 2 + 1 + 10
+        second_part_length = max(13, auth_data_length - 8)
+        nonce += payload[position:position + second_part_length].rstrip(b'\0')
+        position += second_part_length
+        plugin = payload[position:].split(b'\0')[0].decode('utf-8') \
+            if capabilities & MYSQL_CLIENT_PLUGIN_AUTH else 'mysql_native_password'
+
+        if not user:
+            return True
+
+        flags = MYSQL_CLIENT_LONG_PASSWORD | MYSQL_CLIENT_PROTOCOL_41 | MYSQL_CLIENT_SECURE_CONNECTION | \
+            MYSQL_CLIENT_PLUGIN_AUTH | (MYSQL_CLIENT_CONNECT_WITH_DB if db_name else 0)
+        auth_response = _mysql_scramble(plugin, password, nonce)
+
+        response = struct.pack('<IIB23x', flags, 16777216, 33) + user.encode('utf-8') + b'\0' + \
+            bytes([len(auth_response)]) + auth_response + \
+            (db_name.encode('utf-8') + b'\0' if db_name else b'') + plugin.encode('utf-8') + b'\0'
+
+        sequence = _write_mysql_packet(sock, sequence + 1, response)
+
+        while True:
+            sequence, payload = _read_mysql_packet(sock)
+
+            # OK
+            if payload[0] == 0x00:
+                _quit(sock, struct.pack('<I', 1)[0:3] + b'\x00\x01')  # COM_QUIT
+                return True
+
+            if payload[0] == 0xff:
+                raise ProbeException('MySQL authentication failed: %s' % _mysql_error(payload))
+
+            # auth switch request: other plugin, new nonce
+            if payload[0] == 0xfe:
+                plugin, nonce = payload[1:].split(b'\0')[0].decode('utf-8'), payload[1:].split(b'\0', 1)[1]
+                sequence = _write_mysql_packet(sock, sequence + 1,
+                                               _mysql_scramble(plugin, password, nonce.rstrip(b'\0')))
+                continue
+
+            # caching_sha2_password: 0x03 fast auth succeeded (OK follows), 0x04 full auth required
+            if payload[0] == 0x01 and payload[1:2] == b'\x04':
+                return True
+
+            if payload[0] == 0x01 and payload[1:2] == b'\x03':
+                continue
+
+            raise ProbeException('Unexpected MySQL packet 0x%02x during authentication' % payload[0])
+
+
+@_malformed_answer_as_probe_exception('PostgreSQL')
+def probe_postgres(host: str, port: int, user: str = '', password: str = '', db_name: str = '',
+                   timeout: float = 1) -> bool:
+    """
+    Sends SSLRequest (TCP only) and StartupMessage, then interprets the reply like pg_isready does:
+    a server that is starting up, shutting down or in recovery is not ready.
+
+    Without credentials any authentication request (or a rejected login) proves the server accepts connections.
+    With credentials cleartext, MD5 and SCRAM-SHA-256 authentication is performed until ReadyForQuery
+    """
+
+    sock = open_socket(host, port, timeout)
+
+    try:
+        if not host.startswith('/') and not host.startswith('.'):
+            sock.sendall(struct.pack('!II', 8, POSTGRES_SSL_REQUEST))
+            answer = _receive(sock, 1)
+
+            if answer == b'S':
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock, server_hostname=host)
+
+            elif answer != b'N':
+                raise ProbeException('Not a PostgreSQL server, unexpected answer to SSLRequest: %r' % answer)
+
+        login = user if user else 'postgres'
+        parameters = b'user\0' + login.encode('utf-8') + b'\0' + \
+            (b'database\0' + db_name.encode('utf-8') + b'\0' if db_name else b'') + b'\0'
+        sock.sendall(struct.pack('!II', 8 + len(parameters), POSTGRES_PROTOCOL_3) + parameters)
+        scram = None
+
+        while True:
+            message_type, payload = _read_postgres_message(sock)
+
+            if message_type == b'E':
+                fields = _postgres_error_fields(payload)
+
+                if not user and fields.get('C') in POSTGRES_ACCEPTING_ERRORS:
+                    return True
+
+                raise ProbeException('PostgreSQL: %s (%s)' % (fields.get('M', ''), fields.get('C', '')))
+
+            if message_type == b'Z':
+                _quit(sock, b'X' + struct.pack('!I', 4))  # Terminate
+                return True
+
+            if message_type != b'R':
+                continue
+
+            code = struct.unpack('!I', payload[0:4])[0]
+
+            if code == 0:
+                continue
+
+            if not user:
+                return True
+
+            if code == 3:
+                _write_postgres_message(sock, b'p', password.encode('utf-8') + b'\0')
+
+            elif code == 5:
+                inner = hashlib.md5(password.encode('utf-8') + login.encode('utf-8')).hexdigest()
+                outer = hashlib.md5(inner.encode('utf-8') + payload[4:8]).hexdigest()
+                _write_postgres_message(sock, b'p', b'md5' + outer.encode('utf-8') + b'\0')
+
+            elif code == 10:
+                if b'SCRAM-SHA-256\0' not in payload[4:]:
+                    raise ProbeException('No supported SASL mechanism offered by PostgreSQL')
+
+                scram = ScramClient(password)
+                first = scram.client_first()
+                _write_postgres_message(sock, b'p', b'SCRAM-SHA-256\0' + struct.pack('!I', len(first)) + first)
+
+            elif code == 11 and scram:
+                _write_postgres_message(sock, b'p', scram.client_final(payload[4:]))
+
+            elif code == 12 and scram:
+                scram.verify_server_final(payload[4:])
+
+            else:
+                raise ProbeException('Unsupported PostgreSQL authentication method %i' % code)
+    finally:
+        sock.close()
+
+
+class ScramClient(object):
+    """ SCRAM-SHA-256 client side (RFC 7677), as used by PostgreSQL. The user name is taken from StartupMessage """
+
+    def __init__(self, password: str, nonce: str = None):
+        self.password = password
+        self.nonce = nonce if nonce else base64.b64encode(os.urandom(18)).decode('ascii')
+        self.client_first_bare = 'n=,r=' + self.nonce
+        self.auth_message = None
+        self.salted_password = None
+
+    def client_first(self) -> bytes:
+        return ('n,,' + self.client_first_bare).encode('utf-8')
+
+    def client_final(self, server_first: bytes) -> bytes:
+        attributes = dict([part.split('=', 1) for part in server_first.decode('utf-8').split(',')])
+
+        if not attributes['r'].startswith(self.nonce):
+            raise ProbeException('SCRAM: server nonce does not match')
+
+        self.salted_password = hashlib.pbkdf2_hmac('sha256', self.password.encode('utf-8'),
+                                                   base64.b64decode(attributes['s']), int(attributes['i']))
+        without_proof = 'c=biws,r=' + attributes['r']
+        self.auth_message = ','.join([self.client_first_bare, server_first.decode('utf-8'), without_proof])
+
+        client_key = hmac.new(self.salted_password, b'Client Key', hashlib.sha256).digest()
+        signature = hmac.new(hashlib.sha256(client_key).digest(), self.auth_message.encode('utf-8'),
+                             hashlib.sha256).digest()
+        proof = bytes([a ^ b for a, b in zip(client_key, signature)])
+
+        return (without_proof + ',p=' + base64.b64encode(proof).decode('ascii')).encode('utf-8')
+
+    def verify_server_final(self, server_final: bytes):
+        server_key = hmac.new(self.salted_password, b'Server Key', hashlib.sha256).digest()
+        expected = hmac.new(server_key, self.auth_message.encode('utf-8'), hashlib.sha256).digest()
+
+        if server_final.decode('utf-8') != 'v=' + base64.b64encode(expected).decode('ascii'):
+            raise ProbeException('SCRAM: invalid server signature')
+
+
+def _mysql_scramble(plugin: str, password: str, nonce: bytes) -> bytes:
+    if not password:
+        return b''
+
+    nonce = nonce[0:20]
+
+    if plugin == 'caching_sha2_password':
+        first = hashlib.sha256(password.encode('utf-8')).digest()
+        second = hashlib.sha256(hashlib.sha256(first).digest() + nonce).digest()
+
+        return bytes([a ^ b for a, b in zip(first, second)])
+
+    if plugin == 'mysql_native_password':
+        first = hashlib.sha1(password.encode('utf-8')).digest()
+        second = hashlib.sha1(nonce + hashlib.sha1(first).digest()).digest()
+
+        return bytes([a ^ b for a, b in zip(first, second)])
+
+    raise ProbeException('Unsupported MySQL authentication plugin "%s"' % plugin)
+
+
+def _mysql_error(payload: bytes) -> str:
+    """ ERR packet: 0xff, error code, optional "#" + SQL state, message """
+
+    code = struct.unpack('<H', payload[1:3])[0]
+    message = payload[3:]
+
+    if message.startswith(b'#'):
+        message = message[6:]
+
+    return '%i %s' % (code, message.decode('utf-8', errors='replace'))
+
+
+def _read_mysql_packet(sock: socket.socket) -> Tuple[int, bytes]:
+    header = _receive(sock, 4)
+    length = header[0] | header[1] << 8 | header[2] << 16
+
+    return header[3], _receive(sock, length)
+
+
+def _write_mysql_packet(sock: socket.socket, sequence: int, payload: bytes) -> int:
+    sock.sendall(struct.pack('<I', len(payload))[0:3] + bytes([sequence % 256]) + payload)
+
+    return sequence
+
+
+def _read_postgres_message(sock: Union[socket.socket, ssl.SSLSocket]) -> Tuple[bytes, bytes]:
+    header = _receive(sock, 5)
+
+    return header[0:1], _receive(sock, struct.unpack('!I', header[1:5])[0] - 4)
+
+
+def _write_postgres_message(sock: Union[socket.socket, ssl.SSLSocket], message_type: bytes, payload: bytes):
+    sock.sendall(message_type + struct.pack('!I', len(payload) + 4) + payload)
+
+
+def _postgres_error_fields(payload: bytes) -> dict:
+    return {field[0:1].decode('utf-8'): field[1:].decode('utf-8', errors='replace')
+            for field in payload.split(b'\0') if field}
+
+
+def _quit(sock: Union[socket.socket, ssl.SSLSocket], message: bytes):
+    """ Polite goodbye, the server may have closed the connection already """
+
+    try:
+        sock.sendall(message)
+    except OSError:
+        pass
+
+
+def _receive(sock: Union[socket.socket, ssl.SSLSocket], length: int) -> bytes:
+    data = b''
+
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+
+        if not chunk:
+            raise ProbeException('Connection closed by the server')
+
+        data += chunk
+
+    return data
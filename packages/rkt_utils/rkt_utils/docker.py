@@ -1,82 +1,40 @@
-
-import re
+import os
+import json
 from argparse import ArgumentParser
 from abc import ABC
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union
 from subprocess import CalledProcessError
 from rkd.api.contract import TaskInterface, ExecutionContext
 from rkd.api.syntax import TaskDeclaration
+from .registry import RegistryClient, RegistryException, parse_image
+from .engine import EngineClient, EngineException, find_engine_socket, split_image_tag
+from .tagging import TagPlanner
+from .ledger import BuildLedger
 
 
 class DockerBaseTask(TaskInterface, ABC):
+    _engine_socket = None  # type: Union[str, None]
+    _planners = {}  # type: Dict[str, TagPlanner]
+
     def calculate_images(self, image: str, latest_per_version: bool, global_latest: bool, allowed_meta_list: str,
                          keep_prefix: bool):
         """ Calculate tags propagation """
 
-        allowed_meta = allowed_meta_list.replace(' ', '').split(',')
-        tag = image.split(':')[-1]
-
-        # output
-        output_tags = [image]
-
-        pattern = re.compile('(?P<version>[0-9.]+)(-(?P<meta>[A-Za-z]+))?(?P<metanum>[0-9]+)?', re.IGNORECASE)
-        matches = [m.groupdict() for m in pattern.finditer(tag)]
-
-        if not matches:
-            self._io.warn('No release version found')
-            return output_tags
-
-        meta_type = matches[0]['meta']
-        meta_number = matches[0]['metanum']
-
-        if meta_type and meta_type not in allowed_meta:
-            self.io().warn('Version meta part is not allowed, not calculating propagation')
-            return output_tags
-
-        original_tag = tag
-        base_version = matches[0]['version']
-        optional_prefix = tag[0:tag.find(matches[0]['version'])]
-        base_version_with_optional_prefix = optional_prefix + base_version
-        meta = '-' + meta_type if meta_type else None
-        to_strip_at_beginning = optional_prefix if not keep_prefix else ''
-
-        # :latest
-        if global_latest:
-            output_tags.append(image.replace(original_tag, 'latest'))
-
-        # case 1: 1.0.0-RC1 -> 1.0.0-latest-RC
-        if meta and meta_number:
-            output_tags = self.generate_tags_for_numbered_pre_release(
-                output_tags=output_tags,
-                base_version_with_optional_prefix=base_version_with_optional_prefix,
-                original_tag=original_tag,
-                image=image,
-                latest_per_version=latest_per_version,
-                meta=meta,
-                meta_number=meta_number
-            )
-
-        # case 2: 1.0.0-RC (without meta number)
-        elif meta and not meta_number:
-            output_tags = self.generate_tags_for_pre_release_without_number(
-                output_tags=output_tags,
-                base_version_with_optional_prefix=base_version_with_optional_prefix,
-                original_tag=original_tag,
-                image=image,
-                latest_per_version=latest_per_version,
-                meta=meta
-            )
-
-        # release
-        elif not meta:
-            output_tags = self.generate_tags_for_release(
-                output_tags=output_tags,
-                base_version_with_optional_prefix=base_version_with_optional_prefix,
-                original_tag=original_tag,
-                image=image
-            )
-
-        return self.strip_out_each_tag(output_tags, to_strip_at_beginning, image)
+        plan = self.get_tag_planner(allowed_meta_list).plan(image, latest_per_version, global_latest, keep_prefix)
+
+        if plan.warning:
+            self._io.warn(plan.warning)
+
+        return list(plan.tags)
+
+    def get_tag_planner(self, allowed_meta_list: str) -> TagPlanner:
+        """ Planners are kept per allowed meta list, so the plans are memoized for the whole process """
+
+        if allowed_meta_list not in self._planners:
+            self._planners[allowed_meta_list] = TagPlanner(allowed_meta_list)
+
+        return self._planners[allowed_meta_list]
 
     @staticmethod
     def strip_out_each_tag(input_tagged_images: list, to_strip_at_beginning: str, originally_tagged_image: str):
@@ -113,103 +71,62 @@ class DockerBaseTask(TaskInterface, ABC):
 
         return image
 
-    def generate_tags_for_numbered_pre_release(self, output_tags: list, base_version_with_optional_prefix: str,
-                                               original_tag: str, image: str, meta: str,
-                                               latest_per_version: bool, meta_number: str):
+    def plan_images(self, context: ExecutionContext) -> List[Tuple[str, List[str]]]:
         """
-        EXAMPLE CASES:
-            - v2.0.0-BETA1
-            - 2.0.0-BETA1
-            - release-2.0.0-BETA1
-        """
-
-        output_tags.append(image.replace(original_tag, base_version_with_optional_prefix + '-latest%s' % meta, 1))
-
-        if latest_per_version:
-            output_tags = self._generate_for_each_version(
-                image, original_tag, output_tags,
-                lambda version: original_tag.replace(base_version_with_optional_prefix + meta + meta_number,
-                                                     version + '-latest%s' % meta, 1)
-            )
-
-        return output_tags
+        Collect images from --image and --images-file, and calculate tags for each of them
 
-    def generate_tags_for_pre_release_without_number(self, output_tags: list, base_version_with_optional_prefix: str,
-                                                     original_tag: str, image: str, meta: str,
-                                                     latest_per_version: bool):
-        """
-        EXAMPLE CASES:
-            - v2.0.0-PRE
-            - 2.0.0-PRE
-            - release-2.0.0-PRE
+        :return: List of (original image, list of images to tag/push)
         """
 
-        output_tags.append(image.replace(original_tag, base_version_with_optional_prefix + '-latest%s' % meta, 1))
+        originals = [context.args['image']] if context.args.get('image') else []
 
-        if latest_per_version:
-            output_tags = self._generate_for_each_version(
-                image, original_tag, output_tags,
-                lambda version: original_tag.replace(base_version_with_optional_prefix + meta,
-                                                     version + '-latest%s' % meta, 1)
-            )
+        if context.args.get('images_file'):
+            with open(context.args['images_file'], 'rb') as f:
+                lines = f.read().decode('utf-8').splitlines()
 
-        return output_tags
+            originals += [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
 
-    def generate_tags_for_release(self, output_tags: list, base_version_with_optional_prefix: str,
-                                  original_tag: str, image: str):
-        """
-        EXAMPLE CASES:
-            - v2.0.0
-            - 2.0.0
-            - release-1.2.3
-        """
+        if not context.args['propagate']:
+            return [(image, [image]) for image in originals]
 
-        output_tags = self._generate_for_each_version(
-            image, original_tag, output_tags,
-            lambda version: original_tag.replace(base_version_with_optional_prefix, version, 1)
-        )
+        planner = self.get_tag_planner(context.args['allowed_meta'])
+        planned = []
 
-        return output_tags
+        for image, plan in planner.plan_many(originals,
+                                             latest_per_version=not context.args['without_latest'],
+                                             global_latest=not context.args['without_global_latest'],
+                                             keep_prefix=bool(context.args['keep_prefix'])):
+            if plan.warning:
+                self._io.warn('%s: %s' % (image, plan.warning))
 
-    @staticmethod
-    def _generate_for_each_version(image: str, original_tag: str, output_tags: list, callback: Callable) -> list:
-        """
-        Generate a list of tags for each sub-version eg. 2.1.3 -> 2.1 -> 2
+            planned.append((image, list(plan.tags)))
 
-        :param image: Original image eg. quay.io/riotkit/infracheck
-        :param original_tag: Original image tag eg. v2.0.0
-        :param output_tags: List of existing output tags to append generated tags to
-        :param callback: A callback that replaces version in original_tag part
-        :param to_strip_at_beginning: Strip a string at the beginning eg. "release-" or "v" or "v."
-        :return:
-        """
+        return planned
 
-        parts = original_tag.split('.')
+    def _print_images(self, images: list, action: str):
+        for image in images:
+            self._io.info(' -> Going to %s image "%s"' % (action, image))
 
-        for part_num in range(0, len(parts)):
-            version = ".".join(parts[0:part_num])
+    def _get_engine_socket(self, context: ExecutionContext) -> Union[str, None]:
+        """ Path to the Docker Engine socket when --engine-api was requested and the socket is available """
 
-            if not version:
-                continue
+        if not context.args.get('engine_api'):
+            return None
 
-            output_tags.append(
-                image.replace(
-                    original_tag,
-                    callback(version)
-                )
-            )
+        socket_path = find_engine_socket()
 
-        return output_tags
+        if not socket_path:
+            self._io.warn('Docker Engine socket not found, falling back to docker CLI')
 
-    def _print_images(self, images: list, action: str):
-        for image in images:
-            self._io.info(' -> Going to %s image "%s"' % (action, image))
+        return socket_path
 
     def get_group_name(self) -> str:
         return ':docker'
 
     def configure_argparse(self, parser: ArgumentParser):
-        parser.add_argument('--image', '-i', help='Image name', required=True)
+        parser.add_argument('--image', '-i', help='Image name')
+        parser.add_argument('--images-file', '-if',
+                            help='Path to a file with list of images, one per line (can be used together with --image)')
         parser.add_argument('--without-latest', '-wl', help='Do not tag latest per version', action='store_true')
         parser.add_argument('--without-global-latest', '-wgl', help='Do not tag :latest', action='store_true')
         parser.add_argument('--propagate', '-p', help='Propagate tags? eg. 1.0.0 -> 1.0 -> 1 -> latest',
@@ -217,6 +134,8 @@ class DockerBaseTask(TaskInterface, ABC):
         parser.add_argument('--allowed-meta', '-m', help='Allowed meta part eg. rc, alpha, beta',
                             default='rc,alpha,stable,dev,prod,test,beta,build,b,pre,a,preprod,prerelease,early,ea,stage')
         parser.add_argument('--keep-prefix', '-k', help='Keep prefix eg. "release-", "v" or "v." if present in tag')
+        parser.add_argument('--engine-api', help='Talk to Docker Engine directly through its UNIX socket ' +
+                                                 'instead of spawning docker CLI processes', action='store_true')
 
 
 class TagImageTask(DockerBaseTask):
@@ -231,27 +150,30 @@ class TagImageTask(DockerBaseTask):
         return ':tag'
 
     def execute(self, context: ExecutionContext) -> bool:
-        original_image = context.args['image']
-
-        if context.args['propagate']:
-            images = self.calculate_images(
-                image=original_image,
-                latest_per_version=not context.args['without_latest'],
-                global_latest=not context.args['without_global_latest'],
-                allowed_meta_list=context.args['allowed_meta'],
-                keep_prefix=bool(context.args['keep_prefix'])
-            )
-        else:
-            images = [original_image]
+        planned = self.plan_images(context)
 
-        self._print_images(images, 'tag')
+        if not planned:
+            self._io.error_msg('No images specified, use --image or --images-file')
+            return False
 
-        for image in images:
-            try:
-                self.exec('docker tag %s %s' % (original_image, image))
-            except CalledProcessError as e:
-                print(e)
-                return False
+        engine_socket = self._get_engine_socket(context)
+
+        if engine_socket:
+            with EngineClient(engine_socket) as engine:
+                return self.tag_images(planned, engine.tag)
+
+        return self.tag_images(planned, lambda source, target: self.exec('docker tag %s %s' % (source, target)))
+
+    def tag_images(self, planned: List[Tuple[str, List[str]]], tag: Callable) -> bool:
+        for original_image, images in planned:
+            self._print_images(images, 'tag')
+
+            for image in images:
+                try:
+                    tag(original_image, image)
+                except (CalledProcessError, EngineException) as e:
+                    print(e)
+                    return False
 
         return True
 
@@ -264,21 +186,62 @@ class PushTask(DockerBaseTask):
         return ':push'
 
     def execute(self, context: ExecutionContext) -> bool:
-        original_image = context.args['image']
-        images = []
-
-        if context.args['propagate']:
-            images += self.calculate_images(
-                image=original_image,
-                latest_per_version=not context.args['without_latest'],
-                global_latest=not context.args['without_global_latest'],
-                allowed_meta_list=context.args['allowed_meta'],
-                keep_prefix=bool(context.args['keep_prefix'])
-            )
-        else:
-            images = [original_image]
+        planned = self.plan_images(context)
 
-        self._print_images(images, 'push')
+        if not planned:
+            self._io.error_msg('No images specified, use --image or --images-file')
+            return False
+
+        self._engine_socket = self._get_engine_socket(context)
+
+        ledger = BuildLedger(context.args['ledger']) if context.args.get('ledger') else None
+
+        try:
+            for original_image, images in planned:
+                self._print_images(images, 'push')
+
+                if not self.push_images(images, context):
+                    return False
+
+                if ledger:
+                    self.record_in_ledger(ledger, images, context.args.get('git_tag') or None)
+
+        finally:
+            if ledger:
+                ledger.close()
+
+        return True
+
+    def record_in_ledger(self, ledger: BuildLedger, images: list, git_tag: Union[str, None]):
+        """ Remember pushed tags, so "was it already built?" can be answered locally """
+
+        digest = self._get_local_digest(images[0])
+        ledger.record_many(images, digest=digest, git_tag=git_tag)
+
+        self._io.info_msg('Recorded %i tags in the build ledger "%s"' % (len(images), ledger.path))
+
+    def push_images(self, images: list, context: ExecutionContext) -> bool:
+        parallel = int(context.args.get('parallel') or 1)
+
+        if context.args.get('skip_unchanged'):
+            return self.push_changed_only(images)
+
+        if context.args.get('registry_retag') and len(images) > 1:
+            return self.push_and_retag_in_registry(images)
+
+        if parallel > 1 and len(images) > 1:
+            return self.push_in_parallel(images, parallel)
+
+        if self._engine_socket:
+            with EngineClient(self._engine_socket) as engine:
+                for image in images:
+                    try:
+                        engine.push(image)
+                    except EngineException as e:
+                        print(e)
+                        return False
+
+            return True
 
         for image in images:
             try:
@@ -289,6 +252,183 @@ class PushTask(DockerBaseTask):
 
         return True
 
+    def push_in_parallel(self, images: list, workers: int) -> bool:
+        """
+        Push the first image alone, so all the layers are uploaded once, then push the rest of tags
+        through a bounded pool of workers. Each tag is reported separately, the result is False if any push failed
+
+        :param images: List of tagged images, the original one first
+        :param workers: Maximum number of concurrent "docker push" processes
+        :return:
+        """
+
+        results = [self._push_image(images[0])]
+
+        if results[0][1] is None:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results += list(pool.map(self._push_image, images[1:]))
+        else:
+            results += [(image, 'Skipped, the original image was not pushed') for image in images[1:]]
+
+        failed = 0
+
+        for image, error in results:
+            if error is None:
+                self._io.success_msg(' -> Pushed "%s"' % image)
+            else:
+                self._io.error_msg(' -> Failed to push "%s": %s' % (image, error))
+                failed += 1
+
+        if failed:
+            self._io.error_msg('%i of %i tags were not pushed' % (failed, len(results)))
+            return False
+
+        self._io.success_msg('All %i tags pushed' % len(results))
+        return True
+
+    def push_and_retag_in_registry(self, images: list) -> bool:
+        """
+        Push only the first image, then create the rest of tags directly in the registry
+        by uploading the same manifest under each tag (Registry HTTP API v2). No layers are transferred.
+
+        :param images: List of tagged images, the original one first
+        :return:
+        """
+
+        image, error = self._push_image(images[0])
+
+        if error is not None:
+            self._io.error_msg(' -> Failed to push "%s": %s' % (image, error))
+            return False
+
+        self._io.success_msg(' -> Pushed "%s"' % image)
+
+        source = parse_image(images[0])
+        client = RegistryClient(source.registry)
+
+        try:
+            digests = client.retag(source.repository, source.tag, [parse_image(image).tag for image in images[1:]])
+        except (RegistryException, OSError) as e:
+            self._io.error_msg(' -> Cannot re-tag in the registry: %s' % str(e))
+            return False
+
+        for tag, digest in digests.items():
+            self._io.success_msg(' -> Tagged "%s/%s:%s" (%s)' % (source.registry, source.repository, tag, digest))
+
+        return True
+
+    def push_changed_only(self, images: list) -> bool:
+        """
+        Compare the local image manifest digest with the digest each remote tag points to (HEAD on the manifest),
+        and update only the tags that differ. Tags are updated in the registry by uploading the manifest,
+        the image is pushed only when the registry does not have it yet.
+
+        :param images: List of tagged images, the original one first
+        :return:
+        """
+
+        source = parse_image(images[0])
+        client = RegistryClient(source.registry)
+        local_digest = self._get_local_digest(images[0])
+        pushed = []
+
+        try:
+            manifest = client.get_manifest(source.repository, local_digest) if local_digest else None
+        except RegistryException:
+            manifest = None
+
+        try:
+            # the registry does not know this image yet, a regular push is required
+            if manifest is None:
+                image, error = self._push_image(images[0])
+
+                if error is not None:
+                    self._io.error_msg(' -> Failed to push "%s": %s' % (image, error))
+                    return False
+
+                pushed.append(source.tag)
+                manifest = client.get_manifest(source.repository, source.tag)
+
+            skipped = []
+            updated = []
+
+            for image in images:
+                tag = parse_image(image).tag
+
+                if tag in pushed:
+                    continue
+
+                if client.get_digest(source.repository, tag) == manifest.digest:
+                    skipped.append(tag)
+                    continue
+
+                client.put_manifest(source.repository, tag, manifest)
+                updated.append(tag)
+
+        except (RegistryException, OSError) as e:
+            self._io.error_msg(' -> Cannot update tags in the registry: %s' % str(e))
+            return False
+
+        self._io.info_msg('Digest: %s' % manifest.digest)
+        self._io.info_msg('Pushed: %s' % (', '.join(pushed) or '-'))
+        self._io.info_msg('Updated: %s' % (', '.join(updated) or '-'))
+        self._io.info_msg('Skipped, already up to date: %s' % (', '.join(skipped) or '-'))
+
+        return True
+
+    def _get_local_digest(self, image: str) -> Union[str, None]:
+        """ Manifest digest of a local image, known only if the image was already pushed or pulled """
+
+        try:
+            if self._engine_socket:
+                with EngineClient(self._engine_socket) as engine:
+                    repo_digests = engine.inspect_image(image).get('RepoDigests') or []
+            else:
+                repo_digests = json.loads(
+                    self.exec('docker image inspect --format "{{json .RepoDigests}}" %s' % image, capture=True)
+                ) or []
+
+        except (CalledProcessError, EngineException, ValueError):
+            return None
+
+        repository = split_image_tag(image)[0]
+
+        for repo_digest in repo_digests:
+            name, digest = repo_digest.split('@', 1)
+
+            if name == repository:
+                return digest
+
+        return None
+
+    def _push_image(self, image: str) -> Tuple[str, Union[str, None]]:
+        """ Push a single image, returns the image name and an error message (None on success) """
+
+        try:
+            if self._engine_socket:
+                with EngineClient(self._engine_socket) as engine:
+                    engine.push(image)
+            else:
+                self.exec('docker push %s' % image, capture=True)
+
+            return image, None
+        except (CalledProcessError, EngineException) as e:
+            return image, str(e)
+
+    def configure_argparse(self, parser: ArgumentParser):
+        super().configure_argparse(parser)
+        parser.add_argument('--parallel', '-j', default='1',
+                            help='Number of tags to push concurrently after the original tag is pushed')
+        parser.add_argument('--registry-retag', '-rr', action='store_true',
+                            help='Push only the original tag, then create propagated tags in the registry ' +
+                                 'via Registry API v2 (no layers transferred, no local tagging needed)')
+        parser.add_argument('--skip-unchanged', '-su', action='store_true',
+                            help='Compare manifest digests first, update only tags that point to a different ' +
+                                 'manifest in the registry')
+        parser.add_argument('--ledger', default=os.getenv('RKT_BUILD_LEDGER', ''),
+                            help='SQLite database where pushed tags are recorded (defaults to $RKT_BUILD_LEDGER)')
+        parser.add_argument('--git-tag', default='', help='Source git tag of the image, recorded in the ledger')
+
 
 def imports():
     return [
@@ -0,0 +1,169 @@
+import os
+import json
+import base64
+import socket
+from http.client import HTTPConnection, HTTPResponse
+from typing import Union, Tuple
+from urllib.parse import quote, urlencode
+from .registry import load_docker_credentials, parse_image
+
+DEFAULT_SOCKET_PATH = '/var/run/docker.sock'
+
+
+class EngineException(Exception):
+    pass
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """ HTTP/1.1 connection over a UNIX socket """
+
+    def __init__(self, socket_path: str, timeout: int = 300):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def split_image_tag(image: str) -> Tuple[str, str]:
+    """ quay.io/riotkit/taiga:2.1 -> quay.io/riotkit/taiga, 2.1 """
+
+    if ':' in image.split('/')[-1]:
+        repository, tag = image.rsplit(':', 1)
+        return repository, tag
+
+    return image, 'latest'
+
+
+def find_engine_socket() -> Union[str, None]:
+    """ Returns a path to the Docker Engine socket, or None if the engine is not reachable via a local socket """
+
+    docker_host = os.getenv('DOCKER_HOST', '')
+
+    if docker_host and not docker_host.startswith('unix://'):
+        return None
+
+    path = docker_host[len('unix://'):] if docker_host else DEFAULT_SOCKET_PATH
+
+    return path if os.path.exists(path) else None
+
+
+class EngineClient(object):
+    """
+    Docker Engine API client
+
+    Keeps a single keep-alive connection to the daemon socket, so each operation costs one HTTP round trip
+    instead of spawning a "docker" CLI process.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: int = 300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._connection = None  # type: Union[UnixHTTPConnection, None]
+
+    def tag(self, source_image: str, target_image: str):
+        repository, tag = split_image_tag(target_image)
+
+        self._call('POST', '/images/%s/tag' % quote(source_image, safe='/:@'),
+                   query={'repo': repository, 'tag': tag}, expected=[201])
+
+    def inspect_image(self, image: str) -> dict:
+        return self._call('GET', '/images/%s/json' % quote(image, safe='/:@'), expected=[200])
+
+    def push(self, image: str, registry_auth: dict = None):
+        """ Push an image. Credentials default to those stored by "docker login" """
+
+        repository, tag = split_image_tag(image)
+
+        if registry_auth is None:
+            credentials = load_docker_credentials(parse_image(image).registry)
+            registry_auth = {'username': credentials[0], 'password': credentials[1]} if credentials else {}
+
+        self._call('POST', '/images/%s/push' % quote(repository, safe='/:@'), query={'tag': tag}, expected=[200],
+                   headers={'X-Registry-Auth': base64.urlsafe_b64encode(
+                       json.dumps(registry_auth).encode('utf-8')).decode('utf-8')})
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _call(self, method: str, path: str, query: dict = None, body: dict = None, headers: dict = None,
+              expected: list = None) -> Union[dict, list, None]:
+        """
+        Performs a request and decodes the JSON response.
+        Streamed responses (push, pull) are read to the end and checked for an "error" entry.
+        """
+
+        if query:
+            path += '?' + urlencode(query)
+
+        headers = dict(headers or {})
+        payload = None
+
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        response = self._send(method, path, payload, headers)
+        content = response.read()
+
+        if expected and response.status not in expected:
+            raise EngineException('Docker Engine responded with HTTP %i for %s %s: %s' % (
+                response.status, method, path, self._error_message(content)))
+
+        if response.status == 404 or not content:
+            return None
+
+        try:
+            documents = [json.loads(content.decode('utf-8'))]
+        except ValueError:
+            documents = [json.loads(line) for line in content.decode('utf-8').splitlines() if line.strip()]
+
+        for document in documents:
+            if isinstance(document, dict) and document.get('error'):
+                raise EngineException('Docker Engine reported an error for %s %s: %s' % (
+                    method, path, document['error']))
+
+        return documents[-1] if documents else None
+
+    def _send(self, method: str, path: str, payload: Union[bytes, None], headers: dict) -> HTTPResponse:
+        """
+        Sends a request over the persistent connection, reconnecting once if the daemon closed it.
+        A request that was already sent is repeated only when it is safe to (GET, HEAD) - a push or a tag
+        may have been already performed by the daemon
+        """
+
+        for attempt in range(0, 2):
+            if not self._connection:
+                self._connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+            sent = False
+
+            try:
+                self._connection.request(method, path, body=payload, headers=headers)
+                sent = True
+
+                return self._connection.getresponse()
+
+            except (ConnectionError, OSError) as e:
+                self.close()
+
+                if attempt > 0 or (sent and method not in ['GET', 'HEAD']):
+                    raise EngineException('Cannot talk to Docker Engine at %s: %s' % (self.socket_path, str(e)))
+
+    @staticmethod
+    def _error_message(content: bytes) -> str:
+        try:
+            return json.loads(content.decode('utf-8')).get('message', '')
+        except ValueError:
+            return content.decode('utf-8', errors='replace')
@@ -0,0 +1,80 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from typing import List, Union
+from .engine import split_image_tag
+
+
+LedgerEntry = namedtuple('LedgerEntry', 'repository tag digest git_tag pushed_at')
+
+
+class BuildLedger(object):
+    """
+    Local record of pushed images in a SQLite database
+
+    Answers "was this tag already pushed?" with a single indexed lookup, without asking the registry.
+    The database can be shared by many processes (eg. nested rkd calls, parallel builds on one runner).
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+
+        with self._connection:
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS pushed_images (
+                    repository TEXT NOT NULL,
+                    tag TEXT NOT NULL,
+                    digest TEXT,
+                    git_tag TEXT,
+                    pushed_at REAL NOT NULL,
+                    PRIMARY KEY (repository, tag)
+                )
+            ''')
+
+    def record(self, image: str, digest: str = None, git_tag: str = None):
+        self.record_many([image], digest, git_tag)
+
+    def record_many(self, images: List[str], digest: str = None, git_tag: str = None):
+        """ Record tags of the same image in one transaction """
+
+        pushed_at = time.time()
+        rows = [split_image_tag(image) + (digest, git_tag, pushed_at) for image in images]
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO pushed_images VALUES (?, ?, ?, ?, ?)', rows)
+
+    def get(self, image: str) -> Union[LedgerEntry, None]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT repository, tag, digest, git_tag, pushed_at FROM pushed_images ' +
+                'WHERE repository = ? AND tag = ?',
+                split_image_tag(image)
+            ).fetchone()
+
+        return LedgerEntry(*row) if row else None
+
+    def contains(self, image: str) -> bool:
+        return self.get(image) is not None
+
+    def forget(self, image: str):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM pushed_images WHERE repository = ? AND tag = ?',
+                                     split_image_tag(image))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
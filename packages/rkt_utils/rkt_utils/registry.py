@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import base64
+import hashlib
+import requests
+import subprocess
+from collections import namedtuple
+from typing import Dict, List, Union
+
+
+ImageReference = namedtuple('ImageReference', 'registry repository tag')
+Manifest = namedtuple('Manifest', 'content media_type digest')
+
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json'
+]
+
+
+class RegistryException(Exception):
+    pass
+
+
+def parse_image(image: str) -> ImageReference:
+    """
+    Split a docker image name into registry, repository and tag
+
+    Examples:
+        quay.io/riotkit/infracheck:v2.0.0 -> quay.io, riotkit/infracheck, v2.0.0
+        alpine -> registry-1.docker.io, library/alpine, latest
+    """
+
+    name, tag = image, 'latest'
+    last_part = image.split('/')[-1]
+
+    if ':' in last_part:
+        name, tag = image.rsplit(':', 1)
+
+    parts = name.split('/', 1)
+
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        return ImageReference(parts[0], parts[1], tag)
+
+    if len(parts) == 1:
+        return ImageReference(DOCKER_HUB_REGISTRY, 'library/' + name, tag)
+
+    return ImageReference(DOCKER_HUB_REGISTRY, name, tag)
+
+
+def load_docker_credentials(registry: str, config_path: str = None) -> Union[tuple, None]:
+    """
+    Read credentials stored by "docker login" in ~/.docker/config.json
+
+    Follows the same order as docker CLI: "credHelpers" entry for the registry, inline "auths", then "credsStore"
+    """
+
+    if not config_path:
+        config_path = os.path.expanduser('~/.docker/config.json')
+
+    if not os.path.isfile(config_path):
+        return None
+
+    with open(config_path, 'rb') as f:
+        config = json.loads(f.read().decode('utf-8'))
+
+    auths = config.get('auths', {})
+    helpers = config.get('credHelpers', {})
+    aliases = [registry, 'https://' + registry, 'http://' + registry]
+
+    if registry == DOCKER_HUB_REGISTRY:
+        aliases.append('https://index.docker.io/v1/')
+
+    for alias in aliases:
+        if alias in helpers:
+            return get_helper_credentials(helpers[alias], alias)
+
+    for alias in aliases:
+        if alias in auths and auths[alias].get('auth'):
+            username, password = base64.b64decode(auths[alias]['auth']).decode('utf-8').split(':', 1)
+            return username, password
+
+    if config.get('credsStore'):
+        for alias in aliases:
+            credentials = get_helper_credentials(config['credsStore'], alias)
+
+            if credentials:
+                return credentials
+
+    return None
+
+
+def get_helper_credentials(helper: str, server: str) -> Union[tuple, None]:
+    """ Ask a docker credential helper (eg. docker-credential-ecr-login) for credentials, None if it has none """
+
+    try:
+        process = subprocess.run(['docker-credential-' + helper, 'get'], input=server.encode('utf-8'),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    if process.returncode != 0:
+        return None
+
+    try:
+        credentials = json.loads(process.stdout.decode('utf-8'))
+    except ValueError:
+        return None
+
+    if not credentials.get('Secret'):
+        return None
+
+    return credentials.get('Username', ''), credentials['Secret']
+
+
+class RegistryClient(object):
+    """
+    Docker Registry HTTP API v2 client
+
+    Talks directly to the registry, so manifests can be copied between tags without transferring any layer.
+    Supports anonymous access, Basic auth and Bearer token auth (eg. Docker Hub, Quay, GitLab)
+    """
+
+    def __init__(self, registry: str, username: str = None, password: str = None, insecure: bool = None,
+                 session: requests.Session = None, timeout: int = None):
+        if insecure is None:
+            insecure = registry.split(':')[0] in ['localhost', '127.0.0.1']
+
+        if username is None:
+            credentials = load_docker_credentials(registry)
+            username, password = credentials if credentials else (None, None)
+
+        self.base_url = ('http://' if insecure else 'https://') + registry
+        self.username = username
+        self.password = password
+        self.session = session if session else requests.Session()
+        self.timeout = timeout
+        self._tokens = {}  # type: Dict[str, str]
+
+    def get_manifest(self, repository: str, reference: str) -> Manifest:
+        response = self._request('GET', repository, '/manifests/%s' % reference,
+                                 headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)})
+
+        if response.status_code == 404:
+            raise RegistryException('Manifest "%s:%s" not found' % (repository, reference))
+
+        self._raise_for_status(response, repository, reference)
+
+        return Manifest(
+            content=response.content,
+            media_type=response.headers.get('Content-Type', MANIFEST_MEDIA_TYPES[0]).split(';')[0],
+            digest=response.headers.get('Docker-Content-Digest') or self.calculate_digest(response.content)
+        )
+
+    def manifest_exists(self, repository: str, reference: str) -> bool:
+        """ Checks with a HEAD request if the reference exists, nothing is downloaded """
+
+        response = self._request('HEAD', repository, '/manifests/%s' % reference,
+                                 headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)})
+
+        if response.status_code == 404:
+            return False
+
+        self._raise_for_status(response, repository, reference)
+
+        return True
+
+    def get_digest(self, repository: str, reference: str) -> Union[str, None]:
+        """ Digest of the manifest the reference points to (HEAD request, nothing is downloaded), None if missing """
+
+        response = self._request('HEAD', repository, '/manifests/%s' % reference,
+                                 headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)})
+
+        if response.status_code == 404:
+            return None
+
+        self._raise_for_status(response, repository, reference)
+
+        return response.headers.get('Docker-Content-Digest')
+
+    def list_tags(self, repository: str, page_size: int = 1000) -> List[str]:
+        """ All tags of a repository, follows the "Link" header pagination """
+
+        tags = []
+        path = '/tags/list?n=%i' % page_size
+
+        while path:
+            response = self._request('GET', repository, path)
+
+            if response.status_code == 404:
+                return []
+
+            self._raise_for_status(response, repository, 'tags/list')
+            tags += response.json().get('tags') or []
+            path = None
+
+            # Link: </v2/riotkit/taiga/tags/list?n=1000&last=2.1>; rel="next"
+            if 'next' in response.links:
+                next_url = response.links['next']['url']
+                path = next_url[next_url.index('/tags/list'):]
+
+        return tags
+
+    def put_manifest(self, repository: str, reference: str, manifest: Manifest) -> str:
+        response = self._request('PUT', repository, '/manifests/%s' % reference, data=manifest.content,
+                                 headers={'Content-Type': manifest.media_type}, scope_actions='pull,push')
+
+        self._raise_for_status(response, repository, reference)
+
+        return response.headers.get('Docker-Content-Digest', manifest.digest)
+
+    def retag(self, repository: str, source_reference: str, target_tags: List[str]) -> Dict[str, str]:
+        """
+        Create tags pointing to the same manifest as source_reference. The manifest is downloaded once.
+
+        :return: Dict of tag -> digest
+        """
+
+        manifest = self.get_manifest(repository, source_reference)
+
+        return {tag: self.put_manifest(repository, tag, manifest) for tag in target_tags}
+
+    @staticmethod
+    def calculate_digest(content: bytes) -> str:
+        return 'sha256:' + hashlib.sha256(content).hexdigest()
+
+    def _request(self, method: str, repository: str, path: str, headers: dict = None,
+                 scope_actions: str = 'pull', **kwargs) -> requests.Response:
+        url = '%s/v2/%s%s' % (self.base_url, repository, path)
+        headers = dict(headers or {})
+        scope = 'repository:%s:%s' % (repository, scope_actions)
+
+        if scope in self._tokens:
+            headers['Authorization'] = self._tokens[scope]
+
+        if self.timeout:
+            kwargs.setdefault('timeout', self.timeout)
+
+        response = self.session.request(method, url, headers=headers, **kwargs)
+
+        if response.status_code == 401 and 'WWW-Authenticate' in response.headers:
+            self._tokens[scope] = self._authenticate(response.headers['WWW-Authenticate'], scope)
+            headers['Authorization'] = self._tokens[scope]
+            response = self.session.request(method, url, headers=headers, **kwargs)
+
+        return response
+
+    def _authenticate(self, challenge: str, scope: str) -> str:
+        """ Answer the WWW-Authenticate challenge, returns a value for the Authorization header """
+
+        auth = (self.username, self.password) if self.username else None
+        auth_type = challenge.split(' ', 1)[0].lower()
+
+        if auth_type == 'basic':
+            if not auth:
+                raise RegistryException('Registry requires credentials, try "docker login" first')
+
+            return 'Basic ' + base64.b64encode(('%s:%s' % auth).encode('utf-8')).decode('utf-8')
+
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        query = {'scope': params.get('scope', scope)}
+
+        if 'service' in params:
+            query['service'] = params['service']
+
+        response = self.session.get(params['realm'], params=query, auth=auth, timeout=self.timeout)
+
+        if response.status_code != 200:
+            raise RegistryException('Cannot authenticate to the registry, got HTTP %i' % response.status_code)
+
+        body = response.json()
+
+        return 'Bearer ' + (body.get('token') or body.get('access_token'))
+
+    @staticmethod
+    def _raise_for_status(response: requests.Response, repository: str, reference: str):
+        if response.status_code >= 400:
+            raise RegistryException('Registry responded with HTTP %i for "%s:%s": %s' % (
+                response.status_code, repository, reference, response.text[0:256]
+            ))
@@ -0,0 +1,126 @@
+import re
+from collections import namedtuple
+from typing import Dict, List, Tuple, Union
+
+
+TagPlan = namedtuple('TagPlan', 'tags warning')
+
+VERSION_PATTERN = re.compile('(?P<version>[0-9.]+)(-(?P<meta>[A-Za-z]+))?(?P<metanum>[0-9]+)?', re.IGNORECASE)
+
+
+class TagPlanner(object):
+    """
+    Calculates tags propagation eg. 2.1.3 -> 2.1 -> 2 -> latest
+
+    The allowed meta list is parsed once per planner, and each plan is calculated only on the tag part
+    and memoized by (tag, flags), so planning hundreds of images of the same release is almost free.
+
+    Examples:
+        1.0.0 -> 1.0 -> 1 -> latest
+        1.0.0-RC1 -> 1.0.0-latest-RC
+        release-4.0.5-dev1 -> 4.0.5-latest-dev -> 4-latest-dev -> 4.0-latest-dev
+    """
+
+    def __init__(self, allowed_meta_list: str):
+        self.allowed_meta = frozenset(allowed_meta_list.replace(' ', '').split(','))
+        self._plans = {}  # type: Dict[Tuple[str, bool, bool, bool], TagPlan]
+
+    def plan_tag(self, tag: str, latest_per_version: bool, global_latest: bool, keep_prefix: bool) -> TagPlan:
+        key = (tag, latest_per_version, global_latest, keep_prefix)
+
+        if key not in self._plans:
+            self._plans[key] = self._calculate(tag, latest_per_version, global_latest, keep_prefix)
+
+        return self._plans[key]
+
+    def plan(self, image: str, latest_per_version: bool, global_latest: bool, keep_prefix: bool) -> TagPlan:
+        """
+        Plan tags for a single image eg. quay.io/riotkit/infracheck:v2.0.0
+
+        The prefix ("v", "release-") is kept for images of a registry with a port eg. localhost:5000/riotkit/taiga:v2.1
+        as it always was, so already pushed tag names do not change
+        """
+
+        tag = image.split(':')[-1]
+        repository = image[0:len(image) - len(tag)]
+
+        if image.find(':') != len(repository) - 1:
+            keep_prefix = True
+
+        plan = self.plan_tag(tag, latest_per_version, global_latest, keep_prefix)
+
+        if plan.warning:
+            return TagPlan(tags=[image], warning=plan.warning)
+
+        return TagPlan(tags=[repository + planned for planned in plan.tags], warning=None)
+
+    def plan_many(self, images: List[str], latest_per_version: bool, global_latest: bool,
+                  keep_prefix: bool) -> List[Tuple[str, TagPlan]]:
+        """ Plan tags for many images at once, keeps the input order """
+
+        return [(image, self.plan(image, latest_per_version, global_latest, keep_prefix)) for image in images]
+
+    def _calculate(self, tag: str, latest_per_version: bool, global_latest: bool, keep_prefix: bool) -> TagPlan:
+        match = VERSION_PATTERN.search(tag)
+
+        if not match:
+            return TagPlan(tags=[tag], warning='No release version found')
+
+        meta_type = match.group('meta')
+        meta_number = match.group('metanum')
+
+        if meta_type and meta_type not in self.allowed_meta:
+            return TagPlan(tags=[tag], warning='Version meta part is not allowed, not calculating propagation')
+
+        base_version = match.group('version')
+        optional_prefix = tag[0:tag.find(base_version)]
+        base_version_with_optional_prefix = optional_prefix + base_version
+        meta = '-' + meta_type if meta_type else None
+        tags = [tag]
+
+        # :latest
+        if global_latest:
+            tags.append('latest')
+
+        # case 1: 1.0.0-RC1 -> 1.0.0-latest-RC
+        # case 2: 1.0.0-RC (without meta number)
+        if meta:
+            versioned_part = base_version_with_optional_prefix + meta + (meta_number if meta_number else '')
+            tags.append(base_version_with_optional_prefix + '-latest%s' % meta)
+
+            if latest_per_version:
+                tags += [tag.replace(versioned_part, version + '-latest%s' % meta, 1)
+                         for version in self._sub_versions(tag)]
+
+        # release
+        else:
+            tags += [tag.replace(base_version_with_optional_prefix, version, 1) for version in self._sub_versions(tag)]
+
+        if optional_prefix and not keep_prefix:
+            tags = [self._strip_prefix(planned, optional_prefix) for planned in tags]
+
+        return TagPlan(tags=tags, warning=None)
+
+    @staticmethod
+    def _sub_versions(tag: str) -> List[str]:
+        """ v2.1.3 -> v2, v2.1 """
+
+        parts = tag.split('.')
+
+        versions = []
+
+        for part_num in range(1, len(parts)):
+            version = '.'.join(parts[0:part_num])
+
+            if not version:
+                continue
+
+            versions.append(version)
+
+        return versions
+
+    @staticmethod
+    def _strip_prefix(tag: str, prefix: Union[str, None]) -> str:
+        """ Removes a prefix like a "release-", "v" from beginning of the tag """
+
+        return tag[len(prefix):] if tag.startswith(prefix) else tag
@@ -0,0 +1,173 @@
+import os
+import hmac
+import base64
+import struct
+import hashlib
+import tempfile
+import threading
+import socketserver
+from rkd.api.testing import BasicTestingCase
+from rkd.api.inputoutput import BufferedSystemIO
+from rkt_utils.db import WaitForDatabaseTask
+from rkt_utils.dbprobe import probe_mysql, probe_postgres, ProbeException
+
+NONCE = b'abcdefghijklmnopqrst'
+
+
+class FakeMysqlHandler(socketserver.BaseRequestHandler):
+    """ Sends a MySQL 8 handshake (mysql_native_password), accepts "root" with the password "riotkit" """
+
+    def _send(self, sequence: int, payload: bytes):
+        self.request.sendall(struct.pack('<I', len(payload))[0:3] + bytes([sequence]) + payload)
+
+    def _read(self) -> bytes:
+        header = self.request.recv(4)
+        length = header[0] | header[1] << 8 | header[2] << 16
+
+        return self.request.recv(length)
+
+    def handle(self):
+        capabilities = 0x000fa20f | 0x80000
+        self._send(0, b'\x0a8.0.19\0' + struct.pack('<I', 7) + NONCE[0:8] + b'\0' +
+                   struct.pack('<HBHH', capabilities & 0xffff, 33, 2, capabilities >> 16) + bytes([21]) +
+                   b'\0' * 10 + NONCE[8:] + b'\0' + b'mysql_native_password\0')
+
+        response = self._read()
+
+        if not response:
+            return
+
+        user, rest = response[32:].split(b'\0', 1)
+        scramble = rest[1:1 + rest[0]]
+        first = hashlib.sha1(b'riotkit').digest()
+        expected = bytes([a ^ b for a, b in zip(first, hashlib.sha1(NONCE + hashlib.sha1(first).digest()).digest())])
+
+        if user == b'root' and scramble == expected:
+            self._send(2, b'\x00\x00\x00\x02\x00\x00\x00')
+        else:
+            self._send(2, b'\xff' + struct.pack('<H', 1045) + b'#28000Access denied for user')
+
+
+class MalformedMysqlHandler(socketserver.BaseRequestHandler):
+    """ Sends the packet set on the server, eg. an empty or a truncated handshake """
+
+    def handle(self):
+        self.request.sendall(struct.pack('<I', len(self.server.packet))[0:3] + b'\0' + self.server.packet)
+
+
+class FakePostgresHandler(socketserver.BaseRequestHandler):
+    """ Answers SSLRequest with "N", then requires SCRAM-SHA-256 for user "riotkit" with password "anarchy" """
+
+    def _read_message(self) -> bytes:
+        header = self.request.recv(5)
+        return self.request.recv(struct.unpack('!I', header[1:5])[0] - 4)
+
+    def _send(self, message_type: bytes, payload: bytes):
+        self.request.sendall(message_type + struct.pack('!I', len(payload) + 4) + payload)
+
+    def handle(self):
+        length = struct.unpack('!I', self.request.recv(4))[0]
+        self.request.recv(length - 4)
+        self.request.sendall(b'N')
+
+        length = struct.unpack('!I', self.request.recv(4))[0]
+        startup = self.request.recv(length - 4)
+
+        if self.server.starting_up:
+            return self._send(b'E', b'SFATAL\0C57P03\0Mthe database system is starting up\0\0')
+
+        if b'user\0riotkit\0' not in startup:
+            return self._send(b'E', b'SFATAL\0C28P01\0Mpassword authentication failed\0\0')
+
+        self._send(b'R', struct.pack('!I', 10) + b'SCRAM-SHA-256\0\0')
+        initial = self._read_message()
+        client_first_bare = initial[initial.index(b'n,,') + 3:].decode('utf-8')
+        nonce = client_first_bare.split('r=')[1] + 'server'
+        salt = b'salt'
+        server_first = 'r=%s,s=%s,i=4096' % (nonce, base64.b64encode(salt).decode('ascii'))
+        self._send(b'R', struct.pack('!I', 11) + server_first.encode('utf-8'))
+
+        client_final = self._read_message().decode('utf-8')
+        without_proof, proof = client_final.rsplit(',p=', 1)
+        auth_message = ','.join([client_first_bare, server_first, without_proof]).encode('utf-8')
+        salted = hashlib.pbkdf2_hmac('sha256', b'anarchy', salt, 4096)
+        client_key = bytes([a ^ b for a, b in zip(base64.b64decode(proof), hmac.new(
+            hashlib.sha256(hmac.new(salted, b'Client Key', hashlib.sha256).digest()).digest(), auth_message,
+            hashlib.sha256).digest())])
+
+        if hashlib.sha256(client_key).digest() != hashlib.sha256(
+                hmac.new(salted, b'Client Key', hashlib.sha256).digest()).digest():
+            return self._send(b'E', b'SFATAL\0C28P01\0Mpassword authentication failed\0\0')
+
+        server_key = hmac.new(salted, b'Server Key', hashlib.sha256).digest()
+        signature = base64.b64encode(hmac.new(server_key, auth_message, hashlib.sha256).digest())
+        self._send(b'R', struct.pack('!I', 12) + b'v=' + signature)
+        self._send(b'R', struct.pack('!I', 0))
+        self._send(b'Z', b'I')
+
+
+class DatabaseProbeTest(BasicTestingCase):
+    def _start(self, server: socketserver.BaseServer) -> socketserver.BaseServer:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    def _start_mysql(self) -> int:
+        return self._start(socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeMysqlHandler)).server_address[1]
+
+    def _start_postgres(self, starting_up: bool = False) -> int:
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakePostgresHandler)
+        server.starting_up = starting_up
+
+        return self._start(server).server_address[1]
+
+    def test_mysql_handshake_and_authentication(self):
+        port = self._start_mysql()
+
+        self.assertTrue(probe_mysql('127.0.0.1', port))
+        self.assertTrue(probe_mysql('127.0.0.1', port, user='root', password='riotkit'))
+
+        with self.assertRaises(ProbeException):
+            probe_mysql('127.0.0.1', port, user='root', password='wrong')
+
+    def test_mysql_malformed_handshake_is_a_probe_exception(self):
+        for packet in [b'', b'\x0a8.0', b'\x0a8.0.19\0' + struct.pack('<I', 7) + NONCE[0:8] + b'\0\x0f']:
+            with self.subTest(packet=packet):
+                server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), MalformedMysqlHandler)
+                server.packet = packet
+
+                with self.assertRaises(ProbeException):
+                    probe_mysql('127.0.0.1', self._start(server).server_address[1])
+
+    def test_mysql_over_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mysqld.sock')
+        self._start(socketserver.ThreadingUnixStreamServer(path, FakeMysqlHandler))
+
+        self.assertTrue(probe_mysql(path, 3306, user='root', password='riotkit'))
+
+    def test_postgres_scram_authentication(self):
+        port = self._start_postgres()
+
+        self.assertTrue(probe_postgres('127.0.0.1', port, user='riotkit', password='anarchy', db_name='riotkit'))
+
+        with self.assertRaises(ProbeException):
+            probe_postgres('127.0.0.1', port, user='riotkit', password='wrong')
+
+    def test_postgres_without_credentials_is_ready_when_login_is_rejected_but_not_when_starting_up(self):
+        self.assertTrue(probe_postgres('127.0.0.1', self._start_postgres()))
+
+        with self.assertRaises(ProbeException):
+            probe_postgres('127.0.0.1', self._start_postgres(starting_up=True))
+
+    def test_task_uses_native_probe_by_default(self):
+        io = BufferedSystemIO()
+        task = self.satisfy_task_dependencies(WaitForDatabaseTask(), io=io)
+
+        self.assertTrue(task.execute(self.mock_execution_context(task, {
+            'type': 'mysql', 'db_name': '', 'timeout': '2', 'username': 'root', 'password': 'riotkit',
+            'port': str(self._start_mysql()), 'host': '127.0.0.1', 'checker': 'native'
+        }, {})))
+        self.assertIn('The DB seems to be online', io.get_value())
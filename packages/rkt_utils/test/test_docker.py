@@ -1,5 +1,7 @@
 
-from rkt_utils.docker import TagImageTask
+from subprocess import CalledProcessError
+from unittest import mock
+from rkt_utils.docker import TagImageTask, PushTask
 from rkd.api.testing import FunctionalTestingCase
 
 
@@ -120,3 +122,34 @@ class DockerTestCase(FunctionalTestingCase):
             ['quay.io/riotkit/taiga:4.0.4', 'quay.io/riotkit/taiga:4.0', 'quay.io/riotkit/taiga:4'],
             out
         )
+
+    def test_parallel_push_reports_each_tag_and_fails_on_any_error(self):
+        task = PushTask()
+        self.satisfy_task_dependencies(task)
+        pushed = []
+
+        def exec_mock(cmd: str, capture: bool = False, background: bool = False):
+            pushed.append(cmd)
+
+            if cmd.endswith(':2'):
+                raise CalledProcessError(1, cmd)
+
+            return ''
+
+        with mock.patch.object(task, 'exec', side_effect=exec_mock):
+            result = task.push_in_parallel(['quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga:2.1',
+                                            'quay.io/riotkit/taiga:2', 'quay.io/riotkit/taiga:latest'], 3)
+
+        self.assertFalse(result)
+        self.assertEqual('docker push quay.io/riotkit/taiga:2.1.3', pushed[0])
+        self.assertEqual(4, len(pushed))
+
+    def test_parallel_push_skips_other_tags_when_original_push_fails(self):
+        task = PushTask()
+        self.satisfy_task_dependencies(task)
+
+        with mock.patch.object(task, 'exec', side_effect=CalledProcessError(1, 'docker push')) as exec_mock:
+            result = task.push_in_parallel(['quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga:2.1'], 2)
+
+        self.assertFalse(result)
+        self.assertEqual(1, exec_mock.call_count)
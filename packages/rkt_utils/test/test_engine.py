@@ -0,0 +1,127 @@
+import os
+import json
+import tempfile
+import threading
+from socketserver import UnixStreamServer
+from http.server import BaseHTTPRequestHandler
+from rkd.api.testing import BasicTestingCase
+from rkt_utils.engine import EngineClient, EngineException, split_image_tag
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    """ Docker Engine stand-in, answers tag/inspect/push calls and records them """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _send(self, status: int, body: bytes = b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+
+        if 'dropped' in self.path:
+            self.close_connection = True
+            return
+
+        if self.path == '/images/alpine:3.12/json':
+            return self._send(200, json.dumps({'Id': 'sha256:abc', 'RepoTags': ['alpine:3.12']}).encode('utf-8'))
+
+        self._send(404, b'{"message": "No such image"}')
+
+    def do_POST(self):
+        self.server.requests.append(('POST', self.path))
+
+        if 'dropped' in self.path:
+            self.close_connection = True
+            return
+
+        if '/tag?' in self.path:
+            return self._send(201)
+
+        if '/push?' in self.path:
+            if 'broken' in self.path:
+                return self._send(200, b'{"status": "Preparing"}\n{"error": "denied: requested access"}\n')
+
+            return self._send(200, b'{"status": "Pushing"}\n{"status": "Pushed"}\n')
+
+        self._send(404, b'{"message": "page not found"}')
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'docker.sock')
+        self.server = UnixStreamServer(self.socket_path, FakeEngineHandler)
+        self.server.requests = []
+        self.server.connections = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.socket_path)
+
+
+class EngineClientTest(BasicTestingCase):
+    def test_split_image_tag(self):
+        self.assertEqual(('quay.io/riotkit/taiga', '2.1'), split_image_tag('quay.io/riotkit/taiga:2.1'))
+        self.assertEqual(('localhost:5000/taiga', 'latest'), split_image_tag('localhost:5000/taiga'))
+
+    def test_tagging_many_images_uses_a_single_connection(self):
+        engine = FakeEngine()
+
+        with engine as server:
+            with EngineClient(engine.socket_path) as client:
+                for tag in ['2.1.3', '2.1', '2', 'latest']:
+                    client.tag('quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga:%s' % tag)
+
+            self.assertEqual(1, server.connections)
+            self.assertEqual(('POST', '/images/quay.io/riotkit/taiga:2.1.3/tag?repo=quay.io%2Friotkit%2Ftaiga&tag=2'),
+                             server.requests[2])
+
+    def test_inspect(self):
+        engine = FakeEngine()
+
+        with engine:
+            with EngineClient(engine.socket_path) as client:
+                self.assertEqual('sha256:abc', client.inspect_image('alpine:3.12')['Id'])
+
+                with self.assertRaises(EngineException):
+                    client.inspect_image('alpine:not-existing')
+
+    def test_push_reports_error_from_the_progress_stream(self):
+        engine = FakeEngine()
+
+        with engine:
+            with EngineClient(engine.socket_path) as client:
+                client.push('localhost:5000/taiga:2.1', registry_auth={})
+
+                with self.assertRaises(EngineException):
+                    client.push('localhost:5000/broken:2.1', registry_auth={})
+
+    def test_only_idempotent_requests_are_repeated_after_connection_loss(self):
+        engine = FakeEngine()
+
+        with engine as server:
+            with EngineClient(engine.socket_path) as client:
+                with self.assertRaises(EngineException):
+                    client.push('localhost:5000/dropped:2.1', registry_auth={})
+
+                self.assertEqual(1, len(server.requests))
+
+                with self.assertRaises(EngineException):
+                    client.inspect_image('dropped:2.1')
+
+                self.assertEqual(3, len(server.requests))
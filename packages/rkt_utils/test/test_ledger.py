@@ -0,0 +1,49 @@
+import os
+import tempfile
+from unittest import mock
+from rkd.api.testing import BasicTestingCase
+from rkt_utils.docker import PushTask
+from rkt_utils.ledger import BuildLedger
+
+
+class BuildLedgerTest(BasicTestingCase):
+    def test_record_lookup_and_forget(self):
+        path = os.path.join(tempfile.mkdtemp(), 'ledger', 'builds.sqlite3')
+
+        with BuildLedger(path) as ledger:
+            ledger.record_many(['quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga:2.1'], digest='sha256:abc',
+                               git_tag='2.1.3')
+            ledger.record('quay.io/riotkit/taiga:2.1.3', digest='sha256:def')
+
+        # another process opening the same database
+        with BuildLedger(path) as ledger:
+            self.assertEqual(('quay.io/riotkit/taiga', '2.1', 'sha256:abc', '2.1.3'),
+                             ledger.get('quay.io/riotkit/taiga:2.1')[0:4])
+            self.assertEqual('sha256:def', ledger.get('quay.io/riotkit/taiga:2.1.3').digest)
+            self.assertFalse(ledger.contains('quay.io/riotkit/taiga:2'))
+
+            ledger.forget('quay.io/riotkit/taiga:2.1')
+            self.assertFalse(ledger.contains('quay.io/riotkit/taiga:2.1'))
+
+    def test_push_task_records_pushed_tags(self):
+        path = os.path.join(tempfile.mkdtemp(), 'builds.sqlite3')
+        task = PushTask()
+        self.satisfy_task_dependencies(task)
+
+        context = self.mock_execution_context(task, {
+            'image': 'quay.io/riotkit/taiga:2.1.3', 'images_file': None, 'propagate': True, 'without_latest': True,
+            'without_global_latest': True, 'allowed_meta': 'rc', 'keep_prefix': None, 'engine_api': False,
+            'parallel': '1', 'registry_retag': False, 'skip_unchanged': False, 'ledger': path, 'git_tag': '2.1.3'
+        })
+
+        with mock.patch.object(task, 'exec') as exec_mock, \
+                mock.patch.object(task, '_get_local_digest', return_value='sha256:abc'), \
+                mock.patch.object(BuildLedger, 'close', autospec=True, side_effect=BuildLedger.close) as close:
+            self.assertTrue(task.execute(context))
+
+        self.assertEqual(3, exec_mock.call_count)
+        close.assert_called_once()
+
+        with BuildLedger(path) as ledger:
+            for tag in ['2.1.3', '2', '2.1']:
+                self.assertEqual('sha256:abc', ledger.get('quay.io/riotkit/taiga:' + tag).digest)
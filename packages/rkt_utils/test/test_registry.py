@@ -0,0 +1,216 @@
+import os
+import json
+import stat
+import hashlib
+import tempfile
+import threading
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from rkd.api.testing import BasicTestingCase
+from rkt_utils.docker import PushTask
+from rkt_utils.registry import RegistryClient, RegistryException, parse_image, load_docker_credentials
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    """ Minimal registry:2 stand-in, keeps manifests in memory """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split_path(self):
+        repository, reference = self.path[len('/v2/'):].split('/manifests/')
+        return repository, reference
+
+    def _send(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+
+        if '/tags/list' in self.path:
+            return self._list_tags()
+
+        repository, reference = self._split_path()
+        manifest = self.server.manifests.get((repository, reference))
+
+        if reference.startswith('sha256:'):
+            manifest = ([content for key, content in self.server.manifests.items()
+                         if key[0] == repository and 'sha256:' + hashlib.sha256(content).hexdigest() == reference]
+                        or [None])[0]
+
+        if not manifest:
+            return self._send(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+
+        headers = {'Content-Type': MANIFEST_TYPE}
+
+        if self.server.send_digest:
+            headers['Docker-Content-Digest'] = 'sha256:' + hashlib.sha256(manifest).hexdigest()
+
+        self._send(200, manifest, headers)
+
+    do_HEAD = do_GET
+
+    def _list_tags(self):
+        path, query = self.path.split('?', 1)
+        repository = path[len('/v2/'):-len('/tags/list')]
+        params = dict(pair.split('=') for pair in query.split('&'))
+        tags = sorted([key[1] for key in self.server.manifests.keys() if key[0] == repository])
+        tags = [tag for tag in tags if tag > params.get('last', '')]
+        page = tags[0:int(params['n'])]
+        headers = {'Content-Type': 'application/json'}
+
+        if len(tags) > len(page):
+            headers['Link'] = '</v2/%s/tags/list?n=%s&last=%s>; rel="next"' % (repository, params['n'], page[-1])
+
+        self._send(200, json.dumps({'name': repository, 'tags': page}).encode('utf-8'), headers)
+
+    def do_PUT(self):
+        self.server.requests.append(('PUT', self.path))
+        repository, reference = self._split_path()
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.manifests[(repository, reference)] = body
+
+        self._send(201, headers={'Docker-Content-Digest': 'sha256:' + hashlib.sha256(body).hexdigest()})
+
+
+class FakeRegistry(object):
+    def __init__(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeRegistryHandler)
+        self.server.manifests = {}
+        self.server.requests = []
+        self.server.send_digest = True
+        self.address = '127.0.0.1:%i' % self.server.server_port
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RegistryTest(BasicTestingCase):
+    def test_parse_image(self):
+        self.assertEqual(('quay.io', 'riotkit/infracheck', 'v2.0.0'), parse_image('quay.io/riotkit/infracheck:v2.0.0'))
+        self.assertEqual(('localhost:5000', 'taiga', 'latest'), parse_image('localhost:5000/taiga'))
+        self.assertEqual(('registry-1.docker.io', 'library/alpine', '3.12'), parse_image('alpine:3.12'))
+        self.assertEqual(('registry-1.docker.io', 'riotkit/taiga', 'latest'), parse_image('riotkit/taiga'))
+
+    def test_retag_copies_manifest_without_pulling_it_more_than_once(self):
+        registry = FakeRegistry()
+        manifest = json.dumps({'schemaVersion': 2, 'mediaType': MANIFEST_TYPE}).encode('utf-8')
+
+        with registry as server:
+            server.manifests[('riotkit/taiga', '2.1.3')] = manifest
+
+            digests = RegistryClient(registry.address, username='').retag('riotkit/taiga', '2.1.3', ['2.1', '2'])
+
+            self.assertEqual(manifest, server.manifests[('riotkit/taiga', '2.1')])
+            self.assertEqual(manifest, server.manifests[('riotkit/taiga', '2')])
+            self.assertEqual(['2.1', '2'], list(digests.keys()))
+            self.assertEqual(1, len([r for r in server.requests if r[0] == 'GET']))
+
+    def test_list_tags_follows_pagination(self):
+        registry = FakeRegistry()
+
+        with registry as server:
+            for tag in ['1.0', '1.1', '2.0', '2.1', 'latest']:
+                server.manifests[('riotkit/taiga', tag)] = b'{}'
+
+            tags = RegistryClient(registry.address, username='').list_tags('riotkit/taiga', page_size=2)
+
+            self.assertEqual(['1.0', '1.1', '2.0', '2.1', 'latest'], tags)
+            self.assertEqual(3, len(server.requests))
+
+    def test_missing_manifest_raises_exception(self):
+        registry = FakeRegistry()
+
+        with registry:
+            with self.assertRaises(RegistryException):
+                RegistryClient(registry.address, username='').get_manifest('riotkit/taiga', 'not-existing')
+
+    def test_manifest_exists_without_digest_header(self):
+        registry = FakeRegistry()
+
+        with registry as server:
+            server.manifests[('riotkit/taiga', '2.1')] = b'{}'
+            server.send_digest = False
+            client = RegistryClient(registry.address, username='')
+
+            self.assertTrue(client.manifest_exists('riotkit/taiga', '2.1'))
+            self.assertFalse(client.manifest_exists('riotkit/taiga', '2.2'))
+
+    def test_credentials_are_taken_from_credential_helper(self):
+        directory = tempfile.mkdtemp()
+        helper_path = os.path.join(directory, 'docker-credential-fake')
+        config_path = os.path.join(directory, 'config.json')
+
+        with open(helper_path, 'w') as f:
+            f.write('#!/bin/sh\nread server\n[ "$server" = "quay.io" ] || exit 1\n'
+                    'echo \'{"ServerURL": "quay.io", "Username": "riotkit", "Secret": "anarchy"}\'\n')
+
+        os.chmod(helper_path, stat.S_IRWXU)
+
+        with open(config_path, 'w') as f:
+            json.dump({'auths': {'quay.io': {}, 'ghcr.io': {}}, 'credsStore': 'fake'}, f)
+
+        with mock.patch.dict(os.environ, {'PATH': directory + os.pathsep + os.environ.get('PATH', '')}):
+            self.assertEqual(('riotkit', 'anarchy'), load_docker_credentials('quay.io', config_path))
+            self.assertIsNone(load_docker_credentials('ghcr.io', config_path))
+
+            with open(config_path, 'w') as f:
+                json.dump({'credHelpers': {'quay.io': 'fake'}, 'credsStore': 'not-installed'}, f)
+
+            self.assertEqual(('riotkit', 'anarchy'), load_docker_credentials('quay.io', config_path))
+
+    def test_push_task_pushes_once_and_retags_in_registry(self):
+        registry = FakeRegistry()
+        task = PushTask()
+        self.satisfy_task_dependencies(task)
+
+        with registry as server:
+            server.manifests[('riotkit/taiga', '2.1.3')] = b'{"schemaVersion": 2}'
+            image = registry.address + '/riotkit/taiga'
+
+            with mock.patch.object(task, 'exec', return_value='') as exec_mock:
+                result = task.push_and_retag_in_registry([image + ':2.1.3', image + ':2.1', image + ':latest'])
+
+            self.assertTrue(result)
+            exec_mock.assert_called_once_with('docker push %s:2.1.3' % image, capture=True)
+            self.assertIn(('riotkit/taiga', 'latest'), server.manifests)
+
+    def test_push_task_updates_only_tags_pointing_to_other_manifest(self):
+        registry = FakeRegistry()
+        task = PushTask()
+        self.satisfy_task_dependencies(task)
+        current = b'{"schemaVersion": 2, "config": "new"}'
+        current_digest = 'sha256:' + hashlib.sha256(current).hexdigest()
+
+        with registry as server:
+            server.manifests[('riotkit/taiga', '2.1.3')] = current
+            server.manifests[('riotkit/taiga', '2.1')] = current
+            server.manifests[('riotkit/taiga', '2')] = b'{"schemaVersion": 2, "config": "old"}'
+            image = registry.address + '/riotkit/taiga'
+            repo_digests = json.dumps([image + '@' + current_digest])
+
+            with mock.patch.object(task, 'exec', return_value=repo_digests) as exec_mock:
+                result = task.push_changed_only([image + ':2.1.3', image + ':2.1', image + ':2', image + ':latest'])
+
+            self.assertTrue(result)
+            self.assertEqual(1, exec_mock.call_count)  # only "docker image inspect", no push
+            self.assertEqual(current, server.manifests[('riotkit/taiga', '2')])
+            self.assertEqual(current, server.manifests[('riotkit/taiga', 'latest')])
+            self.assertEqual([('PUT', '/v2/riotkit/taiga/manifests/2'), ('PUT', '/v2/riotkit/taiga/manifests/latest')],
+                             [r for r in server.requests if r[0] == 'PUT'])
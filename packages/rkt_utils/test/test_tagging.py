@@ -0,0 +1,140 @@
+import re
+import tempfile
+from unittest import mock
+from rkd.api.testing import BasicTestingCase
+from rkt_utils.docker import TagImageTask
+from rkt_utils.tagging import TagPlanner
+
+ALLOWED_META = 'rc,alpha,stable,dev,prod,test,beta,build,b'
+
+
+def legacy_calculate_images(image: str, latest_per_version: bool, global_latest: bool, allowed_meta_list: str,
+                            keep_prefix: bool) -> list:
+    """ DockerBaseTask.calculate_images() before TagPlanner, kept as a reference for output compatibility """
+
+    allowed_meta = allowed_meta_list.replace(' ', '').split(',')
+    tag = image.split(':')[-1]
+    output_tags = [image]
+    pattern = re.compile('(?P<version>[0-9.]+)(-(?P<meta>[A-Za-z]+))?(?P<metanum>[0-9]+)?', re.IGNORECASE)
+    matches = [m.groupdict() for m in pattern.finditer(tag)]
+
+    if not matches:
+        return output_tags
+
+    meta_type = matches[0]['meta']
+    meta_number = matches[0]['metanum']
+
+    if meta_type and meta_type not in allowed_meta:
+        return output_tags
+
+    base_version = matches[0]['version']
+    optional_prefix = tag[0:tag.find(base_version)]
+    base_with_prefix = optional_prefix + base_version
+    meta = '-' + meta_type if meta_type else None
+    to_strip = optional_prefix if not keep_prefix else ''
+
+    def for_each_version(callback) -> list:
+        parts = tag.split('.')
+        versions = ['.'.join(parts[0:part_num]) for part_num in range(0, len(parts))]
+
+        return [image.replace(tag, callback(version)) for version in versions if version]
+
+    if global_latest:
+        output_tags.append(image.replace(tag, 'latest'))
+
+    if meta:
+        output_tags.append(image.replace(tag, base_with_prefix + '-latest%s' % meta, 1))
+
+        if latest_per_version:
+            versioned_part = base_with_prefix + meta + (meta_number if meta_number else '')
+            output_tags += for_each_version(
+                lambda version: tag.replace(versioned_part, version + '-latest%s' % meta, 1))
+    else:
+        output_tags += for_each_version(lambda version: tag.replace(base_with_prefix, version, 1))
+
+    if not to_strip:
+        return output_tags
+
+    name = image[0:image.find(':')]
+    stripped = []
+
+    for tagged_image in output_tags:
+        tagged = tagged_image[len(name) + 1:]
+        stripped.append(name + ':' + (tagged[len(to_strip):] if tagged.startswith(to_strip) else tagged))
+
+    return stripped
+
+
+class TagPlannerTest(BasicTestingCase):
+    def test_plans_are_memoized_by_tag_and_flags(self):
+        planner = TagPlanner(ALLOWED_META)
+
+        first = planner.plan_tag('v2.1.3', latest_per_version=True, global_latest=True, keep_prefix=False)
+        second = planner.plan_tag('v2.1.3', latest_per_version=True, global_latest=True, keep_prefix=False)
+        other_flags = planner.plan_tag('v2.1.3', latest_per_version=True, global_latest=False, keep_prefix=False)
+
+        self.assertIs(first, second)
+        self.assertEqual(['2.1.3', 'latest', '2', '2.1'], first.tags)
+        self.assertEqual(['2.1.3', '2', '2.1'], other_flags.tags)
+
+    def test_plan_many_keeps_order_and_reports_warnings_per_image(self):
+        planned = TagPlanner(ALLOWED_META).plan_many(
+            ['quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga-front:2.1.3-rc2', 'quay.io/riotkit/nginx:edge',
+             'quay.io/riotkit/php:7.4-unknownmeta'],
+            latest_per_version=True, global_latest=False, keep_prefix=False
+        )
+
+        self.assertEqual(['quay.io/riotkit/taiga:2.1.3', 'quay.io/riotkit/taiga:2', 'quay.io/riotkit/taiga:2.1'],
+                         planned[0][1].tags)
+        self.assertEqual(['quay.io/riotkit/taiga-front:2.1.3-rc2', 'quay.io/riotkit/taiga-front:2.1.3-latest-rc',
+                          'quay.io/riotkit/taiga-front:2-latest-rc', 'quay.io/riotkit/taiga-front:2.1-latest-rc'],
+                         planned[1][1].tags)
+        self.assertEqual(['quay.io/riotkit/nginx:edge'], planned[2][1].tags)
+        self.assertEqual('No release version found', planned[2][1].warning)
+        self.assertEqual(['quay.io/riotkit/php:7.4-unknownmeta'], planned[3][1].tags)
+        self.assertIsNotNone(planned[3][1].warning)
+
+    def test_tag_task_tags_all_images_from_images_file(self):
+        task = TagImageTask()
+        self.satisfy_task_dependencies(task)
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"# comment\nquay.io/riotkit/taiga:2.1\n\nquay.io/riotkit/taiga-front:3.0\n")
+            f.flush()
+
+            context = self.mock_execution_context(task, {
+                'image': None, 'images_file': f.name, 'propagate': True, 'without_latest': False,
+                'without_global_latest': True, 'allowed_meta': ALLOWED_META, 'keep_prefix': None,
+                'engine_api': False
+            })
+
+            with mock.patch.object(task, 'exec') as exec_mock:
+                self.assertTrue(task.execute(context))
+
+        self.assertEqual(
+            ['docker tag quay.io/riotkit/taiga:2.1 quay.io/riotkit/taiga:2.1',
+             'docker tag quay.io/riotkit/taiga:2.1 quay.io/riotkit/taiga:2',
+             'docker tag quay.io/riotkit/taiga-front:3.0 quay.io/riotkit/taiga-front:3.0',
+             'docker tag quay.io/riotkit/taiga-front:3.0 quay.io/riotkit/taiga-front:3'],
+            [call[0][0] for call in exec_mock.call_args_list]
+        )
+
+    def test_same_output_as_before_the_planner(self):
+        task = TagImageTask()
+        self.satisfy_task_dependencies(task)
+        images = ['quay.io/riotkit/taiga:v2.1.3', 'localhost:5000/riotkit/taiga:v2.1.3',
+                  'localhost:5000/riotkit/taiga:release-2.1.3-rc1', 'quay.io/riotkit/taiga:.1.2',
+                  'riotkit/taiga:release-4.0.5-dev1', 'taiga:2.1.3-beta', 'quay.io/riotkit/taiga:1.0.0-RC1',
+                  'quay.io/riotkit/taiga:edge', 'quay.io/riotkit/taiga:7.4-unknownmeta', 'localhost:5000/taiga:2.0']
+
+        for image in images:
+            for flags in [(True, True, False), (False, False, False), (True, False, True), (False, True, True)]:
+                with self.subTest(image=image, flags=flags):
+                    self.assertEqual(legacy_calculate_images(image, flags[0], flags[1], ALLOWED_META, flags[2]),
+                                     task.calculate_images(image, flags[0], flags[1], ALLOWED_META, flags[2]))
+
+    def test_prefix_is_kept_for_registry_with_port(self):
+        plan = TagPlanner(ALLOWED_META).plan('localhost:5000/riotkit/taiga:v2.1.3', True, False, keep_prefix=False)
+
+        self.assertEqual(['localhost:5000/riotkit/taiga:v2.1.3', 'localhost:5000/riotkit/taiga:v2',
+                          'localhost:5000/riotkit/taiga:v2.1'], plan.tags)